@@ -0,0 +1,280 @@
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+import asyncio
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from .metrics import ADMISSION_REJECTIONS, ADMISSION_WAIT_SECONDS
+
+
+logger = logging.getLogger(__name__)
+
+# Requests of this process waiting for an in-flight slot
+_lock = threading.Lock()
+_waiting = 0
+
+# The in-flight slot held by the current request, see `aacquire_slot`
+_held = ContextVar("admission_slot", default=None)
+
+# Seconds a bucket lock is held at most, should its holder die
+_BUCKET_LOCK_TTL = 2
+
+
+class Throttled(Exception):
+    """
+    Raised when a request is not admitted.
+
+    Attributes:
+        retry_after (float): Seconds after which the request may be retried.
+    """
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+async def _alock_bucket(key, timeout=1.0):
+    """Take the lock of a bucket, shared by all processes through `cache.add`."""
+    deadline = time.monotonic() + timeout
+    while not await cache.aadd(f"{key}:lock", 1, timeout=_BUCKET_LOCK_TTL):
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.005)
+    return True
+
+
+async def acheck_rate(user_id, kind, cost=1):
+    """
+    Take `cost` tokens from the user's bucket for `kind` requests.
+
+    Buckets hold up to BURST tokens and are refilled with RATE tokens per
+    second, as configured for `kind` in `ADMISSION_RATES`. Their state is
+    kept in the default cache, updated under a lock taken with the cache's
+    atomic `add`, so every process sharing the cache shares the buckets.
+    A request never costs more than a full bucket.
+
+    Args:
+        user_id (int): The primary key of the user.
+        kind (str): The kind of request, e.g. "chat" or "upload".
+        cost (int): The number of tokens the request takes.
+
+    Raises:
+        Throttled: If the bucket doesn't hold `cost` tokens.
+    """
+    rate, burst = settings.ADMISSION_RATES[kind]
+    if not settings.ADMISSION_ENABLED or rate <= 0:
+        return
+    cost = min(cost, burst)
+    key = f"admission:bucket:{kind}:{user_id}"
+    if not await _alock_bucket(key):
+        ADMISSION_REJECTIONS.inc(kind=kind, reason="rate")
+        raise Throttled(f"Too many {kind} requests at once", retry_after=1)
+    try:
+        now = time.time()
+        tokens, updated = await cache.aget(key) or (burst, now)
+        tokens = min(burst, tokens + max(now - updated, 0) * rate)
+        if tokens < cost:
+            ADMISSION_REJECTIONS.inc(kind=kind, reason="rate")
+            raise Throttled(f"Too many {kind} requests", retry_after=(cost - tokens) / rate)
+        # The state of a full bucket doesn't need to be kept
+        await cache.aset(key, (tokens - cost, now), timeout=math.ceil(burst / rate) + 1)
+    finally:
+        await cache.adelete(f"{key}:lock")
+
+
+def _slot_keys():
+    return [f"admission:slot:{i}" for i in range(settings.ADMISSION_MAX_IN_FLIGHT)]
+
+
+def _free_slot_keys(taken):
+    free = [key for key in _slot_keys() if key not in taken]
+    random.shuffle(free)
+    return free
+
+
+async def _atry_acquire(token):
+    """Take a free slot, returning its key, or None if they're all taken."""
+    for key in _free_slot_keys(await cache.aget_many(_slot_keys())):
+        # `add` only succeeds if no other request took the slot meanwhile
+        if await cache.aadd(key, token, timeout=settings.ADMISSION_SLOT_LEASE):
+            return key
+    return None
+
+
+def _try_acquire(token):
+    """Take a free slot, returning its key, or None if they're all taken."""
+    for key in _free_slot_keys(cache.get_many(_slot_keys())):
+        if cache.add(key, token, timeout=settings.ADMISSION_SLOT_LEASE):
+            return key
+    return None
+
+
+def _enabled():
+    return settings.ADMISSION_ENABLED and settings.ADMISSION_MAX_IN_FLIGHT > 0
+
+
+@contextmanager
+def _queued(kind):
+    """Count a request of this process waiting for a slot, unless too many already wait."""
+    global _waiting
+    with _lock:
+        if _waiting >= settings.ADMISSION_MAX_QUEUE:
+            ADMISSION_REJECTIONS.inc(kind=kind, reason="queue_full")
+            raise Throttled("The server is busy", retry_after=settings.ADMISSION_QUEUE_TIMEOUT)
+        _waiting += 1
+    try:
+        yield
+    finally:
+        with _lock:
+            _waiting -= 1
+
+
+def _delays(deadline):
+    """Yield the growing delays between attempts to take a slot until `deadline`."""
+    delay = 0.01
+    while (remaining := deadline - time.monotonic()) > 0:
+        # Jitter spreads the retries of requests that started waiting together
+        yield min(remaining, delay * random.uniform(0.5, 1.5))
+        delay = min(delay * 2, 0.25)
+
+
+def _admitted(kind, key, token, started):
+    if key is None:
+        ADMISSION_REJECTIONS.inc(kind=kind, reason="timeout")
+        raise Throttled("The server is busy", retry_after=settings.ADMISSION_QUEUE_TIMEOUT)
+    ADMISSION_WAIT_SECONDS.observe(time.monotonic() - started, kind=kind)
+    _held.set((key, token))
+    return key, token
+
+
+async def aacquire_slot(kind):
+    """
+    Take one of the `ADMISSION_MAX_IN_FLIGHT` slots of requests calling OpenAI.
+
+    Slots are cache entries shared by every process, taken with the cache's
+    atomic `add` and leased for `ADMISSION_SLOT_LEASE` seconds, so slots of
+    a crashed process are freed eventually. When they're all taken, up to
+    `ADMISSION_MAX_QUEUE` requests of this process wait for one, polling
+    with backoff, for at most `ADMISSION_QUEUE_TIMEOUT` seconds. Further
+    requests are rejected at once, so bursts get a fast 429 instead of an
+    ever longer wait.
+
+    The slot is held by the current context until released, so that the
+    OpenAI requests made within it through `aslot` or `slot`, e.g. embedding
+    a chat's question, don't take another one.
+
+    Args:
+        kind (str): The kind of request, for the metrics.
+
+    Returns:
+        tuple[str, str] | None: The slot to pass to `arelease_slot`, None if
+            admission control is disabled.
+
+    Raises:
+        Throttled: If no slot was free in time, or too many requests wait.
+    """
+    if not _enabled():
+        return None
+    started = time.monotonic()
+    token = uuid.uuid4().hex
+    key = await _atry_acquire(token)
+    if key is None:
+        with _queued(kind):
+            for delay in _delays(started + settings.ADMISSION_QUEUE_TIMEOUT):
+                await asyncio.sleep(delay)
+                if (key := await _atry_acquire(token)) is not None:
+                    break
+    return _admitted(kind, key, token, started)
+
+
+def acquire_slot(kind):
+    """
+    Take an in-flight slot from synchronous code, see `aacquire_slot`.
+
+    Args:
+        kind (str): The kind of request, for the metrics.
+
+    Returns:
+        tuple[str, str] | None: The slot to pass to `release_slot`, None if
+            admission control is disabled.
+
+    Raises:
+        Throttled: If no slot was free in time, or too many requests wait.
+    """
+    if not _enabled():
+        return None
+    started = time.monotonic()
+    token = uuid.uuid4().hex
+    key = _try_acquire(token)
+    if key is None:
+        with _queued(kind):
+            for delay in _delays(started + settings.ADMISSION_QUEUE_TIMEOUT):
+                time.sleep(delay)
+                if (key := _try_acquire(token)) is not None:
+                    break
+    return _admitted(kind, key, token, started)
+
+
+def _released(slot):
+    if _held.get() == slot:
+        _held.set(None)
+    return slot
+
+
+async def arelease_slot(slot):
+    """
+    Free a slot taken by `aacquire_slot`.
+
+    Args:
+        slot (tuple[str, str] | None): The slot returned by `aacquire_slot`.
+    """
+    if slot is None:
+        return
+    key, token = _released(slot)
+    try:
+        # Unless its lease expired and another request took it
+        if await cache.aget(key) == token:
+            await cache.adelete(key)
+    except Exception:
+        logger.exception("Failed to release admission slot %s", key)
+
+
+def release_slot(slot):
+    """
+    Free a slot taken by `acquire_slot`.
+
+    Args:
+        slot (tuple[str, str] | None): The slot returned by `acquire_slot`.
+    """
+    if slot is None:
+        return
+    key, token = _released(slot)
+    try:
+        if cache.get(key) == token:
+            cache.delete(key)
+    except Exception:
+        logger.exception("Failed to release admission slot %s", key)
+
+
+@asynccontextmanager
+async def aslot(kind):
+    """Hold an in-flight slot while calling OpenAI, unless one is held already."""
+    held = await aacquire_slot(kind) if _held.get() is None else None
+    try:
+        yield
+    finally:
+        await arelease_slot(held)
+
+
+@contextmanager
+def slot(kind):
+    """Hold an in-flight slot while calling OpenAI, unless one is held already."""
+    held = acquire_slot(kind) if _held.get() is None else None
+    try:
+        yield
+    finally:
+        release_slot(held)
@@ -1,6 +1,14 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class DjangolangchainappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'DjangoLangChainApp'
+
+    def ready(self):
+        # Connect the signal receivers cleaning up deleted documents
+        from . import deletion  # noqa: F401
+
+        from DjangoLangChainProject.database import configure_sqlite
+        connection_created.connect(configure_sqlite, dispatch_uid="configure_sqlite")
@@ -0,0 +1,80 @@
+from abc import ABC, abstractmethod
+from collections import namedtuple
+import asyncio
+
+
+# A single search result: vector ID, similarity score and metadata
+Match = namedtuple("Match", ["id", "score", "metadata"])
+
+
+class VectorStoreError(Exception):
+    """
+    Raised when the vector store fails to handle a request.
+
+    Attributes:
+        status (int | None): HTTP status of the failed request, if any.
+        headers (dict | None): HTTP headers of the failed response, if any.
+    """
+    def __init__(self, message, status=None, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers
+
+
+class VectorBackend(ABC):
+    """
+    Interface of the vector stores documents are indexed in.
+
+    Vectors are dicts with an `id`, their `values` and a `metadata` dict
+    that holds at least the `pdf_id` of the document they belong to.
+    """
+    @abstractmethod
+    def upsert(self, vectors):
+        """
+        Insert vectors, replacing existing vectors with the same IDs.
+
+        Args:
+            vectors (list[dict]): The vectors to insert.
+        """
+
+    @abstractmethod
+    def delete(self, ids):
+        """
+        Delete vectors by ID.
+
+        Args:
+            ids (list[str]): The IDs of the vectors to delete.
+        """
+
+    @abstractmethod
+    def delete_by_pdf_id(self, pdf_id):
+        """
+        Delete every vector of a document.
+
+        Args:
+            pdf_id (uuid.UUID | str): The `pdf_id` metadata of the vectors.
+        """
+
+    @abstractmethod
+    def query(self, vector, top_k, filter=None):
+        """
+        Return the vectors most similar to `vector`.
+
+        Args:
+            vector (list[float]): The query embedding.
+            top_k (int): Maximum number of matches to return.
+            filter (dict, optional): Pinecone style metadata filter, e.g.
+                `{"pdf_id": {"$in": [...]}}`.
+
+        Returns:
+            list[Match]: The matches, most similar first.
+        """
+
+    async def aquery(self, vector, top_k, filter=None):
+        """
+        Async version of `query`, run on a worker thread by default.
+
+        Returns:
+            list[Match]: The matches, most similar first.
+        """
+        return await asyncio.to_thread(self.query, vector, top_k, filter)
@@ -0,0 +1,222 @@
+from contextlib import contextmanager
+from pathlib import Path
+import fcntl
+import json
+import threading
+import numpy as np
+from .base import Match, VectorBackend, VectorStoreError
+
+
+class LocalBackend(VectorBackend):
+    """
+    In-process vector backend keeping vectors on local disk.
+
+    Vectors are normalized and appended to a float32 file that is memory
+    mapped for searching, while additions and deletions are appended to a
+    JSON lines log. Before every operation the log entries written since
+    the last one (by any process) are applied, and writes are serialized
+    with a lock file, so the web server and the ingestion worker can share
+    a store on one machine. Searches filtered by `pdf_id` only score the
+    vectors of the requested documents.
+
+    Deleted vectors stay in the vector file, so the store is meant for
+    development, tests and small deployments.
+
+    Args:
+        path (str | pathlib.Path): Directory the store is kept in.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._vectors_path = self.path / "vectors.f32"
+        self._log_path = self.path / "log.jsonl"
+        self._lock_path = self.path / "lock"
+
+        self._lock = threading.RLock()
+        self._log_offset = 0
+        self._dimension = None
+        self._ids = []          # Vector ID of each row of the vector file
+        self._metadata = []     # Metadata of each row, None once deleted
+        self._live = bytearray()  # Whether each row is a live vector
+        self._rows = {}         # Row of each live vector ID
+        self._by_pdf_id = {}    # Live rows of each document
+        self._matrix = None
+        self._refresh()
+
+    def _refresh(self):
+        """Apply the log entries written since the last refresh."""
+        with self._lock:
+            if not self._log_path.exists():
+                return
+            with open(self._log_path, "rb") as log:
+                log.seek(self._log_offset)
+                for line in log:
+                    # Stop at an entry another process is still writing
+                    if not line.endswith(b"\n"):
+                        break
+                    self._apply(json.loads(line))
+                    self._log_offset += len(line)
+
+    def _apply(self, entry):
+        if entry["op"] == "add":
+            self._dimension = entry["dimension"]
+            self._remove(entry["id"])
+            row = entry["row"]
+            # Rows whose write was interrupted before being logged stay empty
+            while len(self._ids) <= row:
+                self._ids.append(None)
+                self._metadata.append(None)
+                self._live.append(0)
+            self._ids[row] = entry["id"]
+            self._metadata[row] = entry["metadata"]
+            self._live[row] = 1
+            self._rows[entry["id"]] = row
+            self._by_pdf_id.setdefault(entry["metadata"].get("pdf_id"), set()).add(row)
+
+        elif entry["op"] == "delete":
+            for vector_id in entry["ids"]:
+                self._remove(vector_id)
+
+    def _remove(self, vector_id):
+        row = self._rows.pop(vector_id, None)
+        if row is not None:
+            self._by_pdf_id.get(self._metadata[row].get("pdf_id"), set()).discard(row)
+            self._metadata[row] = None
+            self._live[row] = 0
+
+    @contextmanager
+    def _write_lock(self):
+        """Hold the store's lock across threads and processes, up to date."""
+        with self._lock, open(self._lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _append_log(self, entries):
+        with open(self._log_path, "a") as log:
+            log.writelines(json.dumps(entry) + "\n" for entry in entries)
+        self._refresh()
+
+    def _vectors(self):
+        """Return the memory mapped matrix of every logged row."""
+        rows = len(self._ids)
+        if self._matrix is None or self._matrix.shape[0] != rows:
+            self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r",
+                                     shape=(rows, self._dimension))
+        return self._matrix
+
+    def upsert(self, vectors):
+        if not vectors:
+            return
+        values = np.asarray([vector["values"] for vector in vectors], dtype=np.float32)
+        norms = np.linalg.norm(values, axis=1, keepdims=True)
+        values /= np.where(norms == 0, 1, norms)
+
+        with self._write_lock():
+            dimension = values.shape[1]
+            if self._dimension not in (None, dimension):
+                raise VectorStoreError(
+                    f"Expected vectors of dimension {self._dimension}, got {dimension}"
+                )
+            with open(self._vectors_path, "ab") as file:
+                first_row = file.tell() // (dimension * values.itemsize)
+                file.write(values.tobytes())
+            self._append_log(
+                {"op": "add", "row": first_row + i, "id": vector["id"],
+                 "dimension": dimension, "metadata": vector.get("metadata", {})}
+                for i, vector in enumerate(vectors)
+            )
+
+    def delete(self, ids):
+        with self._write_lock():
+            self._append_log([{"op": "delete", "ids": list(ids)}])
+
+    def delete_by_pdf_id(self, pdf_id):
+        with self._write_lock():
+            rows = self._by_pdf_id.get(str(pdf_id), ())
+            self._append_log([{"op": "delete", "ids": [self._ids[row] for row in rows]}])
+
+    def query(self, vector, top_k, filter=None):
+        with self._lock:
+            self._refresh()
+            if top_k <= 0 or not self._rows:
+                return []
+            query = np.asarray(vector, dtype=np.float32)
+            query /= np.linalg.norm(query) or 1
+
+            if filter:
+                rows = self._candidates(filter)
+                if not rows:
+                    return []
+                rows = np.fromiter(rows, dtype=np.int64, count=len(rows))
+                scores = self._vectors()[rows] @ query
+            else:
+                # Score the whole memory mapped matrix instead of copying rows
+                rows = np.flatnonzero(np.frombuffer(self._live, dtype=np.bool_))
+                scores = (self._vectors() @ query)[rows]
+
+            k = min(top_k, len(rows))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [Match(self._ids[rows[i]], float(scores[i]), dict(self._metadata[rows[i]]))
+                    for i in top]
+
+    def _candidates(self, filter):
+        """Return the live rows matching `filter`."""
+        filter = dict(filter or {})
+        pdf_ids = _equal_values(filter.get("pdf_id"))
+        if pdf_ids is None:
+            rows = self._rows.values()
+        else:
+            del filter["pdf_id"]
+            rows = set().union(*(self._by_pdf_id.get(str(pdf_id), ()) for pdf_id in pdf_ids))
+
+        if filter:
+            return [row for row in rows if _matches(self._metadata[row], filter)]
+        return list(rows)
+
+
+def _equal_values(condition):
+    """Return the values an `$eq`/`$in` condition accepts, or None for others."""
+    if condition is None:
+        return None
+    if not isinstance(condition, dict):
+        return [condition]
+    if set(condition) == {"$eq"}:
+        return [condition["$eq"]]
+    if set(condition) == {"$in"}:
+        return condition["$in"]
+    return None
+
+
+_OPERATORS = {
+    "$eq": lambda value, operand: value == operand,
+    "$ne": lambda value, operand: value != operand,
+    "$in": lambda value, operand: value in operand,
+    "$nin": lambda value, operand: value not in operand,
+    "$gt": lambda value, operand: value is not None and value > operand,
+    "$gte": lambda value, operand: value is not None and value >= operand,
+    "$lt": lambda value, operand: value is not None and value < operand,
+    "$lte": lambda value, operand: value is not None and value <= operand,
+}
+
+
+def _matches(metadata, filter):
+    """Evaluate a Pinecone style metadata filter against `metadata`."""
+    for field, condition in filter.items():
+        if field == "$and":
+            if not all(_matches(metadata, clause) for clause in condition):
+                return False
+        elif field == "$or":
+            if not any(_matches(metadata, clause) for clause in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(field)
+            if not all(_OPERATORS[op](value, operand) for op, operand in condition.items()):
+                return False
+        elif metadata.get(field) != condition:
+            return False
+    return True
@@ -0,0 +1,60 @@
+from functools import wraps
+import os
+from .base import Match, VectorBackend, VectorStoreError
+
+
+def _translate_errors(method):
+    """Re-raise Pinecone API errors as `VectorStoreError`."""
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        from pinecone import PineconeApiException
+        try:
+            return method(*args, **kwargs)
+        except PineconeApiException as e:
+            raise VectorStoreError(str(e), status=e.status, headers=e.headers) from e
+    return wrapper
+
+
+class PineconeBackend(VectorBackend):
+    """
+    Vector backend storing vectors in a Pinecone index.
+
+    Args:
+        index (pinecone.Index): The index to use.
+    """
+    def __init__(self, index):
+        self.index = index
+
+    @classmethod
+    def from_environment(cls):
+        """
+        Connect to the index named by the `PINECONE_INDEX` environment variable.
+
+        When `PINECONE_HOST` is set, requests go straight to that index host
+        (e.g. "https://<index>-<project>.svc.<region>.pinecone.io") instead
+        of it being looked up by name first.
+        """
+        from pinecone import Pinecone
+        pinecone = Pinecone(api_key=os.environ["PINECONE_API_KEY"])
+        return cls(pinecone.Index(os.environ["PINECONE_INDEX"],
+                                  host=os.environ.get("PINECONE_HOST", "")))
+
+    @_translate_errors
+    def upsert(self, vectors):
+        self.index.upsert(vectors=vectors)
+
+    @_translate_errors
+    def delete(self, ids):
+        self.index.delete(ids=ids)
+
+    @_translate_errors
+    def delete_by_pdf_id(self, pdf_id):
+        # Deleting by metadata filter is only supported by pod-based indexes
+        self.index.delete(filter={"pdf_id": str(pdf_id)})
+
+    @_translate_errors
+    def query(self, vector, top_k, filter=None):
+        response = self.index.query(vector=vector, top_k=top_k, filter=filter,
+                                    include_metadata=True)
+        return [Match(match.id, match.score, match.metadata or {})
+                for match in response.matches]
@@ -0,0 +1,53 @@
+from typing import Any, Callable, Optional
+from asgiref.sync import sync_to_async
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from ...admission import aslot, slot
+
+
+class VectorBackendRetriever(BaseRetriever):
+    """
+    LangChain retriever searching a `VectorBackend`.
+
+    The chunk text is looked up with `texts`, in a single call per search,
+    or read from the `text` metadata of vectors indexed before chunks were
+    stored apart. The vector ID and similarity score are added to the
+    document metadata.
+    """
+    backend: Any
+    embeddings: Any
+    k: int = 4
+    filter: Optional[dict] = None
+    # Returns the text of chunks by vector ID, given a list of vector IDs
+    texts: Optional[Callable] = None
+
+    def _missing_texts(self, matches):
+        if self.texts is None:
+            return []
+        return [match.id for match in matches if "text" not in match.metadata]
+
+    def _to_documents(self, matches, texts):
+        documents = []
+        for match in matches:
+            metadata = dict(match.metadata)
+            text = metadata.pop("text", None)
+            if text is None:
+                text = texts.get(match.id, "")
+            metadata.update(vector_id=match.id, score=match.score)
+            documents.append(Document(page_content=text, metadata=metadata))
+        return documents
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        with slot("embedding"):
+            vector = self.embeddings.embed_query(query)
+        matches = self.backend.query(vector, self.k, self.filter)
+        missing = self._missing_texts(matches)
+        return self._to_documents(matches, self.texts(missing) if missing else {})
+
+    async def _aget_relevant_documents(self, query, *, run_manager):
+        async with aslot("embedding"):
+            vector = await self.embeddings.aembed_query(query)
+        matches = await self.backend.aquery(vector, self.k, self.filter)
+        missing = self._missing_texts(matches)
+        return self._to_documents(matches, await sync_to_async(self.texts)(missing)
+                                  if missing else {})
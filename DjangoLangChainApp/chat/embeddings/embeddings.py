@@ -1,4 +1,189 @@
-from langchain_openai import OpenAIEmbeddings
+from array import array
+from collections import OrderedDict
+import hashlib
+import sqlite3
+import threading
+import time
+from django.conf import settings
+from langchain_core.embeddings import Embeddings
+from ..http_client import get_async_http_client
+from ...metrics import CACHE_REQUESTS, TOKENS
 import os
+import tiktoken
 
-openai_embeddings = OpenAIEmbeddings(openai_api_key=os.environ["OPENAI_API_KEY"])
\ No newline at end of file
+
+# Created on first use by `get_embeddings`
+_lock = threading.Lock()
+_embeddings = None
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that only sends texts it hasn't embedded before.
+
+    Document embeddings are stored in a local SQLite database keyed by a hash
+    of the model name and the text, so duplicate chunks (the same page
+    uploaded twice, shared boilerplate) are never re-embedded. The cache
+    holds at most `max_entries` vectors and evicts the least recently used
+    ones beyond that. The embeddings of the last `query_cache_size` queries
+    are kept in memory, so a question embedded for the answer cache isn't
+    embedded again by the retriever.
+
+    Attributes:
+        hits (int): Number of texts served from the cache.
+        misses (int): Number of texts that were missing from the cache.
+    """
+    def __init__(self, embeddings, model_name, path, max_entries, query_cache_size=256):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.path = str(path)
+        self.max_entries = max_entries
+        self.query_cache_size = query_cache_size
+        self._queries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connection(self):
+        """Return this thread's connection to the cache database."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+            )
+            self._local.connection = connection
+        return connection
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode()).hexdigest()
+
+    def embed_documents(self, texts):
+        """
+        Embed `texts`, sending only the ones missing from the cache.
+
+        Args:
+            texts (list[str]): The texts to embed.
+
+        Returns:
+            list[list[float]]: One embedding per text.
+        """
+        keys = [self._key(text) for text in texts]
+        connection = self._connection()
+        now = time.time()
+
+        cached = {}
+        unique_keys = list(dict.fromkeys(keys))
+        # Stay well below SQLite's limit on the number of query parameters
+        for start in range(0, len(unique_keys), 500):
+            chunk = unique_keys[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            cached.update(
+                (key, array("f", vector).tolist()) for key, vector in connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    chunk
+                )
+            )
+
+        missing = {key: text for key, text in zip(keys, texts) if key not in cached}
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            cached.update(zip(missing.keys(), vectors))
+            _count_tokens(missing.values())
+
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, array("f", cached[key]).tobytes(), now) for key in missing]
+            )
+            connection.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                [(now, key) for key in unique_keys if key not in missing]
+            )
+            if missing:
+                self._evict(connection)
+
+        misses = sum(1 for key in keys if key in missing)
+        with self._lock:
+            self.misses += misses
+            self.hits += len(keys) - misses
+        CACHE_REQUESTS.inc(len(keys) - misses, cache="embedding", result="hit")
+        CACHE_REQUESTS.inc(misses, cache="embedding", result="miss")
+        return [cached[key] for key in keys]
+
+    def _evict(self, connection):
+        """Remove the least recently used entries beyond `max_entries`."""
+        (count,) = connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        if count > self.max_entries:
+            connection.execute(
+                "DELETE FROM embeddings WHERE key IN ("
+                "SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,)
+            )
+
+    def _cached_query(self, text):
+        with self._lock:
+            vector = self._queries.get(text)
+            if vector is not None:
+                self._queries.move_to_end(text)
+        CACHE_REQUESTS.inc(cache="query_embedding", result="miss" if vector is None else "hit")
+        return vector
+
+    def _remember_query(self, text, vector):
+        _count_tokens([text])
+        with self._lock:
+            self._queries[text] = vector
+            while len(self._queries) > self.query_cache_size:
+                self._queries.popitem(last=False)
+        return vector
+
+    def embed_query(self, text):
+        vector = self._cached_query(text)
+        if vector is None:
+            vector = self._remember_query(text, self.embeddings.embed_query(text))
+        return vector
+
+    async def aembed_query(self, text):
+        vector = self._cached_query(text)
+        if vector is None:
+            vector = self._remember_query(text, await self.embeddings.aembed_query(text))
+        return vector
+
+
+def _count_tokens(texts):
+    """Count the tokens of `texts` sent to the embedding model."""
+    encoding = tiktoken.get_encoding("cl100k_base")
+    TOKENS.inc(sum(len(encoding.encode(text, disallowed_special=())) for text in texts),
+               kind="embedding")
+
+
+def get_embeddings():
+    """
+    Return the process-wide embedding model, creating it on first use.
+
+    Returns:
+        Embeddings: The OpenAI embeddings, wrapped in a `CachedEmbeddings`
+            unless `EMBEDDING_CACHE_PATH` is empty.
+    """
+    global _embeddings
+    if _embeddings is None:
+        with _lock:
+            if _embeddings is None:
+                from langchain_openai import OpenAIEmbeddings
+                embeddings = OpenAIEmbeddings(openai_api_key=os.environ["OPENAI_API_KEY"],
+                                              http_async_client=get_async_http_client())
+                if settings.EMBEDDING_CACHE_PATH:
+                    embeddings = CachedEmbeddings(
+                        embeddings,
+                        model_name=embeddings.model,
+                        path=settings.EMBEDDING_CACHE_PATH,
+                        max_entries=settings.EMBEDDING_CACHE_MAX_ENTRIES
+                    )
+                _embeddings = embeddings
+    return _embeddings
@@ -0,0 +1,66 @@
+import asyncio
+import threading
+import weakref
+from django.conf import settings
+import httpx
+
+
+# Created on first use by `get_async_http_client`
+_lock = threading.Lock()
+_client = None
+
+
+class _LoopLocalTransport(httpx.AsyncBaseTransport):
+    """
+    Transport keeping a separate connection pool per event loop.
+
+    Connections can't be shared between event loops, and while an ASGI
+    server runs a single loop per worker, async views served over WSGI
+    (e.g. `runserver`) run each request in a loop of its own. Pools of
+    loops that have been closed are dropped with their loop.
+    """
+    def __init__(self, limits):
+        self.limits = limits
+        self._lock = threading.Lock()
+        self._transports = weakref.WeakKeyDictionary()
+
+    def _transport(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            transport = self._transports.get(loop)
+            if transport is None:
+                transport = httpx.AsyncHTTPTransport(limits=self.limits)
+                self._transports[loop] = transport
+            return transport
+
+    async def handle_async_request(self, request):
+        return await self._transport().handle_async_request(request)
+
+    async def aclose(self):
+        transport = self._transports.pop(asyncio.get_running_loop(), None)
+        if transport is not None:
+            await transport.aclose()
+
+
+def get_async_http_client():
+    """
+    Return the async HTTP client shared by the OpenAI clients of this process.
+
+    Every async chat and embedding request of the process goes through this
+    client, so concurrent requests reuse a pool of at most
+    `HTTP_MAX_CONNECTIONS` connections (`HTTP_MAX_KEEPALIVE_CONNECTIONS`
+    of them kept alive between requests) instead of each opening its own.
+
+    Returns:
+        httpx.AsyncClient: The shared client.
+    """
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                limits = httpx.Limits(
+                    max_connections=settings.HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE_CONNECTIONS
+                )
+                _client = httpx.AsyncClient(transport=_LoopLocalTransport(limits))
+    return _client
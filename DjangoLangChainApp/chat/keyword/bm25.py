@@ -0,0 +1,198 @@
+from collections import OrderedDict, defaultdict
+from pathlib import Path
+import gzip
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+from django.conf import settings
+
+
+# Indexes loaded by `get_keyword_index`, most recently used last
+_lock = threading.Lock()
+_indexes = OrderedDict()
+
+_WORD = re.compile(r"\w+")
+# Codes, versions and other words joined by punctuation, e.g. "ISO-9001"
+_COMPOUND = re.compile(r"\w+(?:[-./:]\w+)+")
+
+
+def tokenize(text):
+    """
+    Split `text` into the lowercase terms it is indexed and searched by.
+
+    Besides single words, words joined by punctuation ("ISO-9001", "v1.2")
+    are kept as terms of their own, so exact codes rank above texts merely
+    containing their parts.
+
+    Returns:
+        list[str]: The terms of the text.
+    """
+    text = text.lower()
+    return _WORD.findall(text) + _COMPOUND.findall(text)
+
+
+class BM25Index:
+    """
+    Okapi BM25 inverted index over the chunks of a document.
+
+    Args:
+        ids (list[str]): Vector ID of each chunk.
+        texts (list[str]): Text of each chunk.
+        metadata (list[dict]): Metadata of each chunk, without the text.
+        k1 (float): Term frequency saturation.
+        b (float): Document length normalization.
+    """
+    def __init__(self, ids, texts, metadata, k1=1.5, b=0.75):
+        self.ids = list(ids)
+        self.texts = list(texts)
+        self.metadata = list(metadata)
+        self.k1 = k1
+        self.b = b
+
+        postings = defaultdict(lambda: ([], []))
+        lengths = []
+        for chunk, text in enumerate(self.texts):
+            terms = tokenize(text)
+            lengths.append(len(terms))
+            counts = defaultdict(int)
+            for term in terms:
+                counts[term] += 1
+            for term, count in counts.items():
+                postings[term][0].append(chunk)
+                postings[term][1].append(count)
+        self._set_postings(postings, lengths)
+
+    def _set_postings(self, postings, lengths):
+        import numpy as np
+
+        self.lengths = np.asarray(lengths, dtype=np.float32)
+        average = self.lengths.mean() if len(self.lengths) else 0
+        # Per chunk part of the BM25 denominator, k1 * (1 - b + b * |d| / avgdl)
+        self._norms = self.k1 * (1 - self.b + self.b * self.lengths / (average or 1))
+        self.postings = {
+            term: (np.asarray(chunks, dtype=np.int32), np.asarray(counts, dtype=np.float32))
+            for term, (chunks, counts) in postings.items()
+        }
+
+    def search(self, query, top_k):
+        """
+        Return the chunks scoring highest for `query`.
+
+        Args:
+            query (str): The search query.
+            top_k (int): Maximum number of chunks to return.
+
+        Returns:
+            list[tuple[int, float]]: Chunk numbers and their scores, best
+                first. Chunks sharing no term with the query are left out.
+        """
+        import numpy as np
+
+        count = len(self.ids)
+        scores = np.zeros(count, dtype=np.float32)
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            chunks, counts = self.postings[term]
+            idf = math.log((count - len(chunks) + 0.5) / (len(chunks) + 0.5) + 1)
+            scores[chunks] += idf * counts * (self.k1 + 1) / (counts + self._norms[chunks])
+
+        matching = np.flatnonzero(scores)
+        if not len(matching) or top_k <= 0:
+            return []
+        top = matching[np.argsort(-scores[matching], kind="stable")[:top_k]]
+        return [(int(chunk), float(scores[chunk])) for chunk in top]
+
+    def to_dict(self):
+        return {
+            "version": 1, "k1": self.k1, "b": self.b,
+            "ids": self.ids, "texts": self.texts, "metadata": self.metadata,
+            "lengths": self.lengths.astype(int).tolist(),
+            "postings": {term: [chunks.tolist(), counts.astype(int).tolist()]
+                         for term, (chunks, counts) in self.postings.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls.__new__(cls)
+        index.ids, index.texts, index.metadata = data["ids"], data["texts"], data["metadata"]
+        index.k1, index.b = data["k1"], data["b"]
+        index._set_postings(data["postings"], data["lengths"])
+        return index
+
+
+def _index_path(index_id):
+    return Path(settings.KEYWORD_INDEX_PATH) / f"{index_id}.json.gz"
+
+
+def save_keyword_index(index_id, index):
+    """
+    Store the keyword index of a document on disk.
+
+    The file is written under a temporary name and renamed into place, so
+    readers never see a partially written index.
+
+    Args:
+        index_id (uuid.UUID | str): ID of the document's index.
+        index (BM25Index): The index to store.
+    """
+    path = _index_path(index_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=path.parent, suffix=".tmp", delete=False) as file:
+        with gzip.open(file, "wt", encoding="utf-8") as gzip_file:
+            json.dump(index.to_dict(), gzip_file, separators=(",", ":"))
+    os.replace(file.name, path)
+
+
+def get_keyword_index(index_id):
+    """
+    Return the keyword index of a document, if it has one.
+
+    Loaded indexes are kept in an LRU of `KEYWORD_INDEX_CACHE_SIZE` entries.
+    The content of an index never changes, so cached entries are only
+    dropped by `delete_keyword_index`.
+
+    Args:
+        index_id (uuid.UUID | str): ID of the document's index.
+
+    Returns:
+        BM25Index | None: The index, None for documents indexed before
+            keyword indexes were built.
+    """
+    key = str(index_id)
+    with _lock:
+        index = _indexes.get(key)
+        if index is not None:
+            _indexes.move_to_end(key)
+            return index
+
+    try:
+        with gzip.open(_index_path(key), "rt", encoding="utf-8") as file:
+            index = BM25Index.from_dict(json.load(file))
+    except FileNotFoundError:
+        return None
+
+    with _lock:
+        _indexes[key] = index
+        while len(_indexes) > settings.KEYWORD_INDEX_CACHE_SIZE:
+            _indexes.popitem(last=False)
+    return index
+
+
+def delete_keyword_index(index_id):
+    """
+    Delete the keyword index of a document, if it has one.
+
+    Args:
+        index_id (uuid.UUID | str): ID of the document's index.
+    """
+    with _lock:
+        _indexes.pop(str(index_id), None)
+    try:
+        os.remove(_index_path(index_id))
+    except FileNotFoundError:
+        pass
+
@@ -0,0 +1,102 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+import asyncio
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from .bm25 import get_keyword_index
+
+
+# Runs the keyword search while the calling thread waits on the vector store
+_executor = ThreadPoolExecutor(thread_name_prefix="keyword-search")
+
+
+def reciprocal_rank_fusion(rankings, k=60, top_k=None):
+    """
+    Merge ranked lists of documents with Reciprocal Rank Fusion.
+
+    Every document scores the sum of 1 / (k + rank) over the lists it
+    appears in (ranks start at 1), so documents ranked high by several
+    retrievers come first. Documents are matched by their `vector_id`
+    metadata.
+
+    Args:
+        rankings (list[list[Document]]): The ranked lists, best first.
+        k (int): Damping constant, larger values flatten rank differences.
+        top_k (int, optional): Maximum number of documents to return.
+
+    Returns:
+        list[Document]: The fused ranking, with the score in the `rrf_score`
+            metadata.
+    """
+    scores, documents = {}, {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking, start=1):
+            key = document.metadata.get("vector_id", document.page_content)
+            scores[key] = scores.get(key, 0) + 1 / (k + rank)
+            documents.setdefault(key, document)
+
+    fused = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    results = []
+    for key in fused:
+        document = documents[key].copy()
+        document.metadata = {**document.metadata, "rrf_score": scores[key]}
+        results.append(document)
+    return results
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    LangChain retriever combining a dense and a keyword retriever.
+
+    Both retrievers are queried concurrently and their results are merged
+    with Reciprocal Rank Fusion, keeping the `k` best chunks.
+    """
+    dense: BaseRetriever
+    keyword: BaseRetriever
+    k: int = 4
+    rrf_k: int = 60
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        config = {"callbacks": run_manager.get_child()}
+        keyword = _executor.submit(self.keyword.invoke, query, config)
+        dense = self.dense.invoke(query, config)
+        return reciprocal_rank_fusion([dense, keyword.result()], self.rrf_k, self.k)
+
+    async def _aget_relevant_documents(self, query, *, run_manager):
+        config = {"callbacks": run_manager.get_child()}
+        dense, keyword = await asyncio.gather(
+            self.dense.ainvoke(query, config),
+            self.keyword.ainvoke(query, config)
+        )
+        return reciprocal_rank_fusion([dense, keyword], self.rrf_k, self.k)
+
+
+class KeywordRetriever(BaseRetriever):
+    """
+    LangChain retriever searching the keyword index of a document.
+
+    Documents without a keyword index return no results. The vector ID and
+    BM25 score are added to the document metadata. Given a list of index
+    IDs, every index is searched and the `k` best chunks overall are kept.
+    """
+    index_id: Any
+    k: int = 4
+
+    def _search(self, index_id, query):
+        index = get_keyword_index(index_id)
+        if index is None:
+            return []
+        return [
+            Document(page_content=index.texts[chunk],
+                     metadata={**index.metadata[chunk], "vector_id": index.ids[chunk],
+                               "score": score})
+            for chunk, score in index.search(query, self.k)
+        ]
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        if not isinstance(self.index_id, list):
+            return self._search(self.index_id, query)
+        documents = [document for index_id in self.index_id
+                     for document in self._search(index_id, query)]
+        documents.sort(key=lambda document: document.metadata["score"], reverse=True)
+        return documents[:self.k]
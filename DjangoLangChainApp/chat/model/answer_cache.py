@@ -0,0 +1,211 @@
+from collections import OrderedDict, namedtuple
+import re
+import threading
+import time
+import unicodedata
+from django.conf import settings
+from ..embeddings.embeddings import get_embeddings
+from ...admission import aslot
+from ...metrics import CACHE_REQUESTS
+
+
+# Created on first use by `get_answer_cache`
+_lock = threading.Lock()
+_cache = None
+
+# A cached reply: the answer text and the (0-based) pages it was based on
+CachedAnswer = namedtuple("CachedAnswer", ["answer", "pages"])
+
+_Entry = namedtuple("_Entry", ["answer", "embedding", "expires_at"])
+
+
+def normalize_question(question):
+    """
+    Return the form of `question` used as its exact cache key.
+
+    Case, Unicode compatibility forms, runs of whitespace and trailing
+    punctuation are ignored, so "What is this about?" and "what is this
+    about" share an entry.
+    """
+    question = unicodedata.normalize("NFKC", question).casefold()
+    return re.sub(r"\s+", " ", question).strip().rstrip("?!.").strip()
+
+
+class AnswerCache:
+    """
+    In-memory LRU cache of chat answers per indexed document.
+
+    Answers are looked up by the normalized question and, when a
+    `similarity_threshold` is set, by the cosine similarity of the
+    question's embedding to those of the cached questions of the same
+    document. Entries expire `ttl` seconds after being added and at most
+    `max_entries` are kept, evicting the least recently used ones.
+
+    Answers are keyed by the ID of the document's index, which is never
+    reused for other content: re-ingesting a page whose content changed
+    points the document at a new index, so stale answers are never served.
+
+    Args:
+        max_entries (int): Maximum number of cached answers.
+        ttl (float): Seconds an answer stays valid.
+        similarity_threshold (float, optional): Minimum cosine similarity of
+            a question to a cached one to reuse its answer. Only exact
+            matches are used when None.
+    """
+    def __init__(self, max_entries, ttl, similarity_threshold=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # (index_id, question) -> _Entry
+        self._documents = {}            # index_id -> keys of its entries
+
+    def get(self, index_id, question, embedding=None):
+        """
+        Return the cached answer to `question` about a document, if any.
+
+        Args:
+            index_id (uuid.UUID | str): ID of the document's index.
+            question (str): The question asked.
+            embedding (list[float], optional): Embedding of the question, to
+                fall back on a similarity lookup when there is no exact match.
+
+        Returns:
+            CachedAnswer | None: The cached answer.
+        """
+        key = (str(index_id), normalize_question(question))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= now:
+                self._remove(key)
+                entry = None
+
+            if entry is None and embedding is not None and self.similarity_threshold is not None:
+                key = self._most_similar(key[0], _unit(embedding), now)
+                entry = self._entries.get(key)
+
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry.answer
+
+    def _most_similar(self, index_id, embedding, now):
+        """Return the key of the closest question above the threshold, if any."""
+        keys = [key for key in self._documents.get(index_id, ())
+                if self._entries[key].embedding is not None]
+        for key in [key for key in keys if self._entries[key].expires_at <= now]:
+            self._remove(key)
+            keys.remove(key)
+        if not keys:
+            return None
+
+        import numpy as np
+        scores = np.stack([self._entries[key].embedding for key in keys]) @ embedding
+        best = int(np.argmax(scores))
+        return keys[best] if scores[best] >= self.similarity_threshold else None
+
+    def set(self, index_id, question, answer, embedding=None):
+        """
+        Cache the answer to `question` about a document.
+
+        Args:
+            index_id (uuid.UUID | str): ID of the document's index.
+            question (str): The question asked.
+            answer (CachedAnswer): The answer to cache.
+            embedding (list[float], optional): Embedding of the question, for
+                similarity lookups.
+        """
+        if self.max_entries <= 0:
+            return
+        key = (str(index_id), normalize_question(question))
+        entry = _Entry(answer,
+                       None if embedding is None else _unit(embedding),
+                       time.monotonic() + self.ttl)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._documents.setdefault(key[0], set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, index_id):
+        """
+        Drop every cached answer about a document.
+
+        Args:
+            index_id (uuid.UUID | str): ID of the document's index.
+        """
+        with self._lock:
+            for key in list(self._documents.get(str(index_id), ())):
+                self._remove(key)
+
+    def _remove(self, key):
+        del self._entries[key]
+        keys = self._documents[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._documents[key[0]]
+
+
+def _unit(vector):
+    import numpy as np
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / (np.linalg.norm(vector) or 1)
+
+
+def get_answer_cache():
+    """
+    Return the process-wide answer cache, creating it on first use.
+
+    Returns:
+        AnswerCache: The cache configured by the `ANSWER_CACHE_*` settings.
+    """
+    global _cache
+    if _cache is None:
+        with _lock:
+            if _cache is None:
+                _cache = AnswerCache(
+                    max_entries=settings.ANSWER_CACHE_SIZE,
+                    ttl=settings.ANSWER_CACHE_TTL,
+                    similarity_threshold=settings.ANSWER_CACHE_SIMILARITY_THRESHOLD
+                )
+    return _cache
+
+
+async def alookup_answer(index_id, question):
+    """
+    Look up the cached answer to `question` about a document.
+
+    Exact matches are answered without any request. Otherwise, if similarity
+    lookups are enabled, the question is embedded and compared to the
+    cached questions of the document.
+
+    Args:
+        index_id (uuid.UUID | str): ID of the document's index.
+        question (str): The question asked.
+
+    Returns:
+        tuple[CachedAnswer | None, list[float] | None]: The cached answer, if
+            any, and the question's embedding if it was computed, to be
+            passed on to `remember_answer`.
+    """
+    cache = get_answer_cache()
+    answer, embedding = cache.get(index_id, question), None
+    if answer is None and cache.similarity_threshold is not None and cache.max_entries > 0:
+        async with aslot("embedding"):
+            embedding = await get_embeddings().aembed_query(question)
+        answer = cache.get(index_id, question, embedding)
+    CACHE_REQUESTS.inc(cache="answer", result="miss" if answer is None else "hit")
+    return answer, embedding
+
+
+def remember_answer(index_id, question, answer, embedding=None):
+    """Cache `answer` to `question`, see `AnswerCache.set`."""
+    get_answer_cache().set(index_id, question, answer, embedding)
+
+
+def invalidate_answers(index_id):
+    """Drop the cached answers about a document, e.g. after it was deleted."""
+    if _cache is not None:
+        _cache.invalidate(index_id)
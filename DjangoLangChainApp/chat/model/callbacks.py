@@ -0,0 +1,126 @@
+import logging
+import time
+from langchain_core.callbacks import BaseCallbackHandler
+import tiktoken
+from ...metrics import CHAT_STAGE_SECONDS, TOKENS
+
+
+logger = logging.getLogger(__name__)
+
+# Tokens OpenAI chat models add around every message and to prime the reply
+_TOKENS_PER_MESSAGE = 3
+_TOKENS_PER_REPLY = 3
+
+
+def count_prompt_tokens(messages):
+    """
+    Return the number of input tokens of a chat model prompt.
+
+    Args:
+        messages (list[BaseMessage]): The messages of the prompt.
+
+    Returns:
+        int: The number of tokens, counted with the cl100k encoding.
+    """
+    encoding = tiktoken.get_encoding("cl100k_base")
+    return _TOKENS_PER_REPLY + sum(
+        _TOKENS_PER_MESSAGE + len(encoding.encode(str(message.content), disallowed_special=()))
+        for message in messages
+    )
+
+
+class PromptTokenLogger(BaseCallbackHandler):
+    """
+    Logs the number of input tokens of every chat model request.
+
+    Input and output tokens are also counted in the `TOKENS` metric.
+    Streamed replies come without token usage, so their output tokens are
+    counted with the cl100k encoding too.
+    """
+    run_inline = True
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        for prompt in messages:
+            tokens = count_prompt_tokens(prompt)
+            TOKENS.inc(tokens, kind="prompt")
+            logger.info("Chat model request with %d input tokens in %d messages",
+                        tokens, len(prompt))
+
+    def on_llm_end(self, response, **kwargs):
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        tokens = usage.get("completion_tokens")
+        if tokens is None:
+            encoding = tiktoken.get_encoding("cl100k_base")
+            tokens = sum(len(encoding.encode(generation.text, disallowed_special=()))
+                         for generations in response.generations
+                         for generation in generations)
+        TOKENS.inc(tokens, kind="completion")
+
+
+class StageTimer(BaseCallbackHandler):
+    """
+    Records the duration of the retrieval and model runs of a chat chain.
+
+    Observed in `CHAT_STAGE_SECONDS` as "retrieval", "first_token" (until the
+    model streams its first token) and "llm" (until its whole answer).
+    """
+    run_inline = True
+
+    def __init__(self):
+        self._started = {}   # run_id -> (stage, perf_counter at start)
+        self._retrievals = {}   # run_id -> the timed retriever run it's part of
+
+    def _start(self, run_id, stage):
+        self._started[run_id] = (stage, time.perf_counter())
+
+    def _end(self, run_id):
+        stage, started = self._started.pop(run_id, (None, None))
+        if stage is not None:
+            CHAT_STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
+
+    def _within_retrieval(self, run_id, parent_run_id):
+        """Record whether a run is nested, at any depth, in a timed retriever run."""
+        timed = self._retrievals.get(parent_run_id)
+        if timed is not None:
+            self._retrievals[run_id] = timed
+        return timed is not None
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+        self._within_retrieval(run_id, parent_run_id)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._retrievals.pop(run_id, None)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._retrievals.pop(run_id, None)
+
+    def on_retriever_start(self, serialized, query, *, run_id, parent_run_id=None, **kwargs):
+        # Only time the outermost retriever, e.g. `ContextPacker` and not the
+        # hybrid retriever it wraps, nor the dense and keyword ones of the latter
+        if not self._within_retrieval(run_id, parent_run_id):
+            self._retrievals[run_id] = run_id
+            self._start(run_id, "retrieval")
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self._retrievals.pop(run_id, None)
+        self._end(run_id)
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._retrievals.pop(run_id, None)
+        self._end(run_id)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._start(run_id, "llm")
+        # Keyed apart from the run, for its first token
+        self._start((run_id, "first_token"), "first_token")
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        self._end((run_id, "first_token"))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._started.pop((run_id, "first_token"), None)
+        self._end(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._started.pop((run_id, "first_token"), None)
+        self._end(run_id)
@@ -1,18 +1,188 @@
-from langchain_openai.chat_models import ChatOpenAI
-from langchain.chains.retrieval import create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
+from collections import OrderedDict
+import threading
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from DjangoLangChainProject.database import closing_old_connections
+from ..http_client import get_async_http_client
 from ..pinecone.vector_store import get_retriever
-from langchain import hub
+from ...metrics import CACHE_REQUESTS
 
 
-def build_chat(pdf_id):
-    retrieval_qa_chat_prompt = hub.pull("langchain-ai/retrieval-qa-chat")
-    llm = ChatOpenAI(streaming=True)
-    retriever = get_retriever(pdf_id)
+# Process-wide state shared by every request handled by this worker. LangChain
+# is imported on first use to keep it out of Django's start up.
+_lock = threading.Lock()
+_prompt = None
+_llm = None
+_chains = OrderedDict()
+
+
+def get_prompt():
+    """
+    Return the retrieval QA prompt, loading it at most once per process.
+
+    The vendored copy in `prompts.py` is used unless `CHAT_PROMPT_HUB_REF`
+    is set, in which case that (ideally commit-pinned) hub reference is
+    pulled on first use.
+
+    Returns:
+        ChatPromptTemplate: The prompt used to answer questions.
+    """
+    global _prompt
+    if _prompt is None:
+        with _lock:
+            if _prompt is None:
+                if settings.CHAT_PROMPT_HUB_REF:
+                    from langchain import hub
+                    _prompt = hub.pull(settings.CHAT_PROMPT_HUB_REF)
+                else:
+                    from .prompts import RETRIEVAL_QA_CHAT_PROMPT
+                    _prompt = RETRIEVAL_QA_CHAT_PROMPT
+    return _prompt
+
+
+def get_llm():
+    """
+    Return the chat model client shared by all chains in this process.
+
+    The number of input tokens of every request is logged, and the input
+    and output tokens are counted in the metrics.
+
+    Returns:
+        ChatOpenAI: The shared chat model.
+    """
+    global _llm
+    if _llm is None:
+        with _lock:
+            if _llm is None:
+                from langchain_openai.chat_models import ChatOpenAI
+                from .callbacks import PromptTokenLogger
+                _llm = ChatOpenAI(streaming=True, http_async_client=get_async_http_client(),
+                                  callbacks=[PromptTokenLogger()])
+    return _llm
+
+
+async def asummarize(summary, lines, max_tokens):
+    """
+    Fold lines of a conversation into its rolling summary.
+
+    Args:
+        summary (str): The summary of the conversation so far, may be empty.
+        lines (list[str]): The lines to add, e.g. "User: ..." and "AI: ...".
+        max_tokens (int): Maximum number of tokens of the new summary.
+
+    Returns:
+        str: The new summary.
+    """
+    from .prompts import CONVERSATION_SUMMARY_PROMPT
+
+    chain = CONVERSATION_SUMMARY_PROMPT | get_llm().bind(max_tokens=max_tokens)
+    reply = await chain.ainvoke({"summary": summary or "(none)", "lines": "\n".join(lines)})
+    return reply.content.strip()
+
+
+def _create_chain(pdf_id):
+    from langchain.chains.retrieval import create_retrieval_chain
+    from langchain.chains.combine_documents import create_stuff_documents_chain
+    from .callbacks import StageTimer
+    from .packing import ContextPacker
+
+    retriever = ContextPacker(
+        retriever=get_retriever(pdf_id),
+        k=settings.RETRIEVAL_K,
+        max_tokens=settings.CHAT_CONTEXT_MAX_TOKENS,
+        mmr_lambda=settings.RETRIEVAL_MMR_LAMBDA,
+        duplicate_threshold=settings.RETRIEVAL_DUPLICATE_THRESHOLD
+    )
     combine_docs_chain = create_stuff_documents_chain(
-        llm, retrieval_qa_chat_prompt
+        get_llm(), get_prompt()
     )
-    return create_retrieval_chain(retriever, combine_docs_chain)
+    chain = create_retrieval_chain(retriever, combine_docs_chain)
+    return chain.with_config(callbacks=[StageTimer()])
+
+
+def _chain_key(pdf_id):
+    """Key of the cached chain of a document, or of a set of documents."""
+    if isinstance(pdf_id, (set, frozenset)):
+        key = frozenset(str(index_id) for index_id in pdf_id)
+        # A single document shares the chain of chatting with it alone
+        return next(iter(key)) if len(key) == 1 else key
+    return str(pdf_id)
+
+
+def build_chat(pdf_id):
+    """
+    Return the retrieval chain for a document, or for several documents.
+
+    Chains are kept in a bounded LRU (`CHAT_CHAIN_CACHE_SIZE` entries) keyed
+    by `pdf_id`, so repeated questions about the same document reuse the
+    retriever and chain instead of rebuilding them. Chains of several
+    documents are keyed by the frozenset of their IDs, so the same selection
+    in any order shares a chain.
+
+    Args:
+        pdf_id (uuid.UUID | frozenset): The ID of the document to chat with,
+            or the IDs of the documents answered from together.
+
+    Returns:
+        Runnable: The retrieval chain for the document(s).
+    """
+    key = _chain_key(pdf_id)
+    with _lock:
+        chain = _chains.get(key)
+        if chain is not None:
+            _chains.move_to_end(key)
+    CACHE_REQUESTS.inc(cache="chat_chain", result="miss" if chain is None else "hit")
+    if chain is not None:
+        return chain
+
+    chain = _create_chain(key)
+
+    with _lock:
+        # Another thread may have built the same chain in the meantime
+        chain = _chains.setdefault(key, chain)
+        _chains.move_to_end(key)
+        while len(_chains) > settings.CHAT_CHAIN_CACHE_SIZE:
+            _chains.popitem(last=False)
+    return chain
+
+
+async def abuild_chat(pdf_id):
+    """
+    Async version of `build_chat`.
+
+    Cached chains are returned directly, new ones are built on a worker
+    thread so the event loop isn't blocked while the SDK clients are set up.
+
+    Args:
+        pdf_id (uuid.UUID | frozenset): The ID of the document to chat with,
+            or the IDs of the documents answered from together.
+
+    Returns:
+        Runnable: The retrieval chain for the document(s).
+    """
+    key = _chain_key(pdf_id)
+    with _lock:
+        chain = _chains.get(key)
+        if chain is not None:
+            _chains.move_to_end(key)
+    if chain is not None:
+        CACHE_REQUESTS.inc(cache="chat_chain", result="hit")
+        return chain
+    return await sync_to_async(closing_old_connections(build_chat),
+                               thread_sensitive=False)(pdf_id)
+
+
+def invalidate_chat(pdf_id):
+    """
+    Drop the cached chains of a document, e.g. after it has been deleted.
+
+    Chains of several documents including it are dropped too.
 
-    
-    
+    Args:
+        pdf_id (uuid.UUID): The ID of the document.
+    """
+    key = str(pdf_id)
+    with _lock:
+        for cached in [cached for cached in _chains
+                       if cached == key or isinstance(cached, frozenset) and key in cached]:
+            del _chains[cached]
@@ -0,0 +1,114 @@
+import logging
+import re
+from langchain_core.retrievers import BaseRetriever
+import tiktoken
+
+
+logger = logging.getLogger(__name__)
+
+_WORD = re.compile(r"\w+")
+
+# Tokens `create_stuff_documents_chain` puts between two documents ("\n\n")
+_SEPARATOR_TOKENS = 1
+
+
+def _shingles(text, size=3):
+    """Return the set of `size` word sequences of `text`."""
+    words = _WORD.findall(text.lower())
+    if len(words) <= size:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def _similarity(a, b):
+    """Jaccard similarity of two shingle sets."""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class ContextPacker(BaseRetriever):
+    """
+    LangChain retriever selecting which retrieved chunks go into the prompt.
+
+    The chunks returned by the wrapped retriever, best first, are packed in
+    three steps:
+
+    1. Near duplicates of better ranked chunks (word 3-gram Jaccard
+       similarity of at least `duplicate_threshold`) are dropped.
+    2. The rest is reordered with Maximal Marginal Relevance, trading the
+       retrieval rank for dissimilarity to the chunks already selected
+       (`mmr_lambda` of 1 keeps the retrieval order).
+    3. Chunks are added in that order while they fit in `max_tokens`
+       (cl100k tokens, separators included), up to `k` chunks. If not even
+       the best chunk fits, it is truncated to the budget.
+    """
+    retriever: BaseRetriever
+    k: int = 4
+    max_tokens: int = 3000
+    mmr_lambda: float = 0.7
+    duplicate_threshold: float = 0.85
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        docs = self.retriever.invoke(query, {"callbacks": run_manager.get_child()})
+        return self.pack(docs)
+
+    async def _aget_relevant_documents(self, query, *, run_manager):
+        docs = await self.retriever.ainvoke(query, {"callbacks": run_manager.get_child()})
+        return self.pack(docs)
+
+    def pack(self, docs):
+        """
+        Select the chunks of `docs` to put in the prompt.
+
+        Args:
+            docs (list[Document]): The retrieved chunks, best first.
+
+        Returns:
+            list[Document]: The selected chunks, most relevant first.
+        """
+        shingles = [_shingles(doc.page_content) for doc in docs]
+
+        candidates = []
+        for i in range(len(docs)):
+            if all(_similarity(shingles[i], shingles[j]) < self.duplicate_threshold
+                   for j in candidates):
+                candidates.append(i)
+        duplicates = len(docs) - len(candidates)
+
+        # Relevance of the retrieval rank, from 1 for the best chunk down
+        relevance = {i: 1 - rank / len(candidates) for rank, i in enumerate(candidates)}
+        selected, ordered = [], []
+        while candidates:
+            best = max(candidates, key=lambda i: (
+                self.mmr_lambda * relevance[i]
+                - (1 - self.mmr_lambda) * max(
+                    (_similarity(shingles[i], shingles[j]) for j in ordered), default=0
+                )
+            ))
+            candidates.remove(best)
+            ordered.append(best)
+
+        encoding = tiktoken.get_encoding("cl100k_base")
+        used = 0
+        for i in ordered:
+            if len(selected) == self.k:
+                break
+            tokens = len(encoding.encode(docs[i].page_content, disallowed_special=()))
+            cost = tokens + (_SEPARATOR_TOKENS if selected else 0)
+            if used + cost <= self.max_tokens:
+                selected.append(docs[i])
+                used += cost
+
+        if not selected and ordered:
+            best = docs[ordered[0]]
+            tokens = encoding.encode(best.page_content, disallowed_special=())
+            truncated = best.copy()
+            truncated.page_content = encoding.decode(tokens[:self.max_tokens])
+            selected.append(truncated)
+            used = min(len(tokens), self.max_tokens)
+
+        logger.info("Packed %d of %d retrieved chunks (%d near duplicates) "
+                    "into %d/%d context tokens",
+                    len(selected), len(docs), duplicates, used, self.max_tokens)
+        return selected
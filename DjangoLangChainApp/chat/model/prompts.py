@@ -0,0 +1,30 @@
+from langchain_core.prompts import (
+    ChatPromptTemplate,
+    HumanMessagePromptTemplate,
+    MessagesPlaceholder,
+    SystemMessagePromptTemplate,
+)
+
+# Vendored copy of the "langchain-ai/retrieval-qa-chat" LangChain Hub prompt,
+# pinned so that building a chat never needs a network round trip to the hub.
+RETRIEVAL_QA_CHAT_PROMPT = ChatPromptTemplate.from_messages([
+    SystemMessagePromptTemplate.from_template(
+        "Answer any use questions based solely on the context below:\n\n"
+        "<context>\n{context}\n</context>"
+    ),
+    MessagesPlaceholder(variable_name="chat_history", optional=True),
+    HumanMessagePromptTemplate.from_template("{input}"),
+])
+
+# Prompt folding older turns of a conversation into its rolling summary
+CONVERSATION_SUMMARY_PROMPT = ChatPromptTemplate.from_messages([
+    SystemMessagePromptTemplate.from_template(
+        "Progressively summarize the conversation between a user and an AI "
+        "assistant about a document. Extend the previous summary with the new "
+        "lines and reply with the new summary only. Keep the facts, names, "
+        "numbers and open questions needed to follow up on the conversation."
+    ),
+    HumanMessagePromptTemplate.from_template(
+        "Previous summary:\n{summary}\n\nNew lines of conversation:\n{lines}"
+    ),
+])
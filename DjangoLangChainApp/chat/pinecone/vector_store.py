@@ -1,36 +1,500 @@
-from pinecone import Pinecone
-from langchain_pinecone import PineconeVectorStore
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders.pdf import PyPDFLoader
-from ..embeddings.embeddings import openai_embeddings
-import os
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from ..backends.base import VectorStoreError
+from ..embeddings.embeddings import get_embeddings
+from ...admission import slot
+from ...metrics import DOCUMENT_CHUNKS, INGESTION_STAGE_SECONDS
+import tiktoken
 
 
-pinecone = Pinecone(api_key=os.environ["PINECONE_API_KEY"])
-pinecone_index = pinecone.Index(os.environ["PINECONE_INDEX"])
-vector_store = PineconeVectorStore(index=pinecone_index, embedding=openai_embeddings)
+logger = logging.getLogger(__name__)
 
-def add_documents_from_pdf(pdf_path, pdf_id):
-    docs = PyPDFLoader(pdf_path).load_and_split(
-        RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-            chunk_size=1000,
-            chunk_overlap=0,
-        )
+# The vector backend (and the SDK it uses) is created on first use, so that
+# importing this module (and thus starting Django) needs neither the SDKs
+# nor the API keys.
+_lock = threading.Lock()
+_backend = None
+
+# Timing of a single embedding or upsert request made by `upsert_documents`
+BatchTiming = namedtuple("BatchTiming", ["stage", "batch", "size", "seconds"])
+
+
+def get_backend():
+    """
+    Return the process-wide vector backend, creating it on first use.
+
+    The backend is selected by the `VECTOR_STORE_BACKEND` setting: "pinecone"
+    for the Pinecone index named by `PINECONE_INDEX`, or "local" for the
+    on-disk store in `LOCAL_VECTOR_STORE_PATH`.
+
+    Returns:
+        VectorBackend: The backend documents are indexed in.
+    """
+    global _backend
+    if _backend is None:
+        with _lock:
+            if _backend is None:
+                if settings.VECTOR_STORE_BACKEND == "pinecone":
+                    from ..backends.pinecone import PineconeBackend
+                    _backend = PineconeBackend.from_environment()
+                elif settings.VECTOR_STORE_BACKEND == "local":
+                    from ..backends.local import LocalBackend
+                    _backend = LocalBackend(settings.LOCAL_VECTOR_STORE_PATH)
+                else:
+                    raise ImproperlyConfigured(
+                        f"Unknown VECTOR_STORE_BACKEND: {settings.VECTOR_STORE_BACKEND}"
+                    )
+    return _backend
+
+
+def delete_vectors(ids, index=None):
+    """
+    Delete vectors from the index.
+
+    IDs are deleted `VECTOR_DELETE_BATCH_SIZE` at a time, Pinecone's limit
+    per request, retrying rate limited and failed requests with backoff.
+
+    Args:
+        ids (list[str]): The IDs of the vectors to delete.
+        index (VectorBackend, optional): Backend to delete from, defaults
+            to the configured vector backend.
+
+    Raises:
+        VectorStoreError: If the backend fails to delete the vectors.
+    """
+    backend = index or get_backend()
+    size = settings.VECTOR_DELETE_BATCH_SIZE
+    for start in range(0, len(ids), size):
+        _with_backoff(backend.delete, ids=ids[start:start + size])
+
+
+def delete_document_vectors(pdf_id):
+    """
+    Delete every vector of a document by its `pdf_id` metadata.
+
+    This takes a single request whatever the number of vectors, but
+    Pinecone only supports it on pod-based indexes.
+
+    Args:
+        pdf_id (uuid.UUID | str): The ID the vectors are stored under.
+
+    Raises:
+        VectorStoreError: If the backend fails to delete the vectors.
+    """
+    _with_backoff(get_backend().delete_by_pdf_id, pdf_id)
+
+
+def iter_pdf_pages(pdf_path):
+    """
+    Yield the pages of a PDF one at a time.
+
+    Unlike `PyPDFLoader`, whose loading and parsing both build the list of
+    all pages first, only the page being extracted is held in memory: the
+    file is read as needed rather than loaded whole, and the content
+    streams of a page are dropped from pypdf's object cache once its text
+    has been extracted.
+
+    Args:
+        pdf_path (str): Path of the PDF file.
+
+    Yields:
+        Document: The text of each page, with its number in the metadata.
+    """
+    from langchain_core.documents import Document
+    import pypdf
+    from pypdf.generic import ArrayObject, IndirectObject
+
+    with open(pdf_path, "rb") as file:
+        reader = pypdf.PdfReader(file)
+        for number, page in enumerate(reader.pages):
+            text = page.extract_text()
+
+            contents = page.raw_get("/Contents") if "/Contents" in page else None
+            references = [contents]
+            if isinstance(contents, IndirectObject) and isinstance(contents.get_object(),
+                                                                   ArrayObject):
+                references += list(contents.get_object())
+            elif isinstance(contents, ArrayObject):
+                references = list(contents)
+            for reference in references:
+                if isinstance(reference, IndirectObject):
+                    reader.resolved_objects.pop((reference.generation, reference.idnum), None)
+
+            yield Document(page_content=text, metadata={"page": number})
+
+
+def iter_chunks(pages, pdf_id):
+    """
+    Yield the chunks of a document, splitting each page as it is read.
+
+    Args:
+        pages (Iterable[Document]): The pages of the document, with their
+            number in the "page" metadata if they have one.
+        pdf_id (uuid.UUID): The ID of the document's index.
+
+    Yields:
+        Document: The chunks, with the metadata stored in the index: their
+            `pdf_id` and page, if any. Their text is stored as `Chunk` rows.
+    """
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        chunk_size=1000,
+        chunk_overlap=0,
     )
-    for doc in docs:
-        doc.metadata = {
-            "page": doc.metadata["page"],
-            "text": doc.page_content,
-            "pdf_id": pdf_id.__str__()  # need to convert UUID to string
-        }
-    return vector_store.add_documents(docs)
+    for page in pages:
+        for doc in splitter.split_documents([page]):
+            page_number = doc.metadata.get("page")
+            doc.metadata = {
+                "pdf_id": pdf_id.__str__()  # need to convert UUID to string
+            }
+            # Web pages indexed from their HTML have none, see `paginate`
+            if page_number is not None:
+                doc.metadata["page"] = page_number
+            yield doc
+
+
+def add_documents(pages, pdf_id):
+    """
+    Index the chunks of a document in the vector store and the keyword index.
+
+    Pages are split, embedded and upserted as a stream, so the pages and
+    vectors held in memory are bounded by the batch sizes rather than by the
+    size of the document. Only the text of the chunks is kept until the
+    end, to build the keyword index and store them as `Chunk` rows.
+
+    Args:
+        pages (Iterable[Document]): The pages of the document, with their
+            number in the "page" metadata if they have one.
+        pdf_id (uuid.UUID): The ID of the document's index.
+
+    Returns:
+        list[str]: The vector IDs of the chunks, in order.
+    """
+    return add_documents_batch([(pages, pdf_id)])[0]
+
+
+def add_documents_batch(documents):
+    """
+    Index the chunks of several documents like `add_documents`.
+
+    The chunks of all documents are embedded and upserted as one stream, so
+    the requests of small documents are filled with the chunks of the next
+    ones. Either all documents are indexed or, if anything fails, none.
+
+    Args:
+        documents (list[tuple[Iterable[Document], uuid.UUID]]): The pages
+            and index ID of each document.
+
+    Returns:
+        list[list[str]]: The vector IDs of the chunks of each document.
+    """
+    from ..keyword.bm25 import BM25Index, delete_keyword_index, save_keyword_index
+
+    chunks = [([], []) for _ in documents]
+    parsing = 0.0
+
+    def stream():
+        nonlocal parsing
+        for (pages, pdf_id), (texts, metadata) in zip(documents, chunks):
+            docs = iter_chunks(pages, pdf_id)
+            while True:
+                # Time reading and splitting the pages, not the embedding
+                # that runs between the chunks
+                started = time.perf_counter()
+                doc = next(docs, None)
+                parsing += time.perf_counter() - started
+                if doc is None:
+                    break
+                texts.append(doc.page_content)
+                metadata.append(doc.metadata)
+                yield doc
+
+    ids = upsert_documents(stream())
+    INGESTION_STAGE_SECONDS.observe(parsing, stage="parse")
+
+    # Keyword index of the same chunks, for hybrid retrieval
+    id_lists, saved, start = [], [], 0
+    try:
+        with INGESTION_STAGE_SECONDS.time(stage="keyword_index"):
+            for (_, pdf_id), (texts, metadata) in zip(documents, chunks):
+                id_lists.append(ids[start:start + len(texts)])
+                start += len(texts)
+                save_keyword_index(pdf_id, BM25Index(id_lists[-1], texts, metadata))
+                saved.append(pdf_id)
+        with INGESTION_STAGE_SECONDS.time(stage="store_chunks"):
+            _save_chunks([pdf_id for _, pdf_id in documents], chunks, id_lists)
+    except Exception:
+        delete_vectors(ids)
+        for pdf_id in saved:
+            delete_keyword_index(pdf_id)
+        raise
+
+    for texts, _ in chunks:
+        DOCUMENT_CHUNKS.observe(len(texts))
+    return id_lists
+
+
+def _save_chunks(index_ids, chunks, id_lists):
+    """Store the text of the chunks of `add_documents_batch` as `Chunk` rows."""
+    from django.db import transaction
+    from ...models import Chunk
+
+    encoding = tiktoken.get_encoding("cl100k_base")
+    rows = [
+        Chunk(index_id=index_id, ordinal=ordinal, page=data.get("page"), vector_id=vector_id,
+              text=text, text_hash=hashlib.sha256(text.encode()).hexdigest(),
+              token_count=len(encoding.encode(text, disallowed_special=())))
+        for index_id, (texts, metadata), ids in zip(index_ids, chunks, id_lists)
+        for ordinal, (text, data, vector_id) in enumerate(zip(texts, metadata, ids))
+    ]
+    with transaction.atomic():
+        Chunk.objects.bulk_create(rows, batch_size=settings.INGESTION_BULK_BATCH_SIZE)
+
+
+def chunk_texts(vector_ids):
+    """
+    Look up the text of chunks in a single query.
+
+    Args:
+        vector_ids (list[str]): The vector IDs of the chunks.
+
+    Returns:
+        dict[str, str]: The text of each chunk found, by vector ID.
+    """
+    from ...models import Chunk
+    return dict(Chunk.objects.filter(vector_id__in=vector_ids).values_list("vector_id", "text"))
+
+
+def add_documents_from_pdf(pdf_path, pdf_id):
+    """
+    Index the chunks of a PDF file, reading it page by page.
+
+    Args:
+        pdf_path (str): Path of the PDF file.
+        pdf_id (uuid.UUID): The ID of the document's index.
+
+    Returns:
+        list[str]: The vector IDs of the chunks, in order.
+    """
+    return add_documents(iter_pdf_pages(pdf_path), pdf_id)
+
 
 def get_retriever(pdf_id):
-    return vector_store.as_retriever(
-        search_kwargs = {
-            "filter": {"pdf_id": pdf_id.__str__()}
-        }
+    """
+    Return the retriever searching the chunks of a document, or of several.
+
+    With `HYBRID_RETRIEVAL` enabled, the `RETRIEVAL_CANDIDATES` best chunks
+    of a vector search and of a BM25 keyword search are fused with
+    Reciprocal Rank Fusion (`RRF_K`), otherwise only the vector search is
+    used. Either way the `RETRIEVAL_CANDIDATES` best chunks are returned,
+    for `ContextPacker` to select the ones sent to the model.
+
+    Several documents are searched with a single vector query filtered with
+    `$in` (Pinecone accepts up to 10,000 values). Their keyword indexes are
+    searched too as long as they fit in `KEYWORD_INDEX_CACHE_SIZE`, larger
+    sets are only searched by vector rather than loading every index from
+    disk for each question.
+
+    Args:
+        pdf_id (uuid.UUID | frozenset): The ID of the document's index, or
+            the IDs of the indexes to search together.
+
+    Returns:
+        BaseRetriever: The retriever.
+    """
+    from ..backends.retriever import VectorBackendRetriever
+    from ..keyword.retriever import HybridRetriever, KeywordRetriever
+
+    if isinstance(pdf_id, (set, frozenset)):
+        index_ids = sorted(str(index_id) for index_id in pdf_id)
+        filter = {"pdf_id": {"$in": index_ids}}
+    else:
+        index_ids = [pdf_id.__str__()]
+        filter = {"pdf_id": index_ids[0]}
+
+    dense = VectorBackendRetriever(
+        backend=get_backend(),
+        embeddings=get_embeddings(),
+        texts=chunk_texts,
+        filter=filter,
+        k=settings.RETRIEVAL_CANDIDATES
     )
+    if not settings.HYBRID_RETRIEVAL or len(index_ids) > settings.KEYWORD_INDEX_CACHE_SIZE:
+        return dense
+
+    return HybridRetriever(
+        dense=dense,
+        keyword=KeywordRetriever(index_id=index_ids[0] if len(index_ids) == 1 else index_ids,
+                                 k=settings.RETRIEVAL_CANDIDATES),
+        k=settings.RETRIEVAL_CANDIDATES,
+        rrf_k=settings.RRF_K
+    )
+
+
+def upsert_documents(docs, embeddings=None, index=None, on_batch=None):
+    """
+    Embed `docs` and upsert them into the index in batches.
+
+    Documents are embedded in requests of at most `EMBEDDING_BATCH_SIZE`
+    documents and `EMBEDDING_MAX_TOKENS_PER_REQUEST` tokens, on a worker
+    thread so the next batch is read from `docs` meanwhile. Each embedded
+    batch is upserted in requests of `UPSERT_BATCH_SIZE` vectors on a pool
+    of `UPSERT_CONCURRENCY` threads, so upserts overlap with the embedding
+    of the following batches. Each embedding request holds one of the
+    admission slots of requests calling OpenAI (see `admission.acquire_slot`),
+    so ingestion and chats share the cap.
+
+    `docs` may be a generator: it is consumed one batch ahead of the
+    embedding, and reading waits once twice `UPSERT_CONCURRENCY` upserts
+    are pending, so the memory used doesn't grow with the number of
+    documents.
+
+    Args:
+        docs (Iterable[Document]): The documents to add.
+        embeddings (Embeddings, optional): Embedding model, defaults to the
+            OpenAI embeddings.
+        index (VectorBackend, optional): Backend to upsert into, defaults to
+            the configured vector backend.
+        on_batch (callable, optional): Called with a `BatchTiming` after
+            every embedding and upsert request.
+
+    Returns:
+        list[str]: The vector IDs of the added documents, in order.
+    """
+    embeddings = embeddings or get_embeddings()
+    index = index or get_backend()
+    ids = []
+    upserts = deque()
+    upsert_count = 0
+
+    def report(stage, batch, size, started):
+        timing = BatchTiming(stage, batch, size, time.perf_counter() - started)
+        logger.debug("%s batch %d: %d item(s) in %.3fs", *timing)
+        INGESTION_STAGE_SECONDS.observe(timing.seconds, stage=stage)
+        if on_batch:
+            on_batch(timing)
+
+    def embed(batch, docs_batch):
+        started = time.perf_counter()
+        with slot("embedding"):
+            values = _with_backoff(embeddings.embed_documents,
+                                   [doc.page_content for doc in docs_batch])
+        report("embedding", batch, len(docs_batch), started)
+        return values
+
+    def upsert(batch, vectors):
+        started = time.perf_counter()
+        _with_backoff(index.upsert, vectors=vectors)
+        report("upsert", batch, len(vectors), started)
+
+    def queue_upserts(docs_batch, embedding):
+        nonlocal upsert_count
+        vectors = []
+        for doc, vector in zip(docs_batch, embedding.result()):
+            vector_id = str(uuid.uuid4())
+            ids.append(vector_id)
+            vectors.append({"id": vector_id, "values": vector,
+                            "metadata": doc.metadata})
+
+        size = settings.UPSERT_BATCH_SIZE
+        for start in range(0, len(vectors), size):
+            upserts.append(executor.submit(upsert, upsert_count, vectors[start:start + size]))
+            upsert_count += 1
+            # Backpressure: wait for the oldest upserts instead of piling up vectors
+            while len(upserts) > 2 * settings.UPSERT_CONCURRENCY:
+                upserts.popleft().result()
+
+    try:
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding") as embedder, \
+                ThreadPoolExecutor(max_workers=settings.UPSERT_CONCURRENCY,
+                                   thread_name_prefix="upsert") as executor:
+            pending = None
+            for batch, docs_batch in enumerate(_embedding_batches(docs)):
+                # This batch was read while the previous one was being embedded
+                if pending:
+                    queue_upserts(*pending)
+                pending = (docs_batch, embedder.submit(embed, batch, docs_batch))
+            if pending:
+                queue_upserts(*pending)
+
+            # Surface the first failed upsert, if any
+            while upserts:
+                upserts.popleft().result()
+
+    except Exception:
+        # Don't leave the vectors of a partially added document behind,
+        # without hiding why it failed
+        if ids:
+            try:
+                delete_vectors(ids, index=index)
+            except Exception:
+                logger.exception("Failed to remove %d partially added vector(s)", len(ids))
+        raise
+
+    return ids
+
+
+def _embedding_batches(docs):
+    """Group `docs` into embedding requests within the size and token limits."""
+    encoding = tiktoken.get_encoding("cl100k_base")
+    max_docs = settings.EMBEDDING_BATCH_SIZE
+    max_tokens = settings.EMBEDDING_MAX_TOKENS_PER_REQUEST
+
+    batch, batch_tokens = [], 0
+    for doc in docs:
+        tokens = len(encoding.encode(doc.page_content, disallowed_special=()))
+        if batch and (len(batch) >= max_docs or batch_tokens + tokens > max_tokens):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(doc)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+def _retry_delay(error, attempt):
+    """
+    Return how long to wait before retrying a request that raised `error`.
+
+    Rate limited (429) and server error (5xx) responses are retried, waiting
+    for the `Retry-After` header when the response has one and backing off
+    exponentially otherwise. Any other error is not retried.
+
+    Returns:
+        float | None: Seconds to wait, or None if the request should not be
+            retried.
+    """
+    # OpenAI errors carry `status_code`/`response`, Pinecone ones `status`/`headers`
+    status = getattr(error, "status_code", None) or getattr(error, "status", None)
+    if status != 429 and not (isinstance(status, int) and status >= 500):
+        return None
 
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or getattr(error, "headers", None) or {}
+    retry_after = headers.get("Retry-After")
+    try:
+        return min(float(retry_after), settings.VECTOR_STORE_RETRY_MAX_DELAY)
+    except (TypeError, ValueError):
+        delay = settings.VECTOR_STORE_RETRY_BASE_DELAY * 2 ** attempt
+        return min(delay, settings.VECTOR_STORE_RETRY_MAX_DELAY)
 
 
+def _with_backoff(func, *args, **kwargs):
+    """Call `func`, retrying rate limited and failed requests with backoff."""
+    for attempt in range(settings.VECTOR_STORE_MAX_RETRIES + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            delay = _retry_delay(e, attempt)
+            if delay is None or attempt == settings.VECTOR_STORE_MAX_RETRIES:
+                raise
+            logger.warning("Request failed (%s), retrying in %.1fs", e, delay)
+            time.sleep(delay)
@@ -0,0 +1,162 @@
+import logging
+from django.conf import settings
+from django.utils import timezone
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+import tiktoken
+from .models import Conversation, Message
+from .chat.model.chat import asummarize
+
+
+logger = logging.getLogger(__name__)
+
+
+def count_tokens(text):
+    """Return the number of tokens of `text` for the chat and embedding models."""
+    return len(tiktoken.get_encoding("cl100k_base").encode(text, disallowed_special=()))
+
+
+async def aload_conversation(user, pdf):
+    """
+    Return the user's conversation about a document, creating it if needed.
+
+    The messages not folded into the summary yet are loaded into the
+    `recent` attribute of the conversation. Loading takes the same number of
+    queries however long the conversation is.
+
+    Args:
+        user (django.contrib.auth.models.User): The user chatting.
+        pdf (PdfFile): The document the conversation is about.
+
+    Returns:
+        Conversation: The conversation.
+    """
+    conversation, _ = await Conversation.objects.aget_or_create(user=user, pdf=pdf)
+    conversation.user, conversation.pdf = user, pdf
+    conversation.recent = [
+        message async for message in conversation.messages
+        .filter(pk__gt=conversation.summarized_until).order_by("pk")
+    ]
+    return conversation
+
+
+def chat_history(conversation):
+    """
+    Return the history to send to the model with the next question.
+
+    The summary comes first, followed by as many of the most recent
+    messages as fit in `CHAT_HISTORY_MAX_TOKENS` tokens.
+
+    Args:
+        conversation (Conversation): A conversation returned by
+            `aload_conversation`.
+
+    Returns:
+        list[BaseMessage]: The history, oldest message first.
+    """
+    budget = settings.CHAT_HISTORY_MAX_TOKENS
+    history = []
+    if conversation.summary:
+        budget -= conversation.summary_tokens
+        history.append(SystemMessage(
+            f"Summary of the earlier conversation:\n{conversation.summary}"
+        ))
+
+    recent = conversation.recent
+    start = len(recent)
+    while start > 0 and recent[start - 1].token_count <= budget:
+        start -= 1
+        budget -= recent[start].token_count
+    # Don't start with an answer whose question didn't fit
+    if start < len(recent) and recent[start].role == Message.Role.AI:
+        start += 1
+
+    for message in recent[start:]:
+        if message.role == Message.Role.USER:
+            history.append(HumanMessage(message.content))
+        else:
+            history.append(AIMessage(message.content))
+    return history
+
+
+async def arecord_turn(conversation, question, answer):
+    """
+    Store a question and its answer in the conversation.
+
+    Args:
+        conversation (Conversation): A conversation returned by
+            `aload_conversation`.
+        question (str): The user's question.
+        answer (str): The model's answer.
+    """
+    messages = await Message.objects.abulk_create([
+        Message(conversation=conversation, role=Message.Role.USER,
+                content=question, token_count=count_tokens(question)),
+        Message(conversation=conversation, role=Message.Role.AI,
+                content=answer, token_count=count_tokens(answer)),
+    ])
+    conversation.recent.extend(messages)
+
+
+async def acompact(conversation):
+    """
+    Fold the oldest turns into the summary once the recent ones grow too long.
+
+    Recent messages may take `CHAT_HISTORY_MAX_TOKENS` minus
+    `CHAT_SUMMARY_MAX_TOKENS` tokens. When they take more, the oldest turns
+    are summarized until the remaining ones take at most half of that, so
+    the summary isn't rewritten after every turn. Messages are kept in the
+    database, they are only left out of the history.
+
+    Compaction is best effort: if summarizing fails, the error is logged and
+    `chat_history` keeps the history within budget by leaving out the
+    oldest messages until the next attempt after the following turn.
+
+    Args:
+        conversation (Conversation): A conversation returned by
+            `aload_conversation`.
+
+    Returns:
+        bool: Whether the conversation was compacted.
+    """
+    limit = settings.CHAT_HISTORY_MAX_TOKENS - settings.CHAT_SUMMARY_MAX_TOKENS
+    recent = conversation.recent
+    if sum(message.token_count for message in recent) <= limit:
+        return False
+
+    # Keep whole turns (a question and its answer) of at most half the limit
+    keep, kept_tokens = len(recent), 0
+    while keep >= 2:
+        turn_tokens = recent[keep - 2].token_count + recent[keep - 1].token_count
+        if kept_tokens + turn_tokens > limit // 2:
+            break
+        keep -= 2
+        kept_tokens += turn_tokens
+    folded = recent[:keep]
+    if not folded:
+        return False
+
+    try:
+        summary = await asummarize(
+            conversation.summary,
+            [f"{message.get_role_display()}: {message.content}" for message in folded],
+            max_tokens=settings.CHAT_SUMMARY_MAX_TOKENS
+        )
+    except Exception:
+        logger.exception("Failed to summarize conversation %s", conversation.pk)
+        return False
+    summary_tokens = count_tokens(summary)
+
+    # Another request may have compacted the conversation in the meantime
+    updated = await Conversation.objects.filter(
+        pk=conversation.pk, summarized_until=conversation.summarized_until
+    ).aupdate(summary=summary, summary_tokens=summary_tokens,
+              summarized_until=folded[-1].pk, updated_at=timezone.now())
+    if not updated:
+        logger.info("Conversation %s was compacted concurrently", conversation.pk)
+        return False
+
+    conversation.summary = summary
+    conversation.summary_tokens = summary_tokens
+    conversation.summarized_until = folded[-1].pk
+    conversation.recent = recent[keep:]
+    return True
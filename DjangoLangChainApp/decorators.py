@@ -0,0 +1,89 @@
+from functools import wraps
+import math
+from django.contrib.auth.views import redirect_to_login
+from django.http import HttpResponse
+from .admission import Throttled, aacquire_slot, acheck_rate, arelease_slot
+
+
+def async_login_required(view_func):
+    """
+    `login_required` for `async def` views.
+
+    Django's `login_required` only wraps sync views. This loads the user
+    with `request.auser()` instead of the lazy `request.user`, which can't be
+    evaluated inside the event loop, and redirects anonymous users to the
+    login page.
+
+    Args:
+        view_func (coroutine function): The view to protect.
+
+    Returns:
+        coroutine function: The wrapped view.
+    """
+    @wraps(view_func)
+    async def wrapper(request, *args, **kwargs):
+        user = await request.auser()
+        if not user.is_authenticated:
+            return redirect_to_login(request.get_full_path())
+        return await view_func(request, *args, **kwargs)
+    return wrapper
+
+
+def _throttled_response(error):
+    response = HttpResponse(f"{error}, please retry later", status=429)
+    response["Retry-After"] = str(max(1, math.ceil(error.retry_after)))
+    return response
+
+
+def admission_control(kind, in_flight=False, cost=None):
+    """
+    Admission control of the POST requests of an `async def` view.
+
+    Every POST takes a token (or `cost` tokens) from the user's `kind`
+    bucket, and with `in_flight` also one of the slots of requests calling
+    OpenAI, held until the response (or the stream of a streaming response)
+    is complete. Requests that aren't admitted get a 429 with `Retry-After`.
+    See `admission.py`. Apply it inside `async_login_required`.
+
+    Args:
+        kind (str): The kind of request, a key of `ADMISSION_RATES`.
+        in_flight (bool): Whether the view calls OpenAI while responding.
+        cost (callable, optional): Called with the request, returns the
+            number of tokens it takes, e.g. the number of URLs of a bulk
+            upload.
+
+    Returns:
+        function: The decorator.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        async def wrapper(request, *args, **kwargs):
+            if request.method != "POST":
+                return await view_func(request, *args, **kwargs)
+            user = await request.auser()
+            try:
+                await acheck_rate(user.pk, kind, cost(request) if cost else 1)
+                slot = await aacquire_slot(kind) if in_flight else None
+            except Throttled as e:
+                return _throttled_response(e)
+
+            try:
+                response = await view_func(request, *args, **kwargs)
+            except BaseException:
+                await arelease_slot(slot)
+                raise
+            if not response.streaming:
+                await arelease_slot(slot)
+                return response
+
+            content = response.streaming_content
+            async def release_when_sent():
+                try:
+                    async for chunk in content:
+                        yield chunk
+                finally:
+                    await arelease_slot(slot)
+            response.streaming_content = release_when_sent()
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,198 @@
+from datetime import timedelta
+import logging
+import os
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from .chat.pinecone.vector_store import delete_document_vectors, delete_vectors
+from .chat.model.chat import invalidate_chat
+from .chat.model.answer_cache import invalidate_answers
+from .chat.keyword.bm25 import delete_keyword_index
+from .ingestion import retry_delay
+from .models import Chunk, CleanupJob, IndexedSource, PdfFile
+
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(post_delete, sender=PdfFile, dispatch_uid="release_document_index")
+def release_index(sender, instance, **kwargs):
+    """
+    Schedule the removal of a deleted document's index.
+
+    Connected to `post_delete`, so that it runs for every deleted document,
+    whether deleted by `PdfFile.delete`, a queryset delete or a cascade
+    from its user, and in the same transaction. A document sharing an
+    IndexedSource only releases its reference, the index being removed
+    with the last one.
+    """
+    if instance.source_id is None:
+        schedule_cleanup(instance.pdf_id, instance.pinecone_id_list)
+        return
+
+    IndexedSource.objects.filter(pk=instance.source_id).update(
+        ref_count=F("ref_count") - 1
+    )
+    release_source(instance.source_id)
+
+
+def release_source(source_id):
+    """
+    Delete an IndexedSource no document references and schedule the removal of its index.
+
+    The row is locked while its count is checked, so that a document
+    attached to it concurrently (which first increments the count) waits
+    and then finds it deleted. The row is deleted by a single statement
+    conditioned on its `ref_count`, not by primary key as the collector
+    would, so that it is also kept on backends without row locks.
+
+    Args:
+        source_id (uuid.UUID): The primary key of the source.
+
+    Returns:
+        bool: Whether the source was deleted.
+    """
+    sources = IndexedSource.objects.filter(pk=source_id, ref_count=0)
+    with transaction.atomic():
+        vector_ids = sources.select_for_update() \
+            .values_list("pinecone_id_list", flat=True).first()
+        if vector_ids is None:
+            return False
+        if PdfFile.objects.filter(source_id=source_id).exists():
+            # Attached by an ingestion that didn't count it yet
+            return False
+        # Skips the collector, nothing else references an unreferenced source
+        deleted = sources._raw_delete(sources.db)
+        if deleted:
+            schedule_cleanup(source_id, vector_ids)
+    return bool(deleted)
+
+
+def schedule_cleanup(index_id, vector_ids):
+    """
+    Record that the index of a deleted document is to be removed.
+
+    The cached chat chain and answers of the document are dropped once the
+    transaction commits, everything else is removed by `run_cleanup_jobs`.
+
+    Args:
+        index_id (uuid.UUID): The `pdf_id` the vectors are stored under.
+        vector_ids (list[str]): IDs of the vectors to delete in addition
+            to those of the index's `Chunk` rows.
+    """
+    CleanupJob.objects.create(index_id=index_id, vector_ids=list(vector_ids))
+
+    def invalidate():
+        invalidate_chat(index_id)
+        invalidate_answers(index_id)
+    transaction.on_commit(invalidate)
+
+
+def claim_cleanup_jobs(limit):
+    """
+    Atomically mark up to `limit` due cleanup jobs as running.
+
+    Args:
+        limit (int): Maximum number of jobs to claim.
+
+    Returns:
+        list[int]: Primary keys of the claimed jobs.
+    """
+    candidates = CleanupJob.objects.filter(
+        status=CleanupJob.Status.QUEUED,
+        next_attempt_at__lte=timezone.now()
+    ).order_by("next_attempt_at").values_list("pk", flat=True)[:limit]
+
+    claimed = []
+    for job_id in list(candidates):
+        updated = CleanupJob.objects.filter(
+            pk=job_id, status=CleanupJob.Status.QUEUED
+        ).update(status=CleanupJob.Status.RUNNING,
+                 attempts=F("attempts") + 1,
+                 updated_at=timezone.now())
+        if updated:
+            claimed.append(job_id)
+    return claimed
+
+
+def requeue_stale_cleanup_jobs():
+    """
+    Requeue running cleanup jobs whose worker stopped without finishing them.
+
+    Returns:
+        int: Number of requeued jobs.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.INGESTION_JOB_TIMEOUT)
+    return CleanupJob.objects.filter(
+        status=CleanupJob.Status.RUNNING, updated_at__lt=cutoff
+    ).update(status=CleanupJob.Status.QUEUED, next_attempt_at=timezone.now())
+
+
+def run_cleanup_jobs(limit=None):
+    """
+    Remove the indexes of up to `limit` due cleanup jobs.
+
+    Vectors are deleted by ID, `VECTOR_DELETE_BATCH_SIZE` at a time, or by
+    `pdf_id` metadata filter with `VECTOR_DELETE_BY_FILTER`. The chunks and
+    PDF files of the batch are then removed together, and finished jobs are
+    deleted.
+    Failed jobs are retried with exponential backoff.
+
+    Args:
+        limit (int, optional): Maximum number of jobs to run, defaults to
+            `CLEANUP_BATCH_SIZE`.
+
+    Returns:
+        tuple[int, int]: Number of removed indexes and of failed jobs.
+    """
+    job_ids = claim_cleanup_jobs(limit or settings.CLEANUP_BATCH_SIZE)
+    if not job_ids:
+        return 0, 0
+
+    done, failed = [], 0
+    for job in CleanupJob.objects.filter(pk__in=job_ids):
+        try:
+            if settings.VECTOR_DELETE_BY_FILTER:
+                delete_document_vectors(job.index_id)
+            else:
+                vector_ids = job.vector_ids + list(
+                    Chunk.objects.filter(index_id=job.index_id)
+                    .values_list("vector_id", flat=True)
+                )
+                if vector_ids:
+                    delete_vectors(vector_ids)
+            delete_keyword_index(job.index_id)
+        except Exception as e:
+            logger.exception("Cleanup of %s failed (attempt %d)", job.index_id, job.attempts)
+            _fail_cleanup(job, e)
+            failed += 1
+        else:
+            done.append(job)
+
+    Chunk.objects.filter(index_id__in=[job.index_id for job in done]).delete()
+    _remove_files(f"pdfs/{job.index_id}.pdf" for job in done)
+    CleanupJob.objects.filter(pk__in=[job.pk for job in done]).delete()
+    return len(done), failed
+
+
+def _remove_files(paths):
+    """Remove the files at `paths` that exist."""
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _fail_cleanup(job, error):
+    """Requeue `job` with backoff, or fail it once out of attempts."""
+    job.last_error = str(error)
+    if job.attempts < settings.CLEANUP_MAX_ATTEMPTS:
+        job.status = CleanupJob.Status.QUEUED
+        job.next_attempt_at = timezone.now() + retry_delay(job.attempts)
+    else:
+        job.status = CleanupJob.Status.FAILED
+    job.save(update_fields=["status", "next_attempt_at", "last_error", "updated_at"])
@@ -0,0 +1,138 @@
+import os
+import re
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import FileResponse, HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+
+_SENDFILE_HEADERS = ("X-Sendfile", "X-Accel-Redirect")
+_RANGE = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+class _FileResponse(FileResponse):
+    # Fewer, larger reads than the default 4 KiB, each of which is a thread
+    # hop when served by the ASGI handler
+    block_size = 64 * 1024
+
+
+class _FileRange:
+    """A file-like reading at most `length` bytes from the current position."""
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size):
+        data = self.file.read(min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def _requested_range(request, size, etag, last_modified):
+    """
+    Return the byte range asked for by the request's `Range` header.
+
+    Multiple ranges, malformed headers and ranges of another version of the
+    file (see `If-Range`) are ignored, so the whole file is served.
+
+    Returns:
+        tuple[int, int] | None: The first and last byte, None for the whole file.
+
+    Raises:
+        ValueError: If the range starts after the end of the file, or asks
+            for the last 0 bytes.
+    """
+    match = _RANGE.fullmatch(request.headers.get("Range", "").strip())
+    if match is None or not any(match.groups()):
+        return None
+    if_range = request.headers.get("If-Range")
+    if if_range and if_range != etag and parse_http_date_safe(if_range) != last_modified:
+        return None
+
+    start, end = match.groups()
+    if not start:
+        # The last `end` bytes
+        if not int(end) or not size:
+            raise ValueError("Empty suffix range")
+        return max(size - int(end), 0), size - 1
+    start = int(start)
+    if end and int(end) < start:
+        return None
+    if start >= size:
+        raise ValueError(f"Range starts after the end of the file ({size} bytes)")
+    return start, min(int(end), size - 1) if end else size - 1
+
+
+def _sendfile_response(path, content_type):
+    header = settings.PDF_SENDFILE_HEADER
+    if header not in _SENDFILE_HEADERS:
+        raise ImproperlyConfigured(
+            f"PDF_SENDFILE_HEADER must be one of {', '.join(_SENDFILE_HEADERS)}, "
+            f"not {header!r}")
+    response = HttpResponse(content_type=content_type)
+    if header == "X-Sendfile":
+        response[header] = os.path.abspath(path)
+    else:
+        response[header] = settings.PDF_SENDFILE_PREFIX.rstrip("/") + "/" + os.path.basename(path)
+    return response
+
+
+def file_response(request, path, content_type):
+    """
+    Serve a private file, answering conditional and range requests.
+
+    Responses carry an `ETag` and `Last-Modified` taken from the file, so
+    browsers revalidate cached copies with a 304 instead of downloading them
+    again, and may be cached for `PDF_CACHE_MAX_AGE` seconds by the browser
+    only. A single `Range` is answered with a 206 of just those bytes, so
+    viewers can load large PDFs page by page. When `PDF_SENDFILE_HEADER` is
+    set, the file is sent by the web server instead (`X-Sendfile` with its
+    absolute path, or `X-Accel-Redirect` with its name under
+    `PDF_SENDFILE_PREFIX`), which then also answers the range requests.
+
+    The caller must have checked the user may read the file.
+
+    Args:
+        request (django.http.HttpRequest): The request object.
+        path (str): Path of the file.
+        content_type (str): Content type of the file.
+
+    Returns:
+        HttpResponse: The file, part of it, a 304 or a 416 response.
+    """
+    stat = os.stat(path)
+    etag = quote_etag(f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+    # HTTP dates have a resolution of a second
+    last_modified = int(stat.st_mtime)
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        if settings.PDF_SENDFILE_HEADER:
+            response = _sendfile_response(path, content_type)
+        else:
+            try:
+                requested = _requested_range(request, stat.st_size, etag, last_modified)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response["Content-Range"] = f"bytes */{stat.st_size}"
+                return response
+            file = open(path, "rb")
+            if requested is None:
+                response = _FileResponse(file, content_type=content_type)
+            else:
+                start, end = requested
+                file.seek(start)
+                response = _FileResponse(_FileRange(file, end - start + 1),
+                                         content_type=content_type, status=206)
+                response["Content-Length"] = end - start + 1
+                response["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+            response["Accept-Ranges"] = "bytes"
+
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    patch_cache_control(response, private=True, max_age=settings.PDF_CACHE_MAX_AGE)
+    return response
@@ -5,4 +5,10 @@ class LinkUploadForm(forms.Form):
     
     
 class QueryForm(forms.Form):
-    querry = forms.CharField(label="Question", required=True)
\ No newline at end of file
+    querry = forms.CharField(label="Question", required=True)
+
+class DocumentsQueryForm(QueryForm):
+    SCOPES = [("selected", "Selected documents"), ("all", "All my documents")]
+
+    scope = forms.ChoiceField(label="Search", choices=SCOPES, initial="selected",
+                              widget=forms.RadioSelect)
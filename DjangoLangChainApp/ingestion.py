@@ -0,0 +1,786 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from datetime import timedelta
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+import hashlib
+import json
+import logging
+import os
+import multiprocessing
+import threading
+import time
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from DjangoLangChainProject.database import closing_old_connections
+from .chat.pinecone.vector_store import (
+    add_documents, add_documents_batch, add_documents_from_pdf, iter_pdf_pages
+)
+from .admission import Throttled
+from .metrics import INGESTION_STAGE_SECONDS
+from .models import PdfFile, IngestionJob, IndexedSource
+from .webpages import fetch_page
+from .chat.keyword.bm25 import delete_keyword_index
+from pypdf import PdfReader
+import pdfkit, uuid
+
+
+logger = logging.getLogger(__name__)
+
+# Semaphores limiting how many jobs may be in each stage at once,
+# set up by `configure_stage_limits` in every worker thread/process pool
+_stage_limits = {}
+
+# Politeness limits of each host pages are fetched from, see `_host_slot`
+_hosts_lock = threading.Lock()
+_hosts = {}
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+# Query parameters that don't change the content of a page,
+# in addition to any "utm_*" parameter
+_TRACKING_PARAMS = {"fbclid", "gclid", "mc_cid", "mc_eid"}
+
+
+class IngestionError(Exception):
+    """Raised when a document could not be ingested."""
+
+
+class IngestionCancelled(Exception):
+    """Raised when the document being ingested was deleted meanwhile."""
+
+
+def enqueue_ingestion(user, url):
+    """
+    Create a queued document for `url` and schedule its ingestion.
+
+    Args:
+        user (django.contrib.auth.models.User): The user uploading the URL.
+        url (str): The URL of the web page to ingest.
+
+    Returns:
+        PdfFile: The newly created, queued document.
+    """
+    with transaction.atomic():
+        pdf_file = PdfFile.objects.create(
+            user=user,
+            pdf_id=uuid.uuid4(),
+            status=PdfFile.Status.QUEUED,
+            url=url
+        )
+        IngestionJob.objects.create(pdf=pdf_file, url=url)
+    return pdf_file
+
+
+def parse_url_list(text):
+    """
+    Parse a list of URLs to upload in bulk.
+
+    Args:
+        text (str): Either a JSON list of URLs, a JSON object with such a
+            list under "urls", or one URL per line (blank lines and lines
+            starting with "#" are ignored).
+
+    Returns:
+        list[str]: The URLs, in order.
+
+    Raises:
+        ValueError: If the JSON is malformed or not a list of strings.
+    """
+    text = text.strip()
+    if not text.startswith(("[", "{")):
+        return [line.strip() for line in text.splitlines()
+                if line.strip() and not line.lstrip().startswith("#")]
+
+    try:
+        urls = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid JSON: {e}") from e
+    if isinstance(urls, dict):
+        urls = urls.get("urls")
+    if not isinstance(urls, list) or not all(isinstance(url, str) for url in urls):
+        raise ValueError("Expected a list of URLs")
+    return [url.strip() for url in urls]
+
+
+def enqueue_ingestions(user, urls):
+    """
+    Create queued documents for `urls` and schedule their ingestion.
+
+    The documents and their jobs are inserted with one bulk query each,
+    in batches of `INGESTION_BULK_BATCH_SIZE` rows.
+
+    Args:
+        user (django.contrib.auth.models.User): The user uploading the URLs.
+        urls (list[str]): The URLs of the web pages to ingest.
+
+    Returns:
+        list[PdfFile]: The newly created, queued documents, in the order of
+            `urls`.
+    """
+    pdf_files = [PdfFile(user=user, pdf_id=uuid.uuid4(), status=PdfFile.Status.QUEUED, url=url)
+                 for url in urls]
+    batch_size = settings.INGESTION_BULK_BATCH_SIZE
+    with transaction.atomic():
+        PdfFile.objects.bulk_create(pdf_files, batch_size=batch_size)
+        IngestionJob.objects.bulk_create(
+            [IngestionJob(pdf=pdf_file, url=url) for pdf_file, url in zip(pdf_files, urls)],
+            batch_size=batch_size
+        )
+    return pdf_files
+
+
+def configure_stage_limits(limits):
+    """
+    Install the per-stage semaphores used by `run_job`.
+
+    Args:
+        limits (dict[str, Semaphore]): Semaphore for each `PdfFile.Status`
+            stage that should be concurrency limited.
+    """
+    _stage_limits.clear()
+    _stage_limits.update(limits)
+
+
+@contextmanager
+def _stage(pdf_file, status):
+    """Wait for a free slot in the `status` stage, then move `pdf_file` to it."""
+    with _stage_limits.get(status) or nullcontext():
+        PdfFile.objects.filter(pk=pdf_file.pk).update(status=status)
+        pdf_file.status = status
+        yield
+
+
+class _HostLimit:
+    """Politeness state of a host: a semaphore and the earliest next request."""
+    def __init__(self, concurrency):
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.next_start = 0.0
+
+
+@contextmanager
+def _host_slot(url):
+    """
+    Wait until a request to the host of `url` is allowed.
+
+    At most `INGESTION_PER_HOST_CONCURRENCY` requests to a host run at once
+    and their starts are at least `INGESTION_PER_HOST_DELAY` seconds apart.
+    Limits are kept per worker thread pool or process.
+    """
+    host = (urlsplit(url).hostname or "").lower()
+    with _hosts_lock:
+        limit = _hosts.get(host)
+        if limit is None:
+            limit = _hosts[host] = _HostLimit(settings.INGESTION_PER_HOST_CONCURRENCY)
+
+    with limit.semaphore:
+        with _hosts_lock:
+            now = time.monotonic()
+            start = max(now, limit.next_start)
+            limit.next_start = start + settings.INGESTION_PER_HOST_DELAY
+        if start > now:
+            time.sleep(start - now)
+        yield
+
+
+def _fetch(url, pdf_path):
+    """
+    Fetch or render the page at `url`, within its host's politeness limits.
+
+    With INGESTION_MODE "html" the text of the page is returned to be
+    indexed directly, and its PDF is only rendered once viewed, unless the
+    URL serves a PDF. Otherwise the page is rendered to `pdf_path`.
+
+    Returns:
+        list[Document] | None: The pages of text of the page, or None if
+            its text is to be read from `pdf_path`.
+    """
+    with _host_slot(url):
+        if settings.INGESTION_MODE == "html":
+            with INGESTION_STAGE_SECONDS.time(stage="fetch"):
+                return fetch_page(url, pdf_path)
+        with INGESTION_STAGE_SECONDS.time(stage="render"):
+            pdfkit.from_url(url, pdf_path)
+        return None
+
+
+def _fetch_status():
+    """The `PdfFile.Status` of documents being fetched in the current mode."""
+    if settings.INGESTION_MODE == "html":
+        return PdfFile.Status.FETCHING
+    return PdfFile.Status.RENDERING
+
+
+def retry_delay(attempts):
+    """
+    Return the exponential backoff delay before the next attempt.
+
+    Args:
+        attempts (int): Number of attempts made so far.
+
+    Returns:
+        datetime.timedelta: Delay before the job may run again.
+    """
+    delay = settings.INGESTION_RETRY_BASE_DELAY * 2 ** max(attempts - 1, 0)
+    return timedelta(seconds=min(delay, settings.INGESTION_RETRY_MAX_DELAY))
+
+
+def claim_jobs(limit, job_ids=None):
+    """
+    Atomically mark up to `limit` due jobs as running.
+
+    A job is only claimed by the worker whose conditional update succeeds,
+    so several workers can poll the same table safely.
+
+    Args:
+        limit (int): Maximum number of jobs to claim.
+        job_ids (list[int], optional): Only claim jobs among these.
+
+    Returns:
+        list[int]: Primary keys of the claimed jobs.
+    """
+    candidates = IngestionJob.objects.filter(
+        status=IngestionJob.Status.QUEUED,
+        next_attempt_at__lte=timezone.now()
+    )
+    if job_ids is not None:
+        candidates = candidates.filter(pk__in=job_ids)
+    candidates = candidates.order_by("next_attempt_at").values_list("pk", flat=True)[:limit]
+
+    claimed = []
+    for job_id in list(candidates):
+        updated = IngestionJob.objects.filter(
+            pk=job_id, status=IngestionJob.Status.QUEUED
+        ).update(status=IngestionJob.Status.RUNNING,
+                 attempts=F("attempts") + 1,
+                 updated_at=timezone.now())
+        if updated:
+            claimed.append(job_id)
+    return claimed
+
+
+def requeue_stale_jobs():
+    """
+    Requeue running jobs whose worker stopped without finishing them.
+
+    Returns:
+        int: Number of requeued jobs.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.INGESTION_JOB_TIMEOUT)
+    return IngestionJob.objects.filter(
+        status=IngestionJob.Status.RUNNING, updated_at__lt=cutoff
+    ).update(status=IngestionJob.Status.QUEUED, next_attempt_at=timezone.now())
+
+
+def normalize_url(url):
+    """
+    Normalize `url` so that different spellings of a page compare equal.
+
+    The scheme and host are lowercased, default ports, fragments, trailing
+    slashes and tracking parameters are dropped and the query is sorted.
+
+    Args:
+        url (str): The URL to normalize.
+
+    Returns:
+        str: The normalized URL.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or "").lower()
+    if parts.port and parts.port != _DEFAULT_PORTS.get(scheme):
+        netloc += f":{parts.port}"
+
+    path = parts.path or "/"
+    if len(path) > 1:
+        path = path.rstrip("/")
+
+    query = urlencode(sorted(
+        (key, value)
+        for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.startswith("utm_") and key not in _TRACKING_PARAMS
+    ))
+    return urlunsplit((scheme, netloc, path, query, ""))
+
+
+def pdf_content_hash(pdf_path):
+    """
+    Return the SHA-256 hash of the text of a PDF file.
+
+    The text is hashed rather than the file, because rendering the same
+    page twice produces different bytes (e.g. the creation date).
+
+    Args:
+        pdf_path (str): Path of the PDF file.
+
+    Returns:
+        str: The hex digest of the hash.
+    """
+    digest = hashlib.sha256()
+    for page in PdfReader(pdf_path).pages:
+        digest.update(page.extract_text().encode())
+        digest.update(b"\f")
+    return digest.hexdigest()
+
+
+def text_content_hash(pages):
+    """
+    Return the SHA-256 hash of the text of a page fetched by `fetch_page`.
+
+    Args:
+        pages (list[Document]): The pages of text of the page.
+
+    Returns:
+        str: The hex digest of the hash.
+    """
+    digest = hashlib.sha256()
+    for page in pages:
+        digest.update(page.page_content.encode())
+        digest.update(b"\f")
+    return digest.hexdigest()
+
+
+def _fresh_source(normalized_url):
+    """Return the latest source fetched from `normalized_url` within the TTL."""
+    sources = IndexedSource.objects.filter(normalized_url=normalized_url)
+    if settings.INGESTION_DEDUP_TTL is not None:
+        sources = sources.filter(
+            fetched_at__gte=timezone.now() - timedelta(seconds=settings.INGESTION_DEDUP_TTL)
+        )
+    return sources.order_by("-fetched_at").first()
+
+
+def _attach(pdf_file, source, refresh=False):
+    """
+    Make `pdf_file` an indexed reference to `source`, copying its details.
+
+    Args:
+        pdf_file (PdfFile): The document being ingested.
+        source (IndexedSource): The source it shares.
+        refresh (bool): Whether the source's content was just fetched again.
+
+    Returns:
+        bool: False if the source has been deleted in the meantime.
+
+    Raises:
+        IngestionCancelled: If `pdf_file` has been deleted in the meantime,
+            in which case the source is left untouched.
+    """
+    updates = {"ref_count": F("ref_count") + 1}
+    if refresh:
+        updates["fetched_at"] = timezone.now()
+    details = {
+        "source": source,
+        "status": PdfFile.Status.INDEXED,
+        "title": source.title,
+        "page_count": source.page_count,
+        "chunk_count": source.chunk_count,
+    }
+
+    with transaction.atomic():
+        if not IndexedSource.objects.filter(pk=source.pk).update(**updates):
+            return False
+        if not PdfFile.objects.filter(pk=pdf_file.pk).update(**details):
+            # Rolls back the reference taken above
+            raise IngestionCancelled(f"Document {pdf_file.pdf_id} was deleted")
+    for field, value in details.items():
+        setattr(pdf_file, field, value)
+    return True
+
+
+def _source_with_content(content_hash):
+    """Return the latest source whose text has the hash `content_hash`."""
+    return IndexedSource.objects.filter(
+        content_hash=content_hash
+    ).order_by("-fetched_at").first()
+
+
+def _page_details(pages, pdf_path):
+    """
+    Return the title and number of pages of a page fetched by `_fetch`.
+
+    Details that can't be read from the PDF are left empty rather than
+    failing the ingestion. A page fetched as HTML has no pages until it is
+    rendered (see `webpages.paginate`).
+    """
+    max_length = IndexedSource._meta.get_field("title").max_length
+    if pages is not None:
+        return pages[0].metadata.get("title", "")[:max_length], 0
+    try:
+        reader = PdfReader(pdf_path)
+        title = reader.metadata.title if reader.metadata else None
+        return str(title or "").strip()[:max_length], len(reader.pages)
+    except Exception:
+        logger.warning("Failed to read the details of %s", pdf_path, exc_info=True)
+        return "", 0
+
+
+def _discard(pdf_path):
+    """Remove the PDF of a page that turned out to be indexed already."""
+    if os.path.exists(pdf_path):
+        os.remove(pdf_path)
+
+
+def _abandon(pdf_id):
+    """
+    Schedule the removal of what was indexed for a document deleted during its ingestion.
+
+    Its vectors, keyword index and PDF file are stored under its `pdf_id`,
+    as is the IndexedSource created for them, which is kept if another
+    document was attached to it meanwhile.
+    """
+    # Imported here as the deletion module depends on this one
+    from .deletion import release_source, schedule_cleanup
+    if IndexedSource.objects.filter(pk=pdf_id).exists():
+        release_source(pdf_id)
+    else:
+        schedule_cleanup(pdf_id, [])
+
+
+def _ingest(job, pdf_file):
+    """Index the page of `job`, reusing an indexed copy of it when possible."""
+    normalized_url = normalize_url(job.url)
+    source = _fresh_source(normalized_url)
+    if source is not None and _attach(pdf_file, source):
+        return
+
+    pdf_path = f"pdfs/{pdf_file.pdf_id}.pdf"
+    with _stage(pdf_file, _fetch_status()):
+        pages = _fetch(job.url, pdf_path)
+
+    content_hash = pdf_content_hash(pdf_path) if pages is None else text_content_hash(pages)
+    source = _source_with_content(content_hash)
+    if source is not None and _attach(pdf_file, source, refresh=True):
+        _discard(pdf_path)
+        return
+
+    with _stage(pdf_file, PdfFile.Status.EMBEDDING):
+        if pages is None:
+            pinecone_id_list = add_documents_from_pdf(
+                pdf_path=pdf_path,
+                pdf_id=pdf_file.pdf_id
+            )
+        else:
+            pinecone_id_list = add_documents(pages, pdf_file.pdf_id)
+    if not pinecone_id_list:
+        raise IngestionError("Failed to add document to Pinecone")
+
+    title, page_count = _page_details(pages, pdf_path)
+    source = IndexedSource.objects.create(
+        source_id=pdf_file.pdf_id,
+        url=job.url,
+        normalized_url=normalized_url,
+        content_hash=content_hash,
+        title=title,
+        page_count=page_count,
+        chunk_count=len(pinecone_id_list)
+    )
+    _attach(pdf_file, source)
+
+
+@closing_old_connections
+def run_job(job_id):
+    """
+    Fetch (or render), embed and index the document of a claimed job.
+
+    A page whose normalized URL was fetched within `INGESTION_DEDUP_TTL`
+    seconds, or whose rendered text matches an indexed page, shares that
+    page's vectors instead of being embedded again.
+
+    On failure the job is requeued with exponential backoff, or marked as
+    failed together with its document once it ran out of attempts. Deleting
+    the document (and thus its job) cancels the ingestion, and whatever was
+    indexed for it is scheduled for removal.
+
+    Args:
+        job_id (int): Primary key of a job previously returned by `claim_jobs`.
+
+    Returns:
+        bool: Whether the document was indexed.
+    """
+    started = time.perf_counter()
+    job = IngestionJob.objects.select_related("pdf").filter(pk=job_id).first()
+    if job is None:
+        logger.info("Ingestion job %s was cancelled", job_id)
+        return False
+    _observe_queued([job])
+
+    try:
+        _ingest(job, job.pdf)
+    except IngestionCancelled:
+        logger.info("Ingestion of %s was cancelled, its document was deleted", job.url)
+        _abandon(job.pdf_id)
+        return False
+    except Throttled as e:
+        logger.warning("Ingestion of %s was not admitted: %s", job.url, e)
+        _fail_attempt(job, e)
+        return False
+    except Exception as e:
+        logger.exception("Ingestion of %s failed (attempt %d)", job.url, job.attempts)
+        _fail_attempt(job, e)
+        return False
+    finally:
+        INGESTION_STAGE_SECONDS.observe(time.perf_counter() - started, stage="job")
+
+    IngestionJob.objects.filter(pk=job.pk).update(
+        status=IngestionJob.Status.DONE, last_error="", updated_at=timezone.now()
+    )
+    return True
+
+
+class JobResult:
+    """Outcomes of a job run by `run_jobs`."""
+    INDEXED = "indexed"
+    REUSED = "reused"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+@closing_old_connections
+def run_jobs(job_ids, concurrency=None):
+    """
+    Fetch (or render), embed and index the documents of several claimed jobs.
+
+    This is `run_job` for many jobs at once:
+
+    - pages are fetched concurrently on up to `concurrency` threads, within
+      the per-host politeness limits (`_host_slot`), while all database
+      access stays on the calling thread;
+    - pages already indexed, or fetched twice in the batch, share vectors
+      like with `run_job`;
+    - the chunks of all new pages go through a single embedding and upsert
+      stream (`add_documents_batch`), so small pages fill whole requests.
+
+    If indexing the batch fails, every job whose page was to be indexed is
+    requeued (or failed) like a failed `run_job`. Jobs whose document was
+    deleted meanwhile are cancelled like with `run_job`.
+
+    Args:
+        job_ids (list[int]): Primary keys of jobs returned by `claim_jobs`.
+        concurrency (int, optional): Maximum number of pages fetched at
+            once, defaults to the "fetching" or "rendering" stage limit.
+
+    Returns:
+        dict[int, tuple[str, str]]: The `JobResult` of each job and its
+            error message, if any.
+    """
+    started = time.perf_counter()
+    jobs = list(IngestionJob.objects.select_related("pdf").filter(pk__in=job_ids))
+    _observe_queued(jobs)
+    results = {}
+
+    to_fetch = []
+    for job in jobs:
+        source = _fresh_source(normalize_url(job.url))
+        try:
+            if source is not None and _attach(job.pdf, source):
+                results[job.pk] = (JobResult.REUSED, "")
+                continue
+        except IngestionCancelled:
+            results[job.pk] = (JobResult.CANCELLED, "")
+            continue
+        to_fetch.append(job)
+
+    status = _fetch_status()
+    PdfFile.objects.filter(pk__in=[job.pdf_id for job in to_fetch]).update(status=status)
+    concurrency = concurrency or settings.INGESTION_STAGE_CONCURRENCY[status]
+
+    def fetch(job):
+        pdf_path = f"pdfs/{job.pdf_id}.pdf"
+        try:
+            with _stage_limits.get(status) or nullcontext():
+                return job, pdf_path, _fetch(job.url, pdf_path), None
+        except Exception as e:
+            return job, pdf_path, None, e
+
+    new = []
+    by_hash = {}
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1),
+                            thread_name_prefix="fetch") as executor:
+        for job, pdf_path, pages, error in executor.map(fetch, to_fetch):
+            if error is None:
+                try:
+                    content_hash = (pdf_content_hash(pdf_path) if pages is None
+                                    else text_content_hash(pages))
+                except Exception as e:
+                    error = e
+            if error is not None:
+                logger.error("Ingestion of %s failed (attempt %d): %s",
+                             job.url, job.attempts, error)
+                _fail_all([job], error, results)
+                continue
+
+            source = _source_with_content(content_hash)
+            try:
+                attached = source is not None and _attach(job.pdf, source, refresh=True)
+            except IngestionCancelled:
+                _discard(pdf_path)
+                results[job.pk] = (JobResult.CANCELLED, "")
+                continue
+            if attached:
+                _discard(pdf_path)
+                results[job.pk] = (JobResult.REUSED, "")
+            elif content_hash in by_hash:
+                # Same page as another one of the batch, attached once indexed
+                _discard(pdf_path)
+                by_hash[content_hash][1].append(job)
+            else:
+                by_hash[content_hash] = (job, [], pages, pdf_path)
+                new.append(content_hash)
+
+    if new:
+        _index_batch([by_hash[content_hash] for content_hash in new], new, results)
+
+    done = [job_id for job_id, (result, _) in results.items() if result != JobResult.FAILED]
+    IngestionJob.objects.filter(pk__in=done).update(
+        status=IngestionJob.Status.DONE, last_error="", updated_at=timezone.now()
+    )
+    INGESTION_STAGE_SECONDS.observe(time.perf_counter() - started, stage="batch")
+    return results
+
+
+def _observe_queued(jobs):
+    """Record how long claimed `jobs` waited in the queue since they were due."""
+    for job in jobs:
+        # `updated_at` was set when the job was claimed
+        waited = (job.updated_at - job.next_attempt_at).total_seconds()
+        INGESTION_STAGE_SECONDS.observe(max(waited, 0), stage="queued")
+
+
+def _index_batch(indexed, content_hashes, results):
+    """Index the new pages of `run_jobs` and attach their documents, recording `results`."""
+    PdfFile.objects.filter(pk__in=[job.pdf_id for job, *_ in indexed]) \
+        .update(status=PdfFile.Status.EMBEDDING)
+    try:
+        with _stage_limits.get(PdfFile.Status.EMBEDDING) or nullcontext():
+            id_lists = add_documents_batch([
+                (iter_pdf_pages(pdf_path) if pages is None else pages, job.pdf_id)
+                for job, _, pages, pdf_path in indexed
+            ])
+    except Exception as e:
+        logger.exception("Indexing of %d page(s) failed", len(indexed))
+        for job, duplicates, *_ in indexed:
+            _fail_all([job] + duplicates, e, results)
+        return
+
+    added = []
+    for content_hash, entry, id_list in zip(content_hashes, indexed, id_lists):
+        if id_list:
+            added.append((content_hash, entry, id_list))
+        else:
+            job, duplicates, *_ = entry
+            delete_keyword_index(job.pdf_id)
+            _fail_all([job] + duplicates,
+                      IngestionError("Failed to add document to Pinecone"), results)
+
+    sources = []
+    for content_hash, (job, _, pages, pdf_path), id_list in added:
+        title, page_count = _page_details(pages, pdf_path)
+        sources.append(IndexedSource(source_id=job.pdf_id, url=job.url,
+                                     normalized_url=normalize_url(job.url),
+                                     content_hash=content_hash, title=title,
+                                     page_count=page_count, chunk_count=len(id_list)))
+    IndexedSource.objects.bulk_create(sources)
+    for source, (_, (job, duplicates, *_), _) in zip(sources, added):
+        for each, result in [(job, JobResult.INDEXED)] + \
+                [(duplicate, JobResult.REUSED) for duplicate in duplicates]:
+            try:
+                _attach(each.pdf, source)
+                results[each.pk] = (result, "")
+            except IngestionCancelled:
+                results[each.pk] = (JobResult.CANCELLED, "")
+        if results[job.pk][0] == JobResult.CANCELLED:
+            # Kept if one of the duplicates was attached to it
+            _abandon(job.pdf_id)
+
+
+def _fail_all(jobs, error, results):
+    """Fail an attempt of each of `jobs`, recording it in `results`."""
+    for job in jobs:
+        if _fail_attempt(job, error):
+            results[job.pk] = (JobResult.FAILED, str(error))
+        else:
+            results[job.pk] = (JobResult.CANCELLED, "")
+
+
+def _fail_attempt(job, error):
+    """
+    Requeue `job` with backoff, or fail it once out of attempts.
+
+    A job deleted with its document meanwhile is cancelled instead. A job
+    that wasn't admitted (see `admission.py`) is requeued for when it may be
+    retried, without counting the attempt.
+
+    Returns:
+        bool: False if the job was cancelled.
+    """
+    job.last_error = str(error)
+    if isinstance(error, Throttled):
+        job.attempts -= 1
+        job.status = IngestionJob.Status.QUEUED
+        job.next_attempt_at = timezone.now() + timedelta(seconds=error.retry_after)
+        pdf_status = PdfFile.Status.QUEUED
+    elif job.attempts < settings.INGESTION_MAX_ATTEMPTS:
+        job.status = IngestionJob.Status.QUEUED
+        job.next_attempt_at = timezone.now() + retry_delay(job.attempts)
+        pdf_status = PdfFile.Status.QUEUED
+    else:
+        job.status = IngestionJob.Status.FAILED
+        pdf_status = PdfFile.Status.FAILED
+
+    if not IngestionJob.objects.filter(pk=job.pk).update(
+        status=job.status, attempts=job.attempts, next_attempt_at=job.next_attempt_at,
+        last_error=job.last_error, updated_at=timezone.now()
+    ):
+        _abandon(job.pdf_id)
+        return False
+    PdfFile.objects.filter(pk=job.pdf_id).update(status=pdf_status)
+    return True
+
+
+def _init_worker_process(limits):
+    configure_stage_limits(limits)
+
+
+def make_executor(kind, workers, stage_concurrency):
+    """
+    Create the executor jobs are run on.
+
+    Args:
+        kind (str): Either "thread" or "process".
+        workers (int): Maximum number of jobs running at once.
+        stage_concurrency (dict[str, int]): Maximum number of jobs in each
+            stage at once.
+
+    Returns:
+        concurrent.futures.Executor: The executor to submit `run_job` to.
+    """
+    if kind == "thread":
+        configure_stage_limits({
+            stage: threading.BoundedSemaphore(limit)
+            for stage, limit in stage_concurrency.items()
+        })
+        return ThreadPoolExecutor(max_workers=workers,
+                                  thread_name_prefix="ingestion")
+
+    if kind == "process":
+        context = multiprocessing.get_context("fork")
+        limits = {
+            stage: context.BoundedSemaphore(limit)
+            for stage, limit in stage_concurrency.items()
+        }
+        # Forked workers must not share the parent's database connections
+        connections.close_all()
+        return ProcessPoolExecutor(max_workers=workers,
+                                   mp_context=context,
+                                   initializer=_init_worker_process,
+                                   initargs=(limits,))
+
+    raise ValueError(f"Unknown executor: {kind}")
+
+
+def close_connections_before_fork(kind):
+    """Close database connections before a process executor may fork."""
+    if kind == "process":
+        connections.close_all()
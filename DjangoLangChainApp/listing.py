@@ -0,0 +1,90 @@
+from datetime import datetime
+import base64
+import binascii
+import uuid
+from django.conf import settings
+from django.db.models import Q
+from .models import PdfFile
+
+
+# Columns read when listing documents, never the vector ID lists
+LISTED_FIELDS = ("pdf_id", "url", "title", "status", "page_count", "chunk_count",
+                 "created_at")
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor is malformed."""
+
+
+def encode_cursor(pdf):
+    """
+    Return the cursor of the documents listed after `pdf`.
+
+    Args:
+        pdf (PdfFile): The last document of a page.
+
+    Returns:
+        str: An opaque, URL-safe cursor.
+    """
+    value = f"{pdf.created_at.isoformat()}|{pdf.pdf_id}"
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Return the upload time and ID of the document a cursor points after.
+
+    Raises:
+        InvalidCursor: If `cursor` wasn't returned by `encode_cursor`.
+    """
+    try:
+        value = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, pdf_id = value.split("|")
+        return datetime.fromisoformat(created_at), uuid.UUID(pdf_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor}") from e
+
+
+def list_page(user, cursor=None, page_size=None, status=None):
+    """
+    Return a page of a user's documents, newest first.
+
+    Pages are found by keyset rather than by offset: a page starts right
+    after the last document of the previous one (its `cursor`), which the
+    (user, created_at) index finds directly, so every page takes the same
+    time however many documents come before it.
+
+    Args:
+        user (django.contrib.auth.models.User): The user whose documents
+            are listed.
+        cursor (str, optional): Cursor of the page, see `encode_cursor`.
+            Defaults to the first page.
+        page_size (int, optional): Number of documents per page, defaults
+            to `DOCUMENTS_PAGE_SIZE`.
+        status (str, optional): Only list the documents with this
+            `PdfFile.Status`.
+
+    Returns:
+        tuple[list[PdfFile], str | None]: The documents, with only their
+            `LISTED_FIELDS` loaded, and the cursor of the next page, None on
+            the last page.
+
+    Raises:
+        InvalidCursor: If `cursor` is malformed.
+    """
+    page_size = page_size or settings.DOCUMENTS_PAGE_SIZE
+    documents = PdfFile.objects.filter(user=user).only(*LISTED_FIELDS) \
+        .order_by("-created_at", "-pdf_id")
+    if status is not None:
+        documents = documents.filter(status=status)
+    if cursor:
+        created_at, pdf_id = decode_cursor(cursor)
+        # (created_at, pdf_id) < cursor, with a bound the index can seek to
+        documents = documents.filter(created_at__lte=created_at).filter(
+            Q(created_at__lt=created_at) | Q(pdf_id__lt=pdf_id)
+        )
+
+    # One more document than shown tells whether there is a next page
+    documents = list(documents[:page_size + 1])
+    next_cursor = encode_cursor(documents[page_size - 1]) if len(documents) > page_size else None
+    return documents[:page_size], next_cursor
@@ -0,0 +1,86 @@
+import sys
+import time
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from DjangoLangChainApp.ingestion import (
+    JobResult,
+    claim_jobs,
+    enqueue_ingestions,
+    parse_url_list,
+    run_jobs,
+)
+from DjangoLangChainApp.models import IngestionJob
+import validators
+
+
+class Command(BaseCommand):
+    help = ("Upload many URLs at once and ingest them, reporting the result "
+            "of each URL and the overall throughput.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "source",
+            help="File with a JSON list of URLs or one URL per line, '-' for stdin.")
+        parser.add_argument(
+            "--user", required=True,
+            help="Username of the user the documents are uploaded for.")
+        parser.add_argument(
+            "--batch-size", type=int, default=50,
+            help="Number of pages fetched and embedded together.")
+        parser.add_argument(
+            "--concurrency", type=int, default=None,
+            help="Maximum number of pages fetched at once (per-host limits still apply).")
+        parser.add_argument(
+            "--enqueue-only", action="store_true",
+            help="Only queue the URLs for the ingestion worker.")
+
+    def handle(self, *args, **options):
+        try:
+            if options["source"] == "-":
+                urls = parse_url_list(sys.stdin.read())
+            else:
+                with open(options["source"], encoding="utf-8") as file:
+                    urls = parse_url_list(file.read())
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        try:
+            user = User.objects.get(username=options["user"])
+        except User.DoesNotExist:
+            raise CommandError(f"Unknown user: {options['user']}")
+
+        started = time.perf_counter()
+        valid = [url for url in urls if validators.url(url)]
+        pdf_files = enqueue_ingestions(user, valid)
+        job_ids = dict(IngestionJob.objects.filter(pdf__in=pdf_files)
+                       .values_list("pdf_id", "pk"))
+
+        results = {}
+        if not options["enqueue_only"]:
+            ordered = [job_ids[pdf_file.pdf_id] for pdf_file in pdf_files]
+            size = max(options["batch_size"], 1)
+            for start in range(0, len(ordered), size):
+                batch = ordered[start:start + size]
+                # Jobs picked up by a running worker in the meantime are left to it
+                claimed = claim_jobs(len(batch), job_ids=batch)
+                results.update(run_jobs(claimed, options["concurrency"]))
+        elapsed = time.perf_counter() - started
+
+        counts = {}
+        pdf_files = iter(pdf_files)
+        for url in urls:
+            if not validators.url(url):
+                status, detail = "invalid", ""
+            else:
+                pdf_file = next(pdf_files)
+                status, error = results.get(job_ids[pdf_file.pdf_id], ("queued", ""))
+                detail = f"{pdf_file.pdf_id} {error}".strip()
+            counts[status] = counts.get(status, 0) + 1
+            self.stdout.write(f"{status:<8} {url} {detail}".rstrip())
+
+        summary = ", ".join(f"{count} {status}" for status, count in sorted(counts.items()))
+        self.stdout.write(f"{len(urls)} URL(s) in {elapsed:.1f}s "
+                          f"({len(urls) / max(elapsed, 1e-9):.1f} URLs/s): {summary or 'none'}")
+        if counts.get(JobResult.FAILED):
+            self.stdout.write(f"Failed jobs are retried by the ingestion worker "
+                              f"(up to {settings.INGESTION_MAX_ATTEMPTS} attempts)")
@@ -0,0 +1,127 @@
+from concurrent.futures import wait, FIRST_COMPLETED
+import logging
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from DjangoLangChainProject.database import close_old_connections
+from DjangoLangChainApp.deletion import requeue_stale_cleanup_jobs, run_cleanup_jobs
+from DjangoLangChainApp.metrics import start_metrics_server
+from DjangoLangChainApp.ingestion import (
+    claim_jobs,
+    close_connections_before_fork,
+    make_executor,
+    requeue_stale_jobs,
+    run_job,
+    run_jobs,
+    JobResult,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Process queued document ingestion and cleanup jobs."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--executor", choices=["thread", "process"],
+            default=settings.INGESTION_EXECUTOR,
+            help="Run jobs on a thread pool or a process pool.")
+        parser.add_argument(
+            "--workers", type=int, default=settings.INGESTION_WORKERS,
+            help="Maximum number of jobs running at once.")
+        parser.add_argument(
+            "--fetch-concurrency", type=int,
+            default=settings.INGESTION_STAGE_CONCURRENCY["fetching"],
+            help="Maximum number of pages fetched at once.")
+        parser.add_argument(
+            "--render-concurrency", type=int,
+            default=settings.INGESTION_STAGE_CONCURRENCY["rendering"],
+            help="Maximum number of pages rendered to PDF at once.")
+        parser.add_argument(
+            "--embed-concurrency", type=int,
+            default=settings.INGESTION_STAGE_CONCURRENCY["embedding"],
+            help="Maximum number of documents embedded and indexed at once.")
+        parser.add_argument(
+            "--batch-size", type=int, default=settings.INGESTION_WORKER_BATCH_SIZE,
+            help="Number of jobs each worker runs together, so the chunks of "
+                 "small pages share embedding and upsert requests.")
+        parser.add_argument(
+            "--poll-interval", type=float, default=settings.INGESTION_POLL_INTERVAL,
+            help="Seconds to wait between polls of an empty queue.")
+        parser.add_argument(
+            "--metrics-port", type=int, default=settings.WORKER_METRICS_PORT,
+            help="Serve the worker's metrics for Prometheus on this port. With "
+                 "the process executor, stage timings are recorded in the "
+                 "job processes and not served.")
+        parser.add_argument(
+            "--once", action="store_true",
+            help="Exit once no job is due instead of polling forever.")
+
+    def handle(self, *args, **options):
+        kind = options["executor"]
+        workers = options["workers"]
+        stage_concurrency = {
+            "fetching": options["fetch_concurrency"],
+            "rendering": options["render_concurrency"],
+            "embedding": options["embed_concurrency"],
+        }
+
+        if options["metrics_port"]:
+            start_metrics_server(options["metrics_port"])
+            self.stdout.write(f"Serving metrics on port {options['metrics_port']}")
+
+        requeued = requeue_stale_jobs() + requeue_stale_cleanup_jobs()
+        if requeued:
+            self.stdout.write(f"Requeued {requeued} stale job(s)")
+
+        in_flight = set()
+        with make_executor(kind, workers, stage_concurrency) as executor:
+            while True:
+                # As Django does between requests
+                close_old_connections()
+                free = workers - len(in_flight)
+                if free:
+                    size = max(options["batch_size"], 1)
+                    job_ids = claim_jobs(free * size)
+                    close_connections_before_fork(kind)
+                    for start in range(0, len(job_ids), size):
+                        batch = job_ids[start:start + size]
+                        if size == 1:
+                            in_flight.add(executor.submit(run_job, batch[0]))
+                        else:
+                            in_flight.add(executor.submit(run_jobs, batch))
+
+                # Indexes of deleted documents are removed between polls
+                removed, failed = run_cleanup_jobs()
+                if removed or failed:
+                    self.stdout.write(f"Removed {removed} deleted document index(es), "
+                                      f"{failed} failed")
+
+                if not in_flight:
+                    if removed or failed:
+                        # More indexes may be waiting to be removed
+                        continue
+                    if options["once"]:
+                        break
+                    time.sleep(options["poll_interval"])
+                    continue
+
+                done, in_flight = wait(in_flight,
+                                       timeout=options["poll_interval"],
+                                       return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        result = future.result()
+                    except Exception:
+                        # Its jobs are requeued once stale, the worker carries on
+                        logger.exception("Ingestion job crashed")
+                        self.stdout.write("Ingestion attempt failed")
+                        continue
+                    outcomes = ([result] if isinstance(result, bool) else
+                                [outcome in (JobResult.INDEXED, JobResult.REUSED)
+                                 for outcome, _ in result.values()])
+                    for indexed in outcomes:
+                        self.stdout.write("Indexed document" if indexed
+                                          else "Ingestion attempt failed")
@@ -0,0 +1,247 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import math
+import threading
+import time
+
+
+# Metrics are kept in memory per process and exported in the Prometheus text
+# format by the /metrics view (and `run_worker --metrics-port`). Recording
+# takes a lock and a few additions, so it can be done on every request.
+_registry = []
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds in seconds of the latency histograms' buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Base class of the metrics, registered for `render` when created."""
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def _key(self, labels):
+        try:
+            return tuple(str(labels[name]) for name in self.labelnames)
+        except KeyError as e:
+            raise ValueError(f"{self.name} needs the labels {self.labelnames}") from e
+
+    def clear(self):
+        """Forget every recorded value."""
+        with self._lock:
+            self._values.clear()
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        """Return the metric in the Prometheus text format."""
+        lines = [f"# HELP {self.name} {_escape(self.documentation)}",
+                 f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{labels} {_format_value(value)}"
+                  for name, labels, value in self._samples()]
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """
+    A count that only goes up, e.g. of tokens or of cache hits.
+
+    Args:
+        name (str): The metric name, ending in "_total".
+        documentation (str): What is counted.
+        labelnames (tuple[str]): Names of the labels every value is given.
+    """
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        """Add `amount` to the count of `labels`."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        """Return the count of `labels`."""
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values, e.g. of latencies in seconds.
+
+    Args:
+        name (str): The metric name.
+        documentation (str): What is observed.
+        labelnames (tuple[str]): Names of the labels every value is given.
+        buckets (tuple[float]): Increasing upper bounds of the buckets.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        """Record `value` for `labels`."""
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # A count per bucket, then the sum of the values
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent in the `with` block, even if it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        """Return the number of values observed for `labels`."""
+        with self._lock:
+            counts = self._values.get(self._key(labels))
+            return sum(counts[:-1]) if counts else 0
+
+    def sum(self, **labels):
+        """Return the sum of the values observed for `labels`."""
+        with self._lock:
+            counts = self._values.get(self._key(labels))
+            return counts[-1] if counts else 0.0
+
+    def _samples(self):
+        with self._lock:
+            values = sorted((key, list(counts)) for key, counts in self._values.items())
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield (f"{self.name}_bucket",
+                       _format_labels(self.labelnames, key, [("le", _format_value(bound))]),
+                       cumulative)
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum", labels, counts[-1]
+            yield f"{self.name}_count", labels, cumulative
+
+
+def render():
+    """
+    Return every metric of this process in the Prometheus text format.
+
+    Returns:
+        str: The exposition, to be served with `CONTENT_TYPE`.
+    """
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, address=""):
+    """
+    Serve the metrics of this process over HTTP on a daemon thread.
+
+    For processes without a web server, such as the ingestion worker.
+
+    Args:
+        port (int): The port to listen on, 0 for any free port.
+        address (str): The address to listen on, all by default.
+
+    Returns:
+        ThreadingHTTPServer: The running server.
+    """
+    server = ThreadingHTTPServer((address, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+# Ingestion: fetching or rendering pages, reading the PDFs, splitting,
+# embedding and upserting chunks, storing them, and whole jobs
+INGESTION_STAGE_SECONDS = Histogram(
+    "djangolangchain_ingestion_stage_seconds",
+    "Seconds spent in each stage of document ingestion.",
+    ["stage"]
+)
+DOCUMENT_CHUNKS = Histogram(
+    "djangolangchain_document_chunks",
+    "Number of chunks of each indexed document.",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+)
+
+# Chat: answer cache lookup, chain setup, retrieval, the model's first token
+# and whole answer, summarizing the conversation, and whole requests
+CHAT_STAGE_SECONDS = Histogram(
+    "djangolangchain_chat_stage_seconds",
+    "Seconds spent in each stage of answering a chat question.",
+    ["stage"]
+)
+
+TOKENS = Counter(
+    "djangolangchain_tokens_total",
+    "Tokens sent to and generated by the OpenAI models.",
+    ["kind"]   # "prompt", "completion" or "embedding"
+)
+CACHE_REQUESTS = Counter(
+    "djangolangchain_cache_requests_total",
+    "Lookups of the in-process caches and whether they were hits.",
+    ["cache", "result"]
+)
+ADMISSION_REJECTIONS = Counter(
+    "djangolangchain_admission_rejections_total",
+    "Requests rejected with a 429 by admission control.",
+    ["kind", "reason"]   # reason: "rate", "queue_full" or "timeout"
+)
+ADMISSION_WAIT_SECONDS = Histogram(
+    "djangolangchain_admission_wait_seconds",
+    "Seconds requests waited for a slot to call OpenAI.",
+    ["kind"]
+)
@@ -1,7 +1,84 @@
-import os
 from django.db import models
 from django.contrib.auth.models import User
-from .chat.pinecone.vector_store import pinecone_index
+from django.utils import timezone
+
+
+class IndexedSource(models.Model):
+    """
+    Represents a rendered and indexed web page.
+
+    Every PdfFile uploaded from the same URL, or whose page has the same
+    content, shares a single IndexedSource and thus a single set of vectors.
+    Its vectors and PDF file are removed in the background (see
+    `CleanupJob`) once the last PdfFile referencing it is deleted.
+
+    Attributes:
+        source_id (uuid.UUID): The ID stored as `pdf_id` in the metadata of
+            the vectors and used as the name of the PDF file.
+        url (str): The URL the page was fetched from.
+        normalized_url (str): The normalized URL used to find the source.
+        content_hash (str): SHA-256 hash of the page's text.
+        title (str): Title of the page.
+        page_count (int): Number of pages of the PDF indexed, 0 for a web
+            page indexed from its HTML.
+        chunk_count (int): Number of chunks (and vectors) indexed.
+        pinecone_id_list (list[str]): List of vector IDs of the page, only
+            used by sources indexed before their chunks were stored as
+            `Chunk` rows.
+        ref_count (int): Number of PdfFile objects referencing the source.
+        fetched_at (datetime.datetime): When the page was last fetched.
+    """
+    source_id = models.UUIDField(primary_key=True, editable=False)
+    url = models.URLField(max_length=2048)
+    normalized_url = models.CharField(max_length=2048, db_index=True)
+    content_hash = models.CharField(max_length=64, db_index=True)
+    title = models.CharField(max_length=512, blank=True)
+    page_count = models.PositiveIntegerField(default=0)
+    chunk_count = models.PositiveIntegerField(default=0)
+    pinecone_id_list = models.JSONField(default=list)
+    ref_count = models.PositiveIntegerField(default=0)
+    fetched_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self) -> str:
+        return f"IndexedSource({self.normalized_url}, refs={self.ref_count})"
+
+
+class Chunk(models.Model):
+    """
+    Represents a chunk of an indexed page, embedded as a single vector.
+
+    The text of a chunk is stored here rather than in the metadata of its
+    vector, which only holds the `pdf_id` and page, and is looked up by
+    vector ID after a search (see `VectorBackendRetriever`). Chunks belong
+    to an index, which documents sharing an IndexedSource share.
+
+    Attributes:
+        index_id (uuid.UUID): The `pdf_id` the vector is stored under, see
+            `PdfFile.index_id`.
+        ordinal (int): Position of the chunk in the document.
+        page (int | None): Page of the document the chunk is from, None for
+            a web page indexed from its HTML.
+        vector_id (str): ID of the chunk's vector.
+        text (str): The text of the chunk.
+        text_hash (str): SHA-256 hash of the text.
+        token_count (int): Number of tokens of the text.
+    """
+    index_id = models.UUIDField()
+    ordinal = models.PositiveIntegerField()
+    page = models.PositiveIntegerField(null=True)
+    vector_id = models.CharField(max_length=64, unique=True)
+    text = models.TextField()
+    text_hash = models.CharField(max_length=64, db_index=True)
+    token_count = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["index_id", "ordinal"], name="unique_chunk_ordinal")
+        ]
+
+    def __str__(self) -> str:
+        return f"Chunk({self.index_id}, {self.ordinal})"
+
 
 class PdfFile(models.Model):
     """
@@ -10,35 +87,65 @@ class PdfFile(models.Model):
     Attributes:
         user (django.contrib.auth.models.User): The user who uploaded the PDF.
         pdf_id (uuid.UUID): The unique ID of the PDF file.
-        pinecone_id_list (list[str]): List of vector IDs associated with this PDF.
+        pinecone_id_list (list[str]): List of vector IDs associated with this
+            PDF, only used by documents indexed before sources were shared.
+        status (str): Ingestion status of the PDF, see `PdfFile.Status`.
+        source (IndexedSource): The indexed page this PDF shares, if any.
+        url (str): The URL the document was uploaded from.
+        title (str): Title of the page, once indexed.
+        page_count (int): Number of pages indexed.
+        chunk_count (int): Number of chunks indexed.
+        created_at (datetime.datetime): When the document was uploaded.
+
+    The listing details are copied from the source when the document is
+    indexed, so that listing documents reads a single table, along the
+    (user, created_at) index.
     """
+    class Status(models.TextChoices):
+        QUEUED = "queued", "Queued"
+        FETCHING = "fetching", "Fetching"
+        RENDERING = "rendering", "Rendering"
+        EMBEDDING = "embedding", "Embedding"
+        INDEXED = "indexed", "Indexed"
+        FAILED = "failed", "Failed"
+
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     pdf_id = models.UUIDField(primary_key=True, editable=False)
     # List of vector ids associated with this pdf file
     pinecone_id_list = models.JSONField(default=list)
-    
-    
-    def delete(self, *args, **kwargs):
-        """
-        Delete this PDF file from the database and local storage.
+    # Documents created outside of the ingestion pipeline are already indexed
+    status = models.CharField(max_length=16, choices=Status.choices,
+                              default=Status.INDEXED)
+    source = models.ForeignKey(IndexedSource, on_delete=models.PROTECT,
+                               null=True, blank=True, related_name="pdf_files")
+    url = models.URLField(max_length=2048, blank=True)
+    title = models.CharField(max_length=512, blank=True)
+    page_count = models.PositiveIntegerField(default=0)
+    chunk_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
 
-        This method deletes this PDF file from the Pinecone vector store,
-        deletes the PDF file from local storage, and then deletes this
-        object from the Django database.
+    class Meta:
+        indexes = [
+            # Keyset pagination of a user's documents, newest first
+            models.Index(fields=["user", "-created_at", "-pdf_id"],
+                         name="pdffile_user_created_idx")
+        ]
 
-        Args:
-            *args: Positional arguments to pass to the super method.
-            **kwargs: Keyword arguments to pass to the super method.
-        """
+    @property
+    def index_id(self):
+        """The `pdf_id` the vectors of this PDF are stored under."""
+        return self.source_id or self.pdf_id
 
-        pinecone_index.delete(ids=self.pinecone_id_list)
-        
-        pdf_path = f"pdfs/{self.pdf_id}.pdf"
-        if os.path.exists(pdf_path):
-            os.remove(pdf_path)
+    @property
+    def pdf_path(self):
+        """
+        Path of the rendered PDF file on local storage.
 
-        # Delete this object from the Django db
-        super().delete(*args, **kwargs)
+        Documents indexed from the text of their page only have a PDF once
+        it has been rendered by `rendering.ensure_pdf`.
+        """
+        return f"pdfs/{self.index_id}.pdf"
+    
     
     def __str__(self) -> str:
         """
@@ -49,3 +156,141 @@ class PdfFile(models.Model):
         """
         print("PdfFile: ", self.user, self.pdf_id)
         return super().__str__()
+
+
+class IngestionJob(models.Model):
+    """
+    Represents a queued request to render, embed and index a web page.
+
+    Jobs are picked up by the `run_worker` management command. Failed jobs
+    are retried with exponential backoff until `INGESTION_MAX_ATTEMPTS` is
+    reached.
+
+    Attributes:
+        pdf (PdfFile): The document the job produces.
+        url (str): The URL of the web page to ingest.
+        status (str): State of the job, see `IngestionJob.Status`.
+        attempts (int): Number of times the job has been started.
+        next_attempt_at (datetime.datetime): Earliest time the job may run.
+        last_error (str): Error message of the last failed attempt.
+    """
+    class Status(models.TextChoices):
+        QUEUED = "queued", "Queued"
+        RUNNING = "running", "Running"
+        DONE = "done", "Done"
+        FAILED = "failed", "Failed"
+
+    pdf = models.OneToOneField(PdfFile, on_delete=models.CASCADE,
+                               related_name="ingestion_job")
+    url = models.URLField(max_length=2048)
+    status = models.CharField(max_length=16, choices=Status.choices,
+                              default=Status.QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "next_attempt_at"])]
+
+    def __str__(self) -> str:
+        return f"IngestionJob({self.pdf_id}, {self.status})"
+
+
+class CleanupJob(models.Model):
+    """
+    Represents the pending removal of the index of deleted documents.
+
+    Deleting a document, directly, in bulk or by cascade from its user,
+    only records a job (see `deletion.py`). Its vectors, keyword index and
+    PDF file are then removed by the `run_worker` command, retrying with
+    exponential backoff until `CLEANUP_MAX_ATTEMPTS` is reached.
+
+    Attributes:
+        index_id (uuid.UUID): The `pdf_id` the vectors are stored under.
+        vector_ids (list[str]): IDs of vectors to delete that aren't
+            stored as `Chunk` rows of the index.
+        status (str): State of the job, see `CleanupJob.Status`.
+        attempts (int): Number of times the job has been started.
+        next_attempt_at (datetime.datetime): Earliest time the job may run.
+        last_error (str): Error message of the last failed attempt.
+    """
+    class Status(models.TextChoices):
+        QUEUED = "queued", "Queued"
+        RUNNING = "running", "Running"
+        FAILED = "failed", "Failed"
+
+    index_id = models.UUIDField()
+    vector_ids = models.JSONField(default=list)
+    status = models.CharField(max_length=16, choices=Status.choices,
+                              default=Status.QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "next_attempt_at"])]
+
+    def __str__(self) -> str:
+        return f"CleanupJob({self.index_id}, {self.status})"
+
+
+class Conversation(models.Model):
+    """
+    Represents a user's chat session about a document.
+
+    Only the most recent messages are sent to the model verbatim, older ones
+    are compacted into a rolling `summary` (see `conversations.py`).
+
+    Attributes:
+        user (django.contrib.auth.models.User): The user chatting.
+        pdf (PdfFile): The document the conversation is about.
+        summary (str): Summary of the messages up to `summarized_until`.
+        summary_tokens (int): Number of tokens of the summary.
+        summarized_until (int): Primary key of the last message folded into
+            the summary, 0 if none.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    pdf = models.ForeignKey(PdfFile, on_delete=models.CASCADE,
+                            related_name="conversations")
+    summary = models.TextField(blank=True)
+    summary_tokens = models.PositiveIntegerField(default=0)
+    summarized_until = models.PositiveBigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "pdf"], name="unique_conversation_per_document")
+        ]
+
+    def __str__(self) -> str:
+        return f"Conversation({self.user_id}, {self.pdf_id})"
+
+
+class Message(models.Model):
+    """
+    Represents a single question or answer of a conversation.
+
+    Attributes:
+        conversation (Conversation): The conversation the message belongs to.
+        role (str): Who wrote the message, see `Message.Role`.
+        content (str): The text of the message.
+        token_count (int): Number of tokens of the content.
+    """
+    class Role(models.TextChoices):
+        USER = "user", "User"
+        AI = "ai", "AI"
+
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE,
+                                     related_name="messages")
+    role = models.CharField(max_length=8, choices=Role.choices)
+    content = models.TextField()
+    token_count = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self) -> str:
+        return f"Message({self.conversation_id}, {self.role})"
@@ -0,0 +1,87 @@
+import logging
+import os
+import tempfile
+import threading
+from django.conf import settings
+import pdfkit
+
+
+logger = logging.getLogger(__name__)
+
+# Rendering slots of this process, created on first use, and one lock per
+# PDF being rendered so concurrent views of a document render it only once
+_lock = threading.Lock()
+_slots = None
+_rendering = {}
+
+
+class RenderError(Exception):
+    """Raised when a document has no PDF and none can be rendered."""
+
+
+def _render_slots():
+    global _slots
+    if _slots is None:
+        with _lock:
+            if _slots is None:
+                _slots = threading.BoundedSemaphore(settings.PDF_RENDER_CONCURRENCY)
+    return _slots
+
+
+def _document_url(pdf):
+    """Return the URL the PDF of `pdf` can be rendered from, if known."""
+    if pdf.source_id is not None:
+        return pdf.source.url
+    job = getattr(pdf, "ingestion_job", None)
+    return job.url if job is not None else None
+
+
+def ensure_pdf(pdf):
+    """
+    Return the path of a document's PDF, rendering it first if needed.
+
+    Documents indexed from the text of their page have no PDF until it is
+    first viewed. At most `PDF_RENDER_CONCURRENCY` PDFs are rendered at once
+    per process, and concurrent requests for the same PDF share a single
+    rendering. The file is written under a temporary name and renamed into
+    place, so a partially rendered PDF is never served.
+
+    Args:
+        pdf (PdfFile): The document, with its `source` and `ingestion_job`.
+
+    Returns:
+        str: The path of the PDF file.
+
+    Raises:
+        RenderError: If the PDF doesn't exist and can't be rendered.
+    """
+    path = pdf.pdf_path
+    if os.path.exists(path):
+        return path
+
+    url = _document_url(pdf)
+    if url is None:
+        raise RenderError(f"No PDF nor URL for document {pdf.pdf_id}")
+
+    with _lock:
+        lock = _rendering.setdefault(path, threading.Lock())
+    try:
+        with lock:
+            if os.path.exists(path):
+                return path
+            with _render_slots():
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                file, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".pdf")
+                os.close(file)
+                try:
+                    pdfkit.from_url(url, temp_path)
+                    os.replace(temp_path, path)
+                except Exception as e:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                    logger.exception("Failed to render %s", url)
+                    raise RenderError(f"Failed to render {url}") from e
+    finally:
+        with _lock:
+            _rendering.pop(path, None)
+    return path
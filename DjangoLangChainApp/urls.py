@@ -7,8 +7,15 @@ urlpatterns = [
     path('accounts/login/', user_login, name='user_login'),
     path('accounts/logout/', user_logout, name='user_logout'),
     path('documents/upload/', upload_link, name='upload_link'),
+    path('documents/upload/bulk/', bulk_upload, name='bulk_upload'),
     path('documents/list/', list_documents, name='list_documents'),
+    path('documents/list/json/', list_documents_json, name='list_documents_json'),
     path('documents/view/<uuid:pdf_id>/', view_document, name='view_document'),
+    path('documents/pdf/<uuid:pdf_id>/', document_pdf, name='document_pdf'),
     path('documents/delete/<uuid:pdf_id>/', delete_document, name='delete_document'),
+    path('documents/delete/bulk/', bulk_delete, name='bulk_delete'),
+    path('documents/chat/', chat_documents, name='chat_documents'),
     path('documents/chat/<uuid:pdf_id>/', chat_view, name='chat_view'),
+    path('documents/chat/<uuid:pdf_id>/stream/', chat_stream, name='chat_stream'),
+    path('metrics', metrics, name='metrics'),
 ]
\ No newline at end of file
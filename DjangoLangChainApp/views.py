@@ -1,14 +1,32 @@
+from asgiref.sync import sync_to_async
 from django.shortcuts import render, redirect, HttpResponse
+from django.conf import settings
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.views.decorators.http import require_POST
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.decorators import login_required
 from django.db.utils import IntegrityError
 from django.contrib.auth.forms import AuthenticationForm, UserCreationForm
-from .forms import LinkUploadForm, QueryForm
-from .chat.pinecone.vector_store import add_documents_from_pdf
+from DjangoLangChainProject.database import closing_old_connections
+from .forms import DocumentsQueryForm, LinkUploadForm, QueryForm
 from .models import PdfFile
-from .chat.model.chat import build_chat
-from pinecone import PineconeApiException
-import validators, pdfkit, uuid
+from .ingestion import enqueue_ingestion, enqueue_ingestions, parse_url_list
+from .rendering import RenderError, ensure_pdf
+from .file_serving import file_response
+from .listing import InvalidCursor, list_page
+from .conversations import aload_conversation, chat_history, arecord_turn, acompact
+from .decorators import admission_control, async_login_required
+from .metrics import CHAT_STAGE_SECONDS, CONTENT_TYPE, INGESTION_STAGE_SECONDS, \
+    render as render_metrics
+from .chat.model.chat import abuild_chat
+from .chat.model.answer_cache import CachedAnswer, alookup_answer, remember_answer
+import validators, json, uuid, hmac, time
+
+
+# Templates read the (lazily loaded) user through the auth context
+# processor, so async views render them on a thread.
+arender = sync_to_async(render)
 
 
 def index(request):
@@ -141,8 +159,9 @@ def user_logout(requset):
     return render(requset, template_name='index.html')
 
 
-@login_required
-def upload_link(request):
+@async_login_required
+@admission_control("upload")
+async def upload_link(request):
     """
     View function for handling link upload form.
 
@@ -152,71 +171,152 @@ def upload_link(request):
     If the request method is POST, then handle the form data.
     """
     if request.method == "GET":
-        return render(request=request, 
-                      template_name='upload_link.html',
-                      context={'form': LinkUploadForm()})
+        return await arender(request=request, 
+                             template_name='upload_link.html',
+                             context={'form': LinkUploadForm()})
     
     if request.method == "POST":
         form = LinkUploadForm(request.POST)
         """
         Handle form data if form is valid.
 
-        If the URL is valid, then convert the URL to a PDF, save the PDF to
-        disk, add the PDF document to Pinecone, and save the PDF entry to the
-        Django db.
+        If the URL is valid, then queue the document for ingestion and
+        redirect the user to the list of documents, where its status is
+        shown. Rendering, embedding and indexing run in the background
+        worker (`python manage.py run_worker`).
 
         If the URL is invalid, then render the upload_link.html template with
         an error message.
         """
         if form.is_valid():
             if validators.url(form.cleaned_data['url']):
-                pdf_id = uuid.uuid4()
-                pdfkit.from_url(form.cleaned_data['url'], f"pdfs/{pdf_id}.pdf")
-                # Add document to Pinecone
-                pinecone_id_list = add_documents_from_pdf(
-                    pdf_path=f"pdfs/{pdf_id}.pdf",
-                    pdf_id=pdf_id
-                )
-                
-                if not pinecone_id_list:
-                    return render(request=request, 
-                                  template_name='upload_link.html',
-                                  context={'form': form, 
-                                           'error': 'Failed to add document to Pinecone'})
-                
-                
-                # Add document to Django db
-                pdf_file = PdfFile.objects.create(
-                    user=request.user,
-                    pdf_id=pdf_id,
-                    pinecone_id_list = pinecone_id_list
-                )
-                pdf_file.save()
+                user = await request.auser()
+                with INGESTION_STAGE_SECONDS.time(stage="enqueue"):
+                    await sync_to_async(enqueue_ingestion)(user, form.cleaned_data['url'])
                 
             else:
-                return render(request=request, 
-                              template_name='upload_link.html',
-                              context={'form': form, 'error': 'Invalid URL'})
+                return await arender(request=request, 
+                                     template_name='upload_link.html',
+                                     context={'form': form, 'error': 'Invalid URL'})
             
         else:
-            return render(request=request, 
-                          template_name='upload_link.html',
-                          context={'form': form, "errors": form.errors})
+            return await arender(request=request, 
+                                 template_name='upload_link.html',
+                                 context={'form': form, "errors": form.errors})
         
-        return redirect('index')
+        return redirect('list_documents')
+
+
+def _url_count(request):
+    """Return the number of URLs of a bulk upload, the upload tokens it takes."""
+    try:
+        return max(len(parse_url_list(request.body.decode())), 1)
+    except (ValueError, UnicodeDecodeError):
+        return 1
+
+
+@async_login_required
+@require_POST
+@admission_control("upload", cost=_url_count)
+async def bulk_upload(request):
+    """
+    View function queueing the ingestion of many URLs at once.
+
+    The body is a JSON list of URLs, a JSON object with the list under
+    "urls", or one URL per line. Valid URLs are queued with bulk inserts
+    and ingested by the background worker, whose progress shows in the
+    status of each document. Each URL takes an upload token, at most a
+    full bucket.
+
+    Args:
+        request (django.http.HttpRequest): The request object.
+
+    Returns:
+        JsonResponse: The number of queued and rejected URLs and, for each
+            URL in order, its document ID or why it was rejected.
+    """
+    try:
+        urls = parse_url_list(request.body.decode())
+    except (ValueError, UnicodeDecodeError) as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    if len(urls) > settings.BULK_UPLOAD_MAX_URLS:
+        return JsonResponse({"error": f"At most {settings.BULK_UPLOAD_MAX_URLS} URLs "
+                                      f"per request"}, status=413)
+
+    is_valid = [bool(validators.url(url)) for url in urls]
+    valid = [url for url, ok in zip(urls, is_valid) if ok]
+    user = await request.auser()
+    pdf_files = iter(await sync_to_async(enqueue_ingestions)(user, valid))
+    results = []
+    for url, ok in zip(urls, is_valid):
+        if ok:
+            results.append({"url": url, "pdf_id": str(next(pdf_files).pdf_id),
+                            "status": "queued"})
+        else:
+            results.append({"url": url, "error": "Invalid URL"})
+    return JsonResponse({"queued": len(valid), "rejected": len(urls) - len(valid),
+                         "results": results}, status=202)
+
 
 @login_required
 def list_documents(request):
     """View function for listing documents.
 
+    Documents are listed newest first, `DOCUMENTS_PAGE_SIZE` per page. The
+    page after the first one is selected by the `cursor` GET parameter,
+    see `listing.list_page`.
+
     Returns:
-        Rendered template with a list of PDF documents associated with
+        Rendered template with a page of PDF documents associated with
         the currently logged in user.
     """
-    pdfs = PdfFile.objects.filter(user=request.user)
+    try:
+        pdfs, next_cursor = list_page(request.user, request.GET.get("cursor"))
+    except InvalidCursor:
+        return HttpResponse("Invalid cursor", status=400)
     return render(request,
                   template_name='list_documents.html',
-                  context={'pdfs': pdfs})
+                  context={'pdfs': pdfs, 'next_cursor': next_cursor})
+
+
+@login_required
+def list_documents_json(request):
+    """View function listing documents as JSON.
+
+    Like `list_documents`, with the number of documents per page given by
+    the `limit` GET parameter, up to `DOCUMENTS_MAX_PAGE_SIZE`.
+
+    Args:
+        request (django.http.HttpRequest): The request object.
+
+    Returns:
+        JsonResponse: The documents of the page and the URL of the next
+            page, null on the last page.
+    """
+    try:
+        limit = int(request.GET.get("limit", settings.DOCUMENTS_PAGE_SIZE))
+        pdfs, next_cursor = list_page(request.user, request.GET.get("cursor"),
+                                      min(max(limit, 1), settings.DOCUMENTS_MAX_PAGE_SIZE))
+    except ValueError as e:  # Including InvalidCursor
+        return JsonResponse({"error": str(e)}, status=400)
+
+    next_url = None
+    if next_cursor is not None:
+        query = request.GET.copy()
+        query["cursor"] = next_cursor
+        next_url = f"{reverse('list_documents_json')}?{query.urlencode()}"
+    return JsonResponse({
+        "documents": [{
+            "pdf_id": str(pdf.pdf_id),
+            "url": pdf.url,
+            "title": pdf.title,
+            "status": pdf.status,
+            "page_count": pdf.page_count,
+            "chunk_count": pdf.chunk_count,
+            "created_at": pdf.created_at.isoformat(),
+        } for pdf in pdfs],
+        "next": next_url,
+    })
 
 
 
@@ -234,7 +334,7 @@ def view_document(request, pdf_id):
         Rendered template with a single PDF document.
     """
     try:
-        pdf = PdfFile.objects.get(user=request.user, pdf_id=pdf_id)
+        pdf = PdfFile.objects.defer("pinecone_id_list").get(user=request.user, pdf_id=pdf_id)
         return render(request,
                       template_name='view_document.html',
                       context={'pdf': pdf})
@@ -242,6 +342,38 @@ def view_document(request, pdf_id):
         return HttpResponse('Document not found')
 
 
+@async_login_required
+async def document_pdf(request, pdf_id):
+    """View function serving the PDF file of a document.
+
+    Only the owner of the document can read it. Documents indexed from the
+    text of their page are rendered to PDF on the first request, on a worker
+    thread so the event loop isn't blocked. Range and conditional requests
+    are answered, see `file_serving.file_response`.
+
+    Args:
+        request (django.http.HttpRequest): The request object.
+
+    Returns:
+        HttpResponse: The PDF file, part of it, or a 304 response.
+    """
+    user = await request.auser()
+    pdf = await PdfFile.objects.filter(user=user, pdf_id=pdf_id) \
+        .select_related("source", "ingestion_job") \
+        .defer("pinecone_id_list", "source__pinecone_id_list").afirst()
+    if pdf is None:
+        raise Http404("Document not found")
+
+    @closing_old_connections
+    def respond():
+        return file_response(request, ensure_pdf(pdf), "application/pdf")
+
+    try:
+        return await sync_to_async(respond, thread_sensitive=False)()
+    except RenderError:
+        return HttpResponse("Failed to render document", status=502)
+
+
 @login_required
 def delete_document(request, pdf_id):
     """Delete the PDF document associated with the provided pdf_id.
@@ -259,7 +391,8 @@ def delete_document(request, pdf_id):
     try:
         pdf = PdfFile.objects.get(user=request.user, pdf_id=pdf_id)
 
-        # Delete the PDF document from the Django db and file system
+        # Delete the PDF document from the Django db, its vectors and file
+        # are removed in the background by the worker
         pdf.delete()    
 
         # Redirect the user to the list of documents view
@@ -267,51 +400,345 @@ def delete_document(request, pdf_id):
     
     except PdfFile.DoesNotExist:
         return HttpResponse('Document not found')
-    
-    except PineconeApiException:
-            return HttpResponse('Failed to delete document from Pinecone')
-        
-    except FileNotFoundError:
-        return HttpResponse('Failed to delete document from file system')
+
 
 @login_required
-def chat_view(request, pdf_id):
+@require_POST
+def bulk_delete(request):
+    """
+    View function deleting many of the user's documents at once.
+
+    The body is a JSON list of document IDs, or a JSON object with the list
+    under "pdf_ids". The documents are deleted with a single queryset
+    delete, their vectors and files are removed in the background.
+
+    Args:
+        request (django.http.HttpRequest): The request object.
+
+    Returns:
+        JsonResponse: The number of deleted documents.
+    """
+    try:
+        pdf_ids = json.loads(request.body)
+        if isinstance(pdf_ids, dict):
+            pdf_ids = pdf_ids.get("pdf_ids")
+        if not isinstance(pdf_ids, list):
+            raise ValueError("Expected a list of document IDs")
+        pdf_ids = [uuid.UUID(str(pdf_id)) for pdf_id in pdf_ids]
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    _, by_model = PdfFile.objects.filter(user=request.user, pdf_id__in=pdf_ids).delete()
+    return JsonResponse({"deleted": by_model.get(PdfFile._meta.label, 0)})
+
+@async_login_required
+@admission_control("chat", in_flight=True)
+async def chat_view(request, pdf_id):
     """View function for handling chat view GET and POST requests.
 
     If the request method is GET, then render the chat_view.html template
-    with an empty form.
+    with an empty form and the recent turns of the user's conversation about
+    the document.
 
-    If the request method is POST, then handle the form data.
+    If the request method is POST, then handle the form data. The question
+    is answered with the conversation's history and added to it.
     """
-    pdf_path = f"pdfs/{pdf_id}.pdf"
-    
-    if not PdfFile.objects.filter(user=request.user, pdf_id=pdf_id).exists():
+    user = await request.auser()
+    pdf = await PdfFile.objects.filter(user=user, pdf_id=pdf_id) \
+        .only("pdf_id", "source_id").afirst()
+    if pdf is None:
         return HttpResponse("Document not found")
+    pdf_path = reverse("document_pdf", args=[pdf_id])
+    conversation = await aload_conversation(user, pdf)
     
     if request.method == "GET":
         
-        return render(
+        return await arender(
             request, 
             template_name='chat_view.html', 
-            context={"pdf_path": pdf_path, "form": QueryForm()})
+            context={"pdf_path": pdf_path, "pdf_id": pdf_id, "form": QueryForm(),
+                     "llm_response": _transcript(conversation),
+                     "summary": conversation.summary})
 
     if request.method == "POST":
+        started = time.perf_counter()
         form = QueryForm(request.POST)
 
-        # Invoke the chat LLM and get the response
-        llm_response = [request.POST.get('querry')]
+        # Invoke the chat LLM (unless the question was answered before) and
+        # get the response
+        llm_response = _transcript(conversation) + [request.POST.get('querry')]
+        cached = False
         if form.is_valid():
-            chat = build_chat(pdf_id)
-            reply = chat.invoke({"input": form.cleaned_data['querry']})
-            llm_response.append(reply["answer"])
+            question = form.cleaned_data['querry']
+            history = chat_history(conversation)
+            answer, embedding = await _lookup_answer(pdf, question, history)
+            cached = answer is not None
+            if not cached:
+                chat = await _abuild_chat(pdf)
+                reply = await chat.ainvoke({"input": question, "chat_history": history})
+                answer = CachedAnswer(reply["answer"], _pages(reply.get("context", [])))
+                if not history:
+                    remember_answer(pdf.index_id, question, answer, embedding)
+            llm_response.append(answer.answer)
+
+            await arecord_turn(conversation, question, answer.answer)
+            await _acompact(conversation)
+            CHAT_STAGE_SECONDS.observe(time.perf_counter() - started, stage="total")
 
         # Render the chat_view.html template with the form and response
-        return render(request=request,
-                      template_name="chat_view.html", 
-                      context={"pdf_path": pdf_path, 
-                               "form": form, 
-                               "llm_response": llm_response})
+        response = await arender(request=request,
+                                 template_name="chat_view.html", 
+                                 context={"pdf_path": pdf_path, 
+                                          "pdf_id": pdf_id,
+                                          "form": form, 
+                                          "llm_response": llm_response,
+                                          "summary": conversation.summary,
+                                          "cached": cached})
+        response["X-Answer-Cache"] = "hit" if cached else "miss"
+        return response
+
+
+def _transcript(conversation):
+    """Return the questions and answers of the conversation's recent turns."""
+    return [message.content for message in conversation.recent]
 
 
+async def _lookup_answer(pdf, question, history):
+    """
+    Look up the cached answer to `question`, see `alookup_answer`.
+
+    Answers to follow-up questions depend on the conversation, so only
+    questions asked without any history are looked up.
+    """
+    if history:
+        return None, None
+    with CHAT_STAGE_SECONDS.time(stage="answer_cache"):
+        return await alookup_answer(pdf.index_id, question)
+
+
+async def _abuild_chat(pdf):
+    """Return the chain answering questions about `pdf`, see `abuild_chat`."""
+    with CHAT_STAGE_SECONDS.time(stage="build_chat"):
+        return await abuild_chat(pdf.index_id)
+
+
+async def _acompact(conversation):
+    """Summarize the older turns of `conversation`, see `acompact`."""
+    with CHAT_STAGE_SECONDS.time(stage="summary"):
+        await acompact(conversation)
 
 
+def _pages(docs):
+    """Return the sorted pages the retrieved `docs` come from, if they have any."""
+    return sorted({doc.metadata["page"] for doc in docs if doc.metadata.get("page") is not None})
+
+
+def _sse_event(event, data):
+    """Format a single Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _stream_answer(chain, conversation, question, history, embedding=None):
+    """
+    Yield the chain's reply to `question` as Server-Sent Events.
+
+    The retrieved source pages are sent first as a `sources` event, followed
+    by one `token` event per answer chunk and a final `done` event. Complete
+    answers are added to the conversation (and to the answer cache if the
+    question was asked without any history).
+    """
+    tokens, pages = [], []
+    try:
+        async for chunk in chain.astream({"input": question, "chat_history": history}):
+            if "context" in chunk:
+                pages = _pages(chunk["context"])
+                yield _sse_event("sources", {"pages": pages})
+            if "answer" in chunk:
+                tokens.append(chunk["answer"])
+                yield _sse_event("token", {"text": chunk["answer"]})
+    except Exception:
+        yield _sse_event("error", {"message": "Failed to generate an answer"})
+        raise
+    answer = CachedAnswer("".join(tokens), pages)
+    if not history:
+        remember_answer(conversation.pdf.index_id, question, answer, embedding)
+    await arecord_turn(conversation, question, answer.answer)
+    yield _sse_event("done", {"cached": False})
+    # The answer has been sent, summarize older turns before closing
+    await _acompact(conversation)
+
+
+async def _replay_answer(conversation, question, answer):
+    """Yield a cached answer as the same events `_stream_answer` sends."""
+    await arecord_turn(conversation, question, answer.answer)
+    yield _sse_event("sources", {"pages": answer.pages})
+    yield _sse_event("token", {"text": answer.answer})
+    yield _sse_event("done", {"cached": True})
+
+
+async def _timed_events(events, started):
+    """Yield `events`, recording the time since `started` once they're all sent."""
+    try:
+        async for event in events:
+            yield event
+    finally:
+        CHAT_STAGE_SECONDS.observe(time.perf_counter() - started, stage="total")
+
+
+@async_login_required
+@require_POST
+@admission_control("chat", in_flight=True)
+async def chat_stream(request, pdf_id):
+    """View function streaming the chat answer for a document.
+
+    Returns the reply to the posted question as a `text/event-stream`
+    response, so the browser can render the answer token by token instead
+    of waiting for the whole chat_view.html page. Answers found in the
+    answer cache are sent at once, with `cached` set in the `done` event.
+    Like in chat_view, the question is answered with the conversation's
+    history and added to it.
+
+    Args:
+        request (django.http.HttpRequest): The request object.
+        pdf_id (uuid.UUID): The ID of the document to chat with.
+
+    Returns:
+        StreamingHttpResponse: The answer as Server-Sent Events.
+    """
+    started = time.perf_counter()
+    user = await request.auser()
+    pdf = await PdfFile.objects.filter(user=user, pdf_id=pdf_id) \
+        .only("pdf_id", "source_id").afirst()
+    if pdf is None:
+        return HttpResponse("Document not found", status=404)
+
+    form = QueryForm(request.POST)
+    if not form.is_valid():
+        return HttpResponse(json.dumps(form.errors), status=400,
+                            content_type="application/json")
+
+    question = form.cleaned_data['querry']
+    conversation = await aload_conversation(user, pdf)
+    history = chat_history(conversation)
+    answer, embedding = await _lookup_answer(pdf, question, history)
+    if answer is not None:
+        events = _replay_answer(conversation, question, answer)
+    else:
+        chat = await _abuild_chat(pdf)
+        events = _stream_answer(chat, conversation, question, history, embedding)
+
+    response = StreamingHttpResponse(_timed_events(events, started),
+                                     content_type="text/event-stream")
+    # Ask browsers and proxies (e.g. nginx) not to buffer the stream
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    response["X-Answer-Cache"] = "miss" if answer is None else "hit"
+    return response
+
+
+def _sources(docs, titles):
+    """Return the documents and pages the retrieved `docs` come from."""
+    pages = {}
+    for doc in docs:
+        doc_pages = pages.setdefault(doc.metadata.get("pdf_id"), set())
+        if doc.metadata.get("page") is not None:
+            doc_pages.add(doc.metadata["page"])
+    return [{"pdf_id": titles[index_id][0], "title": titles[index_id][1],
+             "pages": sorted(pages[index_id])}
+            for index_id in pages if index_id in titles]
+
+
+def _too_many_documents():
+    """Return the response to a question about too many documents."""
+    return HttpResponse(f"At most {settings.CHAT_DOCUMENTS_MAX_INDEXES} documents "
+                        f"can be asked about at once", status=400)
+
+
+@async_login_required
+@admission_control("chat", in_flight=True)
+async def chat_documents(request):
+    """View function answering a question from several documents at once.
+
+    The question is answered from the documents selected with the
+    `pdf_ids` POST parameter, or from all the user's indexed documents when
+    `scope` is "all", with a single retrieval over all of them and a single
+    call to the model, instead of asking each document in turn. Questions
+    are answered without a conversation history.
+
+    Documents are listed for selection like with `list_documents`, a page
+    at a time. Questions about more than `CHAT_DOCUMENTS_MAX_INDEXES`
+    indexes, the documents of a shared page counting once, are rejected
+    rather than answered from part of them.
+
+    Args:
+        request (django.http.HttpRequest): The request object.
+
+    Returns:
+        Rendered template with the answer and the pages it is based on.
+    """
+    user = await request.auser()
+    try:
+        documents, next_cursor = await sync_to_async(list_page)(
+            user, request.GET.get("cursor"), status=PdfFile.Status.INDEXED)
+    except InvalidCursor:
+        return HttpResponse("Invalid cursor", status=400)
+    context = {"documents": documents, "next_cursor": next_cursor, "form": DocumentsQueryForm()}
+    if request.method != "POST":
+        return await arender(request, template_name="chat_documents.html", context=context)
+
+    started = time.perf_counter()
+    form = context["form"] = DocumentsQueryForm(request.POST)
+    try:
+        selected = {uuid.UUID(pdf_id) for pdf_id in request.POST.getlist("pdf_ids")}
+    except ValueError:
+        return HttpResponse("Invalid document ID", status=400)
+    context["selected"] = {str(pdf_id) for pdf_id in selected}
+    if not form.is_valid():
+        return await arender(request, template_name="chat_documents.html", context=context)
+
+    indexed = PdfFile.objects.filter(user=user, status=PdfFile.Status.INDEXED)
+    if form.cleaned_data["scope"] == "selected":
+        if len(selected) > settings.CHAT_DOCUMENTS_MAX_INDEXES:
+            return _too_many_documents()
+        indexed = indexed.filter(pdf_id__in=selected)
+    # Documents sharing an index are answered from it once
+    titles = {}
+    async for pdf_id, source_id, title, url in indexed.values_list(
+            "pdf_id", "source_id", "title", "url"):
+        titles.setdefault(str(source_id or pdf_id), (pdf_id, title or url))
+        if len(titles) > settings.CHAT_DOCUMENTS_MAX_INDEXES:
+            return _too_many_documents()
+    if not titles:
+        form.add_error(None, "Select at least one indexed document")
+        return await arender(request, template_name="chat_documents.html", context=context)
+
+    with CHAT_STAGE_SECONDS.time(stage="build_chat"):
+        chat = await abuild_chat(frozenset(titles))
+    question = form.cleaned_data["querry"]
+    reply = await chat.ainvoke({"input": question, "chat_history": []})
+    context.update(question=question, answer=reply["answer"],
+                   sources=_sources(reply.get("context", []), titles))
+    CHAT_STAGE_SECONDS.observe(time.perf_counter() - started, stage="total")
+    return await arender(request, template_name="chat_documents.html", context=context)
+
+
+def metrics(request):
+    """
+    View function exporting the metrics of this process for Prometheus.
+
+    Disabled (404) unless `METRICS_ENABLED`. When `METRICS_TOKEN` is set,
+    scrapers must send it as a bearer token.
+
+    Args:
+        request (django.http.HttpRequest): The request object.
+
+    Returns:
+        HttpResponse: The metrics in the Prometheus text format.
+    """
+    if not settings.METRICS_ENABLED:
+        raise Http404("Metrics are disabled")
+    if settings.METRICS_TOKEN:
+        expected = f"Bearer {settings.METRICS_TOKEN}"
+        if not hmac.compare_digest(request.headers.get("Authorization", ""), expected):
+            return HttpResponse("Forbidden", status=403)
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE)
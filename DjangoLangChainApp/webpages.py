@@ -0,0 +1,185 @@
+from html.parser import HTMLParser
+import os
+import re
+from django.conf import settings
+import httpx
+
+
+# Elements whose text is never part of the content
+_SKIPPED = {"script", "style", "noscript", "template", "svg", "iframe", "nav",
+            "aside", "form", "button", "select", "textarea", "title"}
+# Skipped outside of the main content only, e.g. an article's own header
+_CHROME = {"header", "footer"}
+# Elements holding the main content, when the page marks it up
+_MAIN = {"main", "article"}
+_BLOCKS = {"address", "blockquote", "br", "dd", "div", "dl", "dt", "figcaption",
+           "h1", "h2", "h3", "h4", "h5", "h6", "hr", "li", "ol", "p", "pre",
+           "section", "table", "td", "th", "tr", "ul"} | _MAIN | _CHROME
+
+_WHITESPACE = re.compile(r"\s+")
+
+# Approximate number of characters of a printed page. Paragraphs are grouped
+# into sections of about this size to be split into chunks. They don't match
+# the pages of the page rendered as a PDF, so they aren't numbered.
+PAGE_CHARS = 3000
+
+
+class FetchError(Exception):
+    """Raised when a web page could not be fetched."""
+
+
+class _TextExtractor(HTMLParser):
+    """
+    Collects the paragraphs of an HTML document, noting which are main
+    content, and its title.
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.paragraphs = []
+        self.title = ""
+        self._title = []
+        self._text = []
+        self._skipped = []
+        self._main = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _BLOCKS:
+            self._flush()
+        if tag in _SKIPPED or (tag in _CHROME and not self._main):
+            self._skipped.append(tag)
+        elif tag in _MAIN:
+            self._main += 1
+
+    def handle_endtag(self, tag):
+        if tag in _BLOCKS:
+            self._flush()
+        if self._skipped and self._skipped[-1] == tag:
+            self._skipped.pop()
+        elif tag in _MAIN and self._main:
+            self._main -= 1
+
+    def handle_data(self, data):
+        if not self._skipped:
+            self._text.append(data)
+        elif self._skipped == ["title"]:
+            # The document's own title, not e.g. the title of an inline SVG
+            self._title.append(data)
+
+    def _flush(self):
+        text = _WHITESPACE.sub(" ", "".join(self._text)).strip()
+        self._text = []
+        if text:
+            self.paragraphs.append((text, self._main > 0))
+
+    def close(self):
+        super().close()
+        self._flush()
+        self.title = _WHITESPACE.sub(" ", "".join(self._title)).strip()
+
+
+def _parse(html):
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return parser
+
+
+def _main_paragraphs(parser):
+    main = [text for text, in_main in parser.paragraphs if in_main]
+    return main or [text for text, _ in parser.paragraphs]
+
+
+def extract_text(html):
+    """
+    Extract the readable text of an HTML page.
+
+    Scripts, styles, navigation, forms and similar elements are left out.
+    When the page marks up its main content with `<main>` or `<article>`,
+    only that content is kept, dropping headers, footers and sidebars.
+
+    Args:
+        html (str): The HTML of the page.
+
+    Returns:
+        list[str]: The paragraphs of the page, in document order.
+    """
+    return _main_paragraphs(_parse(html))
+
+
+def paginate(paragraphs, page_chars=PAGE_CHARS):
+    """
+    Group paragraphs into sections of about `page_chars` characters.
+
+    Unlike the pages of a PDF, sections have no "page" metadata: where they
+    end up once the page is rendered isn't known, so sources from them are
+    cited without page numbers.
+
+    Args:
+        paragraphs (list[str]): The paragraphs of a page.
+        page_chars (int): Size a section is filled up to.
+
+    Returns:
+        list[Document]: One document per section.
+    """
+    from langchain_core.documents import Document
+
+    pages, current, size = [], [], 0
+    for paragraph in paragraphs:
+        if current and size + len(paragraph) > page_chars:
+            pages.append(current)
+            current, size = [], 0
+        current.append(paragraph)
+        size += len(paragraph) + 2
+    if current:
+        pages.append(current)
+    return [Document(page_content="\n\n".join(page), metadata={}) for page in pages]
+
+
+def fetch_page(url, pdf_path):
+    """
+    Fetch a web page and return its text, without rendering it.
+
+    Responses larger than `HTML_FETCH_MAX_BYTES` are rejected. A URL that
+    serves a PDF file is saved to `pdf_path` instead, for its text to be
+    read from the file.
+
+    Args:
+        url (str): The URL of the page.
+        pdf_path (str): Where to save the response if it is a PDF.
+
+    Returns:
+        list[Document] | None: The sections of text of the page (see
+            `paginate`), with its title in the "title" metadata, or None if
+            the URL served a PDF.
+
+    Raises:
+        FetchError: If the page could not be fetched or has no text.
+    """
+    try:
+        with httpx.Client(follow_redirects=True, timeout=settings.HTML_FETCH_TIMEOUT,
+                          headers={"User-Agent": settings.HTML_FETCH_USER_AGENT}) as client, \
+                client.stream("GET", url) as response:
+            response.raise_for_status()
+            body = bytearray()
+            for chunk in response.iter_bytes():
+                body += chunk
+                if len(body) > settings.HTML_FETCH_MAX_BYTES:
+                    raise FetchError(f"{url} is larger than {settings.HTML_FETCH_MAX_BYTES} bytes")
+            content_type = response.headers.get("Content-Type", "")
+            encoding = response.encoding
+    except httpx.HTTPError as e:
+        raise FetchError(f"Failed to fetch {url}: {e}") from e
+
+    if content_type.startswith("application/pdf"):
+        os.makedirs(os.path.dirname(pdf_path) or ".", exist_ok=True)
+        with open(pdf_path, "wb") as file:
+            file.write(body)
+        return None
+
+    parser = _parse(body.decode(encoding or "utf-8", errors="replace"))
+    pages = paginate(_main_paragraphs(parser))
+    if not pages:
+        raise FetchError(f"{url} has no text")
+    for page in pages:
+        page.metadata["title"] = parser.title
+    return pages
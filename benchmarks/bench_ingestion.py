@@ -0,0 +1,115 @@
+"""
+Measure embedding + upsert throughput (chunks/sec) of `upsert_documents`.
+
+Runs the batching layer against a local fake embedding model and a fake
+index that sleep for a configurable latency per request, so the effect of
+batch sizes and upsert concurrency can be compared without any network:
+
+    python benchmarks/bench_ingestion.py --chunks 2000 --embed-latency 0.2 \
+        --upsert-latency 0.05 --upsert-concurrency 1 4 8
+"""
+from pathlib import Path
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "DjangoLangChainProject.settings")
+
+import django
+django.setup()
+
+from django.conf import settings
+from django.test.utils import override_settings
+from langchain_core.documents import Document
+from DjangoLangChainApp.chat.pinecone.vector_store import upsert_documents
+
+
+class FakeEmbeddings:
+    """Embedding model answering each request after a fixed latency."""
+    def __init__(self, latency, dimension):
+        self.latency = latency
+        self.dimension = dimension
+
+    def embed_documents(self, texts):
+        time.sleep(self.latency)
+        return [[float(len(text))] * self.dimension for text in texts]
+
+
+class FakeIndex:
+    """Vector index answering each upsert after a fixed latency."""
+    def __init__(self, latency):
+        self.latency = latency
+        self.vectors = {}
+        self.lock = threading.Lock()
+
+    def upsert(self, vectors):
+        time.sleep(self.latency)
+        with self.lock:
+            self.vectors.update((vector["id"], vector) for vector in vectors)
+
+    def delete(self, ids):
+        with self.lock:
+            for vector_id in ids:
+                self.vectors.pop(vector_id, None)
+
+
+def run(args, embed_batch_size, upsert_batch_size, upsert_concurrency):
+    docs = [
+        Document(page_content=f"chunk {i} " + "lorem ipsum " * args.chunk_words,
+                 metadata={"page": i, "pdf_id": "benchmark"})
+        for i in range(args.chunks)
+    ]
+    index = FakeIndex(args.upsert_latency)
+    timings = []
+
+    with override_settings(EMBEDDING_BATCH_SIZE=embed_batch_size,
+                           UPSERT_BATCH_SIZE=upsert_batch_size,
+                           UPSERT_CONCURRENCY=upsert_concurrency):
+        started = time.perf_counter()
+        upsert_documents(docs,
+                         embeddings=FakeEmbeddings(args.embed_latency, args.dimension),
+                         index=index,
+                         on_batch=timings.append)
+        elapsed = time.perf_counter() - started
+
+    assert len(index.vectors) == args.chunks
+    for stage in ("embedding", "upsert"):
+        seconds = sorted(t.seconds for t in timings if t.stage == stage)
+        print(f"    {stage:<9} {len(seconds):>5} batch(es), "
+              f"p50 {seconds[len(seconds) // 2] * 1000:8.1f} ms, "
+              f"max {seconds[-1] * 1000:8.1f} ms")
+    return args.chunks / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=1000)
+    parser.add_argument("--chunk-words", type=int, default=200)
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--embed-latency", type=float, default=0.1,
+                        help="Seconds per embedding request.")
+    parser.add_argument("--upsert-latency", type=float, default=0.05,
+                        help="Seconds per upsert request.")
+    parser.add_argument("--embed-batch-size", type=int, nargs="+",
+                        default=[settings.EMBEDDING_BATCH_SIZE])
+    parser.add_argument("--upsert-batch-size", type=int, nargs="+",
+                        default=[settings.UPSERT_BATCH_SIZE])
+    parser.add_argument("--upsert-concurrency", type=int, nargs="+",
+                        default=[1, settings.UPSERT_CONCURRENCY])
+    args = parser.parse_args()
+
+    for embed_batch_size in args.embed_batch_size:
+        for upsert_batch_size in args.upsert_batch_size:
+            for upsert_concurrency in args.upsert_concurrency:
+                print(f"embed batch {embed_batch_size}, upsert batch "
+                      f"{upsert_batch_size}, upsert concurrency {upsert_concurrency}")
+                rate = run(args, embed_batch_size, upsert_batch_size, upsert_concurrency)
+                print(f"    {rate:,.0f} chunks/sec")
+
+
+if __name__ == "__main__":
+    main()
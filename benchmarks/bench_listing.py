@@ -0,0 +1,113 @@
+"""
+Measure how the document listing scales with the number of documents.
+
+Creates a throwaway test database, gives a user `--documents` documents and
+times querying and rendering a page of the listing:
+
+- "first" is the first page;
+- "keyset" is a page halfway through, reached with its cursor;
+- "offset" is the same page selected with OFFSET, for comparison.
+
+"view" is the whole request of the first page through the test client.
+
+    python benchmarks/bench_listing.py --documents 1000 10000 100000
+"""
+from pathlib import Path
+import argparse
+import os
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "DjangoLangChainProject.settings")
+
+import django
+django.setup()
+
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.shortcuts import render
+from django.test import Client, RequestFactory
+from django.test.utils import setup_test_environment
+from django.urls import reverse
+from django.utils import timezone
+from DjangoLangChainApp.listing import LISTED_FIELDS, encode_cursor, list_page
+from DjangoLangChainApp.models import PdfFile
+
+
+def add_documents(user, count):
+    """Give `user` `count` more documents, one uploaded per second."""
+    start = timezone.now() - timedelta(seconds=PdfFile.objects.count() + count)
+    PdfFile.objects.bulk_create(
+        (PdfFile(user=user, pdf_id=uuid.uuid4(), url=f"https://example.com/{i}",
+                 title=f"Document {i}", page_count=3, chunk_count=12,
+                 pinecone_id_list=[str(uuid.uuid4()) for _ in range(12)],
+                 created_at=start + timedelta(seconds=i))
+         for i in range(count)),
+        batch_size=1000
+    )
+
+
+def timed(func, repeat):
+    """Median seconds of `repeat` calls of `func`."""
+    seconds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - started)
+    return statistics.median(seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        user = User.objects.create_user(username="benchmark", password="benchmark")
+        client = Client()
+        client.force_login(user)
+        request = RequestFactory().get("/")
+        request.user = user
+        size = settings.DOCUMENTS_PAGE_SIZE
+        url = reverse("list_documents")
+
+        total = 0
+        for documents in sorted(args.documents):
+            add_documents(user, documents - total)
+            total = documents
+
+            middle = (total // size // 2) * size
+            ordered = PdfFile.objects.filter(user=user).order_by("-created_at", "-pdf_id")
+            cursor = encode_cursor(ordered.only(*LISTED_FIELDS)[middle - 1])
+
+            def keyset_page(cursor=None):
+                pdfs, next_cursor = list_page(user, cursor)
+                render(request, "list_documents.html",
+                       {"pdfs": pdfs, "next_cursor": next_cursor})
+
+            def offset_page():
+                pdfs = list(ordered.only(*LISTED_FIELDS)[middle:middle + size])
+                render(request, "list_documents.html", {"pdfs": pdfs})
+
+            first = timed(keyset_page, args.repeat)
+            keyset = timed(lambda: keyset_page(cursor), args.repeat)
+            offset = timed(offset_page, args.repeat)
+            view = timed(lambda: client.get(url), args.repeat)
+            print(f"{total:>8} documents: first {first * 1000:6.1f}ms, "
+                  f"keyset {keyset * 1000:6.1f}ms, offset {offset * 1000:6.1f}ms "
+                  f"(page {middle // size + 1}), view {view * 1000:6.1f}ms")
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
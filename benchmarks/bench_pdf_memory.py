@@ -0,0 +1,147 @@
+"""
+Measure the peak memory of ingesting a large PDF.
+
+Writes a synthetic PDF of `--pages` text pages, then indexes it in a fresh
+process per pipeline with a fake embedding model (returning vectors of
+`--dimension` floats like the real one) and a fake index:
+
+- "eager" loads and splits every page first (`PyPDFLoader.load_and_split`),
+  as ingestion used to;
+- "streaming" reads, splits, embeds and upserts page by page
+  (`iter_chunks` of `iter_pdf_pages` feeding `upsert_documents`).
+
+    python benchmarks/bench_pdf_memory.py --pages 500 1000 2000
+"""
+from pathlib import Path
+import argparse
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "DjangoLangChainProject.settings")
+
+WORDS = ("invoice order delivery payment quality contract supplier warranty "
+         "schedule volume report standard service customer period amount").split()
+
+
+def write_pdf(path, pages, lines_per_page=50, words_per_line=12):
+    """Write a PDF of `pages` pages of random text in Helvetica."""
+    rng = random.Random(0)
+    page_ids = [4 + 2 * i for i in range(pages)]
+    offsets = []
+
+    with open(path, "wb") as file:
+        def write_object(number, body):
+            offsets.append((number, file.tell()))
+            file.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+
+        file.write(b"%PDF-1.4\n")
+        write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        kids = b" ".join(b"%d 0 R" % page_id for page_id in page_ids)
+        write_object(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, pages))
+        write_object(3, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+        for page_id in page_ids:
+            lines = [" ".join(rng.choice(WORDS) for _ in range(words_per_line))
+                     for _ in range(lines_per_page)]
+            text = b"BT /F1 10 Tf 40 800 Td 14 TL " + b" ".join(
+                b"(%s) '" % line.encode() for line in lines
+            ) + b" ET"
+            write_object(page_id, b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                                  b"/Resources << /Font << /F1 3 0 R >> >> "
+                                  b"/Contents %d 0 R >>" % (page_id + 1))
+            write_object(page_id + 1, b"<< /Length %d >>\nstream\n%s\nendstream"
+                         % (len(text), text))
+
+        xref = file.tell()
+        offsets.sort()
+        file.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(offsets) + 1))
+        for _, offset in offsets:
+            file.write(b"%010d 00000 n \n" % offset)
+        file.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                   % (len(offsets) + 1, xref))
+
+
+class FakeEmbeddings:
+    """Embedding model returning random vectors of `dimension` floats."""
+    def __init__(self, dimension):
+        self.dimension = dimension
+
+    def embed_documents(self, texts):
+        return [[random.random() for _ in range(self.dimension)] for _ in texts]
+
+
+class FakeIndex:
+    """Vector index discarding what is upserted, like a remote one."""
+    def upsert(self, vectors):
+        pass
+
+    def delete(self, ids):
+        pass
+
+
+def run(mode, pdf_path, dimension):
+    """Index `pdf_path` with the `mode` pipeline and print chunks, seconds and peak RSS."""
+    import django
+    django.setup()
+
+    from langchain_community.document_loaders.pdf import PyPDFLoader
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    from DjangoLangChainApp.chat.pinecone.vector_store import (
+        iter_chunks, iter_pdf_pages, upsert_documents
+    )
+
+    started = time.perf_counter()
+    pdf_id = uuid.uuid4()
+    if mode == "eager":
+        docs = PyPDFLoader(pdf_path).load_and_split(
+            RecursiveCharacterTextSplitter.from_tiktoken_encoder(chunk_size=1000,
+                                                                 chunk_overlap=0)
+        )
+        for doc in docs:
+            doc.metadata = {"page": doc.metadata["page"], "text": doc.page_content,
+                            "pdf_id": str(pdf_id)}
+    else:
+        docs = iter_chunks(iter_pdf_pages(pdf_path), pdf_id)
+    ids = upsert_documents(docs, embeddings=FakeEmbeddings(dimension), index=FakeIndex())
+
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(len(ids), time.perf_counter() - started, peak)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, nargs="+", default=[250, 500, 1000])
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--run", nargs=2, metavar=("MODE", "PDF"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run(*args.run, args.dimension)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        for pages in args.pages:
+            pdf_path = os.path.join(directory, f"{pages}.pdf")
+            write_pdf(pdf_path, pages)
+            print(f"{pages} pages ({os.path.getsize(pdf_path) / 2 ** 20:.1f} MiB)")
+            for mode in ("eager", "streaming"):
+                output = subprocess.run(
+                    [sys.executable, __file__, "--dimension", str(args.dimension),
+                     "--run", mode, pdf_path],
+                    check=True, capture_output=True, text=True
+                ).stdout.split()
+                chunks, seconds, peak = int(output[0]), float(output[1]), float(output[2])
+                print(f"    {mode:<9} {chunks:>6} chunks in {seconds:6.1f}s, "
+                      f"peak RSS {peak:7.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+"""
+Local stand-ins for the OpenAI API, the Pinecone data plane and web pages.
+
+A single HTTP server answers:
+
+- POST /v1/embeddings and /v1/chat/completions like the OpenAI API, with
+  deterministic embeddings and streamed (or not) answers of `--answer-tokens`
+  tokens;
+- POST /vectors/upsert, /query, /vectors/delete and /describe_index_stats
+  like a Pinecone index host, keeping the vectors in memory;
+- GET /pages/<n>, an article of `--page-words` words to upload;
+- GET /stats, the number of requests and injected errors per route.
+
+Every API request waits `--openai-latency` or `--pinecone-latency` seconds
+(streamed answers then `--token-delay` seconds per token) and fails with a
+429 at `--error-rate`. Point the app at it with:
+
+    python benchmarks/fake_services.py --port 8100
+    OPENAI_BASE_URL=http://127.0.0.1:8100/v1 PINECONE_HOST=http://127.0.0.1:8100 \
+        python manage.py runserver
+
+`benchmarks/load_test.py` starts it on its own.
+"""
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import numpy as np
+
+_WORDS = ("the model reads every page of the document and answers questions about "
+          "its content using the most relevant passages found by the search").split()
+
+
+class FakeServices:
+    """
+    State and behaviour of the fake APIs.
+
+    Args:
+        openai_latency (float): Seconds before an OpenAI response (or its
+            first token) is sent.
+        token_delay (float): Seconds between the tokens of streamed answers.
+        answer_tokens (int): Number of tokens of every answer.
+        pinecone_latency (float): Seconds before a Pinecone response.
+        error_rate (float): Fraction of API requests failed with a 429.
+        retry_after (float): `Retry-After` of the failed requests.
+        dimension (int): Dimension of the embeddings.
+        page_words (int): Number of words of the served pages.
+    """
+    def __init__(self, openai_latency=0.2, token_delay=0.02, answer_tokens=50,
+                 pinecone_latency=0.02, error_rate=0.0, retry_after=0.1,
+                 dimension=1536, page_words=2000):
+        self.openai_latency = openai_latency
+        self.token_delay = token_delay
+        self.answer_tokens = answer_tokens
+        self.pinecone_latency = pinecone_latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.dimension = dimension
+        self.page_words = page_words
+        self.lock = threading.Lock()
+        self.vectors = {}           # id -> (unit vector, metadata)
+        self.by_pdf_id = {}         # pdf_id metadata -> set of ids
+        self.requests = Counter()
+        self.errors = Counter()
+
+    def count(self, route):
+        """Count a request to `route`, returning whether to fail it."""
+        failed = route != "pages" and random.random() < self.error_rate
+        with self.lock:
+            self.requests[route] += 1
+            if failed:
+                self.errors[route] += 1
+        return failed
+
+    def embed(self, value):
+        """A deterministic unit vector for a text or a list of token IDs."""
+        digest = hashlib.sha256(json.dumps(value).encode()).digest()
+        vector = np.random.default_rng(int.from_bytes(digest[:8], "little")) \
+            .standard_normal(self.dimension, dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def upsert(self, vectors):
+        with self.lock:
+            for vector in vectors:
+                values = np.asarray(vector["values"], dtype=np.float32)
+                metadata = vector.get("metadata") or {}
+                self._remove(vector["id"])
+                self.vectors[vector["id"]] = (values / (np.linalg.norm(values) or 1), metadata)
+                self.by_pdf_id.setdefault(metadata.get("pdf_id"), set()).add(vector["id"])
+
+    def _remove(self, vector_id):
+        entry = self.vectors.pop(vector_id, None)
+        if entry is not None:
+            self.by_pdf_id.get(entry[1].get("pdf_id"), set()).discard(vector_id)
+
+    def delete(self, ids=None, filter=None):
+        with self.lock:
+            if filter is not None:
+                ids = [vector_id for pdf_id in self._pdf_ids(filter)
+                       for vector_id in self.by_pdf_id.get(pdf_id, ())]
+            for vector_id in ids or ():
+                self._remove(vector_id)
+
+    @staticmethod
+    def _pdf_ids(filter):
+        condition = filter.get("pdf_id")
+        if isinstance(condition, dict):
+            return condition.get("$in") or [condition.get("$eq")]
+        return [condition]
+
+    def query(self, vector, top_k, filter=None):
+        with self.lock:
+            if filter:
+                ids = [vector_id for pdf_id in self._pdf_ids(filter)
+                       for vector_id in self.by_pdf_id.get(pdf_id, ())]
+            else:
+                ids = list(self.vectors)
+            entries = [self.vectors[vector_id] for vector_id in ids]
+        if not ids:
+            return []
+        scores = np.stack([values for values, _ in entries]) @ np.asarray(vector, np.float32)
+        best = np.argsort(-scores)[:top_k]
+        return [{"id": ids[i], "score": float(scores[i]), "values": [],
+                 "metadata": entries[i][1]} for i in best]
+
+    def page(self, number):
+        rng = random.Random(number)
+        paragraphs = []
+        for start in range(0, self.page_words, 100):
+            words = [rng.choice(_WORDS) for _ in range(min(100, self.page_words - start))]
+            paragraphs.append(f"<p>{' '.join(words).capitalize()}.</p>")
+        return (f"<html><head><title>Page {number}</title></head><body><article>"
+                f"<h1>Page {number}</h1>{''.join(paragraphs)}</article></body></html>")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def services(self):
+        return self.server.services
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type="application/json", headers=()):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _rate_limited(self):
+        self._send(429, {"error": {"message": "Rate limit reached", "type": "requests",
+                                   "code": "rate_limit_exceeded"}},
+                   headers=[("Retry-After", str(self.services.retry_after))])
+
+    def do_GET(self):
+        match = re.fullmatch(r"/pages/(\d+)", self.path)
+        if match:
+            self.services.count("pages")
+            self._send(200, self.services.page(int(match.group(1))).encode(),
+                       "text/html; charset=utf-8")
+        elif self.path == "/stats":
+            with self.services.lock:
+                self._send(200, {"requests": dict(self.services.requests),
+                                 "errors": dict(self.services.errors),
+                                 "vectors": len(self.services.vectors)})
+        else:
+            self._send(404, {"error": "Not found"})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        routes = {
+            "/v1/embeddings": self._embeddings,
+            "/v1/chat/completions": self._chat,
+            "/vectors/upsert": self._upsert,
+            "/query": self._query,
+            "/vectors/delete": self._delete,
+            "/describe_index_stats": self._stats,
+        }
+        path = self.path.split("?")[0]
+        route = routes.get(path)
+        if route is None:
+            return self._send(404, {"error": "Not found"})
+        if self.services.count(path):
+            return self._rate_limited()
+        route(body)
+
+    def _embeddings(self, body):
+        time.sleep(self.services.openai_latency)
+        inputs = body["input"]
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        data = []
+        for index, value in enumerate(inputs):
+            vector = self.services.embed(value)
+            if body.get("encoding_format") == "base64":
+                vector = base64.b64encode(vector.astype(np.float32).tobytes()).decode()
+            else:
+                vector = vector.tolist()
+            data.append({"object": "embedding", "index": index, "embedding": vector})
+        tokens = sum(len(value) if isinstance(value, list) else len(value.split())
+                     for value in inputs)
+        self._send(200, {"object": "list", "data": data, "model": body.get("model"),
+                         "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+
+    def _chat(self, body):
+        time.sleep(self.services.openai_latency)
+        tokens = [" " + _WORDS[i % len(_WORDS)] for i in range(self.services.answer_tokens)]
+        base = {"id": "chatcmpl-fake", "created": int(time.time()), "model": body.get("model")}
+        if not body.get("stream"):
+            return self._send(200, {**base, "object": "chat.completion", "choices": [{
+                "index": 0, "finish_reason": "stop",
+                "message": {"role": "assistant", "content": "".join(tokens).strip()},
+            }], "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens),
+                          "total_tokens": len(tokens)}})
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        deltas = [{"role": "assistant", "content": ""}] + [{"content": t} for t in tokens]
+        for number, delta in enumerate(deltas):
+            if number > 1:
+                time.sleep(self.services.token_delay)
+            self._chunk({**base, "object": "chat.completion.chunk", "choices": [
+                {"index": 0, "delta": delta, "finish_reason": None}]})
+        self._chunk({**base, "object": "chat.completion.chunk", "choices": [
+            {"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        self._chunk("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _chunk(self, data):
+        event = f"data: {data if isinstance(data, str) else json.dumps(data)}\n\n".encode()
+        self.wfile.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+        self.wfile.flush()
+
+    def _upsert(self, body):
+        time.sleep(self.services.pinecone_latency)
+        self.services.upsert(body["vectors"])
+        self._send(200, {"upsertedCount": len(body["vectors"])})
+
+    def _query(self, body):
+        time.sleep(self.services.pinecone_latency)
+        matches = self.services.query(body["vector"], body.get("topK", 10), body.get("filter"))
+        self._send(200, {"matches": matches, "namespace": body.get("namespace", "")})
+
+    def _delete(self, body):
+        time.sleep(self.services.pinecone_latency)
+        self.services.delete(body.get("ids"), body.get("filter"))
+        self._send(200, {})
+
+    def _stats(self, body):
+        with self.services.lock:
+            count = len(self.services.vectors)
+        self._send(200, {"namespaces": {"": {"vectorCount": count}},
+                         "dimension": self.services.dimension, "totalVectorCount": count})
+
+
+def make_server(services, host="127.0.0.1", port=0):
+    """
+    Create the HTTP server of `services`, to be run with `serve_forever`.
+
+    Returns:
+        ThreadingHTTPServer: The server, listening on `server_address`.
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.services = services
+    return server
+
+
+def add_arguments(parser):
+    """Add the options of `FakeServices` to an argument parser."""
+    parser.add_argument("--openai-latency", type=float, default=0.2)
+    parser.add_argument("--token-delay", type=float, default=0.02)
+    parser.add_argument("--answer-tokens", type=int, default=50)
+    parser.add_argument("--pinecone-latency", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=0.1)
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--page-words", type=int, default=2000)
+
+
+def services_from_arguments(args):
+    """Create the `FakeServices` configured by the options of `add_arguments`."""
+    return FakeServices(openai_latency=args.openai_latency, token_delay=args.token_delay,
+                        answer_tokens=args.answer_tokens,
+                        pinecone_latency=args.pinecone_latency, error_rate=args.error_rate,
+                        retry_after=args.retry_after, dimension=args.dimension,
+                        page_words=args.page_words)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100, help="0 for any free port")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = make_server(services_from_arguments(args), args.host, args.port)
+    # Read by load_test.py when started with --port 0
+    print(f"Listening on http://{args.host}:{server.server_address[1]}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
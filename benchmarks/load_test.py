@@ -0,0 +1,372 @@
+"""
+Load test chats and uploads against fake OpenAI and Pinecone APIs.
+
+Starts `fake_services.py` in its own process and points the app at it
+(`OPENAI_BASE_URL`, `PINECONE_HOST`), so requests go through the real view,
+ORM, LangChain, OpenAI and Pinecone client code over HTTP, with the
+latencies and error rate given to the fake services. The app runs in this
+process on a throwaway SQLite database:
+
+1. every virtual user uploads `--documents` pages, indexed by the worker;
+2. for `--seconds` seconds, `--concurrency` virtual users send requests
+   through Django's ASGI handler, each an upload (`upload_link`) with
+   probability `--upload-ratio` and otherwise a question (`chat_view`, or
+   `chat_stream` with `--stream`), while a worker thread indexes the
+   uploaded pages like `run_worker` does.
+
+Reported per operation: requests/s, p50/p95/p99 latency and errors, the
+time from upload to indexed, and the memory (RSS) of the app process.
+
+Results saved with `--json` record the commit and parameters, and
+`--compare` runs the same test again and fails (exit status 1) if the p95
+latency or the throughput of an operation got more than `--tolerance`
+worse, so regressions are caught before deploying:
+
+    python benchmarks/load_test.py --seconds 30 --json baseline.json
+    git checkout my-branch
+    python benchmarks/load_test.py --seconds 30 --compare baseline.json
+"""
+from pathlib import Path
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+from fake_services import add_arguments as add_service_arguments
+
+
+def start_fake_services(args):
+    """Start `fake_services.py` on a free port, returning the process and its URL."""
+    options = ["--openai-latency", args.openai_latency, "--token-delay", args.token_delay,
+               "--answer-tokens", args.answer_tokens, "--pinecone-latency",
+               args.pinecone_latency, "--error-rate", args.error_rate, "--retry-after",
+               args.retry_after, "--dimension", args.dimension, "--page-words",
+               args.page_words]
+    process = subprocess.Popen(
+        [sys.executable, str(ROOT / "benchmarks" / "fake_services.py"), "--port", "0",
+         *map(str, options)],
+        stdout=subprocess.PIPE, text=True
+    )
+    line = process.stdout.readline()
+    if not line.startswith("Listening on "):
+        process.kill()
+        raise RuntimeError("The fake services failed to start")
+    return process, line.split()[-1]
+
+
+def configure_environment(url, directory, args):
+    """Point the app at the fake services and keep its files in `directory`."""
+    os.environ.update({
+        "DJANGO_SETTINGS_MODULE": "DjangoLangChainProject.settings",
+        "OPENAI_API_KEY": "sk-fake",
+        "OPENAI_BASE_URL": f"{url}/v1",
+        "PINECONE_API_KEY": "fake",
+        "PINECONE_INDEX": "load-test",
+        "PINECONE_HOST": url,
+        "VECTOR_STORE_BACKEND": "pinecone",
+        "DATABASE_URL": f"sqlite:///{directory / 'db.sqlite3'}",
+        "EMBEDDING_CACHE_PATH": "" if args.no_embedding_cache
+        else str(directory / "embedding_cache.sqlite3"),
+        "KEYWORD_INDEX_PATH": str(directory / "keyword_indexes"),
+        "INGESTION_MODE": "html",
+        # Every page comes from the same fake host
+        "INGESTION_PER_HOST_CONCURRENCY": str(args.fetch_concurrency),
+        "INGESTION_PER_HOST_DELAY": "0",
+        # Every virtual user asks far more often than the per-user rate limits allow
+        "ADMISSION_ENABLED": "true" if args.admission else "false",
+    })
+    os.environ.setdefault("DJANGO_SECRET_KEY", "load-test")
+    # Documents are written to pdfs/ relative to the working directory
+    (directory / "pdfs").mkdir()
+    os.chdir(directory)
+
+
+def run_queued_jobs(batch_size):
+    """Run due ingestion jobs like `run_worker`, returning how many ran."""
+    from DjangoLangChainApp.ingestion import claim_jobs, run_jobs
+
+    job_ids = claim_jobs(batch_size)
+    if job_ids:
+        run_jobs(job_ids)
+    return len(job_ids)
+
+
+def worker(stop, batch_size):
+    """Index uploaded pages until `stop` is set and the queue is empty."""
+    from django.db import connection
+
+    try:
+        while True:
+            if not run_queued_jobs(batch_size):
+                if stop.is_set():
+                    return
+                time.sleep(0.05)
+    finally:
+        connection.close()
+
+
+def percentile(values, percent):
+    """The `percent`th percentile of `values`, by linear interpolation."""
+    values = sorted(values)
+    if not values:
+        return None
+    position = (len(values) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(latencies, errors, seconds):
+    """Throughput and latency percentiles (in milliseconds) of an operation."""
+    summary = {"requests": len(latencies) + errors, "errors": errors,
+               "per_second": round(len(latencies) / seconds, 2)}
+    for percent in (50, 95, 99):
+        value = percentile(latencies, percent)
+        summary[f"p{percent}_ms"] = None if value is None else round(value * 1000, 1)
+    return summary
+
+
+def rss_mb():
+    """Current resident memory of this process in MiB."""
+    with open("/proc/self/statm") as statm:
+        pages = int(statm.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+async def virtual_user(client, url, pdf_ids, args, deadline, samples, counter):
+    """Send requests until `deadline`, appending (operation, seconds, ok) to `samples`."""
+    from django.urls import reverse
+
+    while time.monotonic() < deadline:
+        counter[0] += 1
+        number = counter[0]
+        started = time.perf_counter()
+        if random.random() < args.upload_ratio:
+            operation = "upload"
+            response = await client.post(reverse("upload_link"),
+                                         {"url": f"{url}/pages/{100_000 + number}"})
+            ok = response.status_code == 302
+        else:
+            operation = "chat"
+            view = "chat_stream" if args.stream else "chat_view"
+            response = await client.post(
+                reverse(view, args=[random.choice(pdf_ids)]),
+                {"querry": f"What does the document say about topic {number}?"}
+            )
+            ok = response.status_code == 200
+            if ok and args.stream:
+                content = b"".join([chunk async for chunk in response.streaming_content])
+                ok = b"event: done" in content
+        samples.append((operation, time.perf_counter() - started, ok))
+
+
+async def run_load(users, url, args):
+    """Run the virtual users for `--seconds` seconds, returning their samples."""
+    from django.test import AsyncClient
+    from DjangoLangChainApp.models import PdfFile
+
+    clients = []
+    for user in users:
+        # Failed requests count as errors instead of stopping the test
+        client = AsyncClient(raise_request_exception=False)
+        await client.aforce_login(user)
+        pdf_ids = [pdf_id async for pdf_id in PdfFile.objects.filter(user=user)
+                   .values_list("pdf_id", flat=True)]
+        clients.append((client, pdf_ids))
+
+    samples, counter = [], [0]
+    deadline = time.monotonic() + args.seconds
+    await asyncio.gather(*(virtual_user(client, url, pdf_ids, args, deadline, samples, counter)
+                           for client, pdf_ids in clients))
+    return samples
+
+
+def run(args, url):
+    """Seed the documents, run the load and return the results."""
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from django.contrib.auth.models import User
+    from django.core.management import call_command
+    from DjangoLangChainApp.ingestion import enqueue_ingestions
+    from DjangoLangChainApp.models import IngestionJob, PdfFile
+
+    settings.DEBUG = False
+    settings.ALLOWED_HOSTS = ["testserver"]
+    call_command("migrate", run_syncdb=True, verbosity=0)
+
+    users = [User.objects.create_user(username=f"load-{i}") for i in range(args.concurrency)]
+    started = time.perf_counter()
+    for i, user in enumerate(users):
+        enqueue_ingestions(user, [f"{url}/pages/{i * args.documents + n}"
+                                  for n in range(args.documents)])
+    while run_queued_jobs(args.batch_size):
+        pass
+    seeding = time.perf_counter() - started
+    indexed = PdfFile.objects.filter(status=PdfFile.Status.INDEXED).count()
+    if indexed < len(users) * args.documents:
+        raise RuntimeError(f"Only {indexed} of {len(users) * args.documents} documents "
+                           f"were indexed")
+    print(f"Indexed {indexed} documents in {seeding:.1f}s", file=sys.stderr)
+
+    rss_before = rss_mb()
+    stop = threading.Event()
+    thread = threading.Thread(target=worker, args=(stop, args.batch_size))
+    thread.start()
+    load_started = time.perf_counter()
+    load_start_time = django.utils.timezone.now()
+    try:
+        samples = asyncio.run(run_load(users, url, args))
+        seconds = time.perf_counter() - load_started
+    finally:
+        stop.set()
+        thread.join()
+
+    jobs = IngestionJob.objects.filter(created_at__gte=load_start_time)
+    indexing = [(job.updated_at - job.created_at).total_seconds()
+                for job in jobs.filter(status=IngestionJob.Status.DONE)]
+    not_indexed = jobs.exclude(status=IngestionJob.Status.DONE).count()
+
+    results = {}
+    for operation in ("chat", "upload"):
+        latencies = [latency for op, latency, ok in samples if op == operation and ok]
+        errors = sum(1 for op, _, ok in samples if op == operation and not ok)
+        results[operation] = summarize(latencies, errors, seconds)
+    results["indexing"] = summarize(indexing, not_indexed, seconds)
+    return {
+        "seeding_seconds": round(seeding, 1),
+        "results": results,
+        "memory": {"rss_before_load_mb": round(rss_before, 1),
+                   "rss_after_load_mb": round(rss_mb(), 1),
+                   "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                                        / 1024, 1)},
+    }
+
+
+def git_commit():
+    """The checked out commit, marked "-dirty" with uncommitted changes."""
+    def git(*command):
+        return subprocess.run(["git", *command], cwd=ROOT, capture_output=True,
+                              text=True).stdout.strip()
+    commit = git("rev-parse", "--short", "HEAD") or "unknown"
+    return commit + ("-dirty" if git("status", "--porcelain", "--untracked-files=no") else "")
+
+
+def print_results(report, baseline=None):
+    """Print the results, with the change from `baseline` when given."""
+    print(f"commit {report['commit']}, {report['parameters']['concurrency']} users, "
+          f"{report['parameters']['seconds']}s")
+    print(f"{'':>9} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for operation, summary in report["results"].items():
+        line = (f"{operation:>9} {summary['per_second']:>8} {summary['p50_ms']!s:>9} "
+                f"{summary['p95_ms']!s:>9} {summary['p99_ms']!s:>9} {summary['errors']:>7}")
+        before = (baseline or {}).get("results", {}).get(operation)
+        if before:
+            line += (f"   vs {baseline['commit']}: {change(before['per_second'], summary['per_second'])}"
+                     f" req/s, {change(before['p95_ms'], summary['p95_ms'])} p95")
+        print(line)
+    memory = report["memory"]
+    print(f"memory: {memory['rss_before_load_mb']} MiB before load, "
+          f"{memory['rss_after_load_mb']} MiB after, {memory['peak_rss_mb']} MiB peak")
+
+
+def change(before, after):
+    """Relative change from `before` to `after`, e.g. "+12%"."""
+    if not before or after is None:
+        return "n/a"
+    return f"{(after - before) / before:+.0%}"
+
+
+def regressions(report, baseline, tolerance, min_requests):
+    """Operations whose p95 latency or throughput got worse than `tolerance`."""
+    found = []
+    for operation, before in baseline["results"].items():
+        after = report["results"].get(operation)
+        # Percentiles of a handful of requests are mostly noise
+        if not after or min(before["requests"], after["requests"]) < min_requests:
+            continue
+        if before["p95_ms"] and after["p95_ms"] and \
+                after["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            found.append(f"{operation} p95 {before['p95_ms']} -> {after['p95_ms']} ms")
+        if after["per_second"] < before["per_second"] * (1 - tolerance):
+            found.append(f"{operation} throughput {before['per_second']} -> "
+                         f"{after['per_second']} req/s")
+        if after["errors"] > before["errors"] * (1 + tolerance) + 1:
+            found.append(f"{operation} errors {before['errors']} -> {after['errors']}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of virtual users")
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--documents", type=int, default=2,
+                        help="Documents uploaded by each user before the load")
+    parser.add_argument("--upload-ratio", type=float, default=0.2)
+    parser.add_argument("--stream", action="store_true", help="Ask through chat_stream")
+    parser.add_argument("--batch-size", type=int, default=8,
+                        help="Jobs the worker runs together")
+    parser.add_argument("--fetch-concurrency", type=int, default=8)
+    parser.add_argument("--no-embedding-cache", action="store_true")
+    parser.add_argument("--admission", action="store_true",
+                        help="Keep admission control on, its 429s count as errors")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Save the results to this file")
+    parser.add_argument("--compare", help="Results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed relative regression with --compare")
+    parser.add_argument("--min-requests", type=int, default=20,
+                        help="Operations with fewer requests aren't compared")
+    add_service_arguments(parser)
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    random.seed(args.seed)
+
+    process, url = start_fake_services(args)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            configure_environment(url, Path(directory), args)
+            report = run(args, url)
+            os.chdir(ROOT)
+    finally:
+        process.terminate()
+
+    parameters = {key: value for key, value in vars(args).items()
+                  if key not in ("json", "compare", "tolerance", "min_requests")}
+    report = {"commit": git_commit(), "python": platform.python_version(),
+              "parameters": parameters, **report}
+    if baseline and baseline.get("parameters") != parameters:
+        print("Warning: the baseline was run with different parameters", file=sys.stderr)
+    print_results(report, baseline)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=2)
+    if baseline:
+        found = regressions(report, baseline, args.tolerance, args.min_requests)
+        for regression in found:
+            print(f"Regression: {regression}")
+        sys.exit(1 if found else 0)
+
+
+if __name__ == "__main__":
+    main()